@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""
+End to end benchmark of StackGlue actions against the in-process CloudFormation stand-in.
+
+usage: python benchmarks/deploy.py [-n 30] [--shape random] [--refs 3] [--resources 5:50]
+                                   [--latency 0.02] [--throttle-rate 20] [--operation-seconds 0]
+                                   [-m 4] [-r 20] [-e sync] [--save FILE] [--compare FILE]
+
+A synthetic project with n stacks is generated in a temporary directory, then apply, update,
+listcs and delete run against benchmarks/fake_cloudformation.py. No AWS account is needed.
+For every action the wall time, the API calls by operation, the throttled calls and the peak
+Python memory (tracemalloc) are reported. --save stores the results as a baseline,
+--compare prints the change against a stored baseline
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import simplejson
+
+from cfnstack.AsyncEngine import AsyncEngine
+from cfnstack.ChangeSetLister import NdjsonWriter
+from cfnstack.StackGlue import StackGlue
+from fake_cloudformation import FakeCloudFormation
+from sort_deps import SHAPES
+
+ACTIONS = ['apply', 'update', 'listcs', 'delete']
+REF_TYPES = ['output', 'resource', 'parameter']
+OUTPUTS = 3
+
+
+class BenchGlue(StackGlue):
+    """
+    StackGlue whose sessions talk to the fake
+    """
+
+    fake = None
+
+    def _new_session(self):
+        return self.fake.register(super(BenchGlue, self)._new_session())
+
+
+def stack_deps(count, shape, rng):
+    """
+    Dependency indexes of every stack, built with the graph shapes of sort_deps
+    """
+    shapes = dict(SHAPES)
+    deps = []
+    for stack in shapes[shape](count, rng):
+        deps.append([int(dep.rsplit('stack', 1)[1]) for dep in (stack.depends_on or [])])
+    return deps
+
+
+def write_project(workdir, count, shape, refs, resources, rng):
+    """
+    Write templates and the YAML file of a synthetic project, return the YAML path and the template sizes
+    """
+    min_resources, max_resources = resources
+    sizes = []
+    lines = ['bench:', '    region: us-east-1', '    environment: dev', '    tags:', '        project: bench', '    stacks:']
+    for index, deps in enumerate(stack_deps(count, shape, rng)):
+        params = ['revision']
+        yaml_params = ['                revision:', '                    value: "{{BENCH_REVISION}}"']
+        for ref in range(refs if deps else 0):
+            var_type = REF_TYPES[ref % len(REF_TYPES)]
+            variable = {'output': 'Out%d' % (ref % OUTPUTS), 'resource': 'Res0', 'parameter': 'revision'}[var_type]
+            params.append('ref%d' % ref)
+            yaml_params += ['                ref%d:' % ref,
+                            '                    source: stack%d' % rng.choice(deps),
+                            '                    type: %s' % var_type,
+                            '                    variable: %s' % variable]
+
+        resource_count = rng.randint(min_resources, max_resources)
+        template = {
+            'AWSTemplateFormatVersion': '2010-09-09',
+            'Parameters': dict((param, {'Type': 'String'}) for param in params),
+            'Resources': dict(('Res%d' % res, {'Type': 'AWS::CloudFormation::WaitConditionHandle',
+                                               'Metadata': {'Revision': {'Ref': 'revision'}, 'Index': res}})
+                              for res in range(resource_count)),
+            'Outputs': dict(('Out%d' % out, {'Value': {'Ref': 'Res%d' % (out % resource_count)}}) for out in range(OUTPUTS)),
+        }
+        template_path = join(workdir, 'stack%d.template' % index)
+        with open(template_path, 'w') as template_file:
+            simplejson.dump(template, template_file, indent=4)
+        sizes.append(os.path.getsize(template_path))
+
+        lines += ['        stack%d:' % index, '            cf_template: %s' % template_path, '            depends:']
+        lines += ['                - stack%d' % dep for dep in deps]
+        lines += ['            params:'] + yaml_params
+
+    yamlfile = join(workdir, 'bench.yaml')
+    with open(yamlfile, 'w') as yaml_file:
+        yaml_file.write('\n'.join(lines) + '\n')
+    return yamlfile, sizes
+
+
+def run_action(args, fake, yamlfile, action):
+    glue = BenchGlue(yamlfile, None, args.max_parallel, args.api_rate)
+    glue.sort_cf_stacks_by_deps()
+    options = {}
+    if action == 'listcs':
+        # Change sets are serialized as in a real run but not printed
+        options = {'writer': NdjsonWriter(open(os.devnull, 'w'))}
+    if args.engine == 'async':
+        AsyncEngine(glue, args.max_parallel).run(action, **options)
+    else:
+        getattr(glue, action)(**options)
+    return glue
+
+
+def measure(args, fake, yamlfile, action):
+    fake.reset_counters()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    ok = True
+    try:
+        run_action(args, fake, yamlfile, action)
+    except SystemExit:
+        ok = False
+    wall = time.perf_counter() - start
+    calls = fake.api_calls()
+    return {
+        'ok': ok,
+        'wall_seconds': round(wall, 4),
+        'api_calls': sum(calls.values()),
+        'calls_by_operation': calls,
+        'throttled': fake.throttled,
+        'peak_memory_mib': round(tracemalloc.get_traced_memory()[1] / 1048576.0, 2),
+    }
+
+
+def compare(results, baseline):
+    print("\nChange against baseline:")
+    print("%-8s %14s %14s %14s" % ('action', 'wall', 'api calls', 'peak memory'))
+    for action in ACTIONS:
+        if action not in results or action not in baseline['results']:
+            continue
+        current, previous = results[action], baseline['results'][action]
+        deltas = []
+        for key in ('wall_seconds', 'api_calls', 'peak_memory_mib'):
+            if previous[key]:
+                deltas.append('%+.1f%%' % ((current[key] - previous[key]) * 100.0 / previous[key]))
+            else:
+                deltas.append('-')
+        print("%-8s %14s %14s %14s" % tuple([action] + deltas))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-n', '--stacks', dest='stacks', type=int, default=30, help='Number of stacks in the project')
+    arg_parser.add_argument('--shape', dest='shape', default='random', choices=[name for name, _ in SHAPES], help='Dependency graph shape')
+    arg_parser.add_argument('--refs', dest='refs', type=int, default=3, help='Parameters referencing a dependency, per stack')
+    arg_parser.add_argument('--resources', dest='resources', default='5:50', help='MIN:MAX resources per template')
+    arg_parser.add_argument('--change-sets', dest='change_sets', type=int, default=2, help='Change sets per stack listed by listcs')
+    arg_parser.add_argument('--latency', dest='latency', type=float, default=0.02, help='Seconds per API call')
+    arg_parser.add_argument('--throttle-rate', dest='throttle_rate', type=float, default=20, help='API calls per second before throttling, 0 disables it')
+    arg_parser.add_argument('--operation-seconds', dest='operation_seconds', type=float, default=0, help='Seconds a stack operation stays in progress')
+    arg_parser.add_argument('-m', '--max-parallel', dest='max_parallel', type=int, default=4, help='Stacks deployed at the same time')
+    arg_parser.add_argument('-r', '--api-rate', dest='api_rate', type=float, default=20, help='cfnstack API rate limit')
+    arg_parser.add_argument('-e', '--engine', dest='engine', default='sync', choices=['sync', 'async'], help='Execution backend')
+    arg_parser.add_argument('--seed', dest='seed', type=int, default=1, help='Random seed for project generation')
+    arg_parser.add_argument('--save', dest='save', help='Store the results as baseline in this file')
+    arg_parser.add_argument('--compare', dest='compare', help='Compare the results with the baseline in this file')
+    arg_parser.add_argument('--log-level', dest='loglevel', default='error', help='cfnstack log level')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()))
+    resources = tuple(int(value) for value in args.resources.split(':'))
+    if len(resources) == 1:
+        resources = resources * 2
+
+    workdir = tempfile.mkdtemp(prefix='cfnstack-bench-')
+    # Offline credentials and config cache, the user's AWS config is never read
+    with open(join(workdir, 'credentials'), 'w') as credentials:
+        credentials.write('[default]\naws_access_key_id = bench\naws_secret_access_key = bench\n')
+    with open(join(workdir, 'config'), 'w') as config:
+        config.write('[default]\nregion = us-east-1\n')
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = join(workdir, 'credentials')
+    os.environ['AWS_CONFIG_FILE'] = join(workdir, 'config')
+    os.environ['CFNSTACK_CACHE_DIR'] = join(workdir, 'cache')
+    # The revision is not a secret, configs rendering it are cached
+    os.environ['CFNSTACK_CACHE_VARIABLES'] = 'BENCH_REVISION'
+
+    try:
+        yamlfile, sizes = write_project(workdir, args.stacks, args.shape, args.refs, resources, random.Random(args.seed))
+        fake = FakeCloudFormation(args.latency, args.throttle_rate, args.operation_seconds)
+        BenchGlue.fake = fake
+
+        settings = dict((key, value) for key, value in vars(args).items() if key not in ('save', 'compare', 'loglevel'))
+        print("%s stacks, %s shape, templates %s-%s bytes" % (args.stacks, args.shape, min(sizes), max(sizes)))
+        print("%-8s %4s %10s %10s %10s %12s" % ('action', 'ok', 'wall (s)', 'api calls', 'throttled', 'peak (MiB)'))
+
+        tracemalloc.start()
+        results = {}
+        for action in ACTIONS:
+            os.environ['BENCH_REVISION'] = '2' if action == 'update' else '1'
+            if action == 'listcs':
+                for name in list(fake.stacks):
+                    fake.add_change_sets(name, args.change_sets)
+            results[action] = result = measure(args, fake, yamlfile, action)
+            print("%-8s %4s %10.3f %10d %10d %12.2f" % (action, 'yes' if result['ok'] else 'no', result['wall_seconds'],
+                                                        result['api_calls'], result['throttled'], result['peak_memory_mib']))
+            logging.getLogger(__name__).info("%s calls: %s", action, result['calls_by_operation'])
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = simplejson.load(baseline_file)
+        if baseline['settings'] != settings:
+            print("Warning: baseline was recorded with different settings: %s" % baseline['settings'])
+        compare(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            simplejson.dump({'settings': settings, 'results': results}, baseline_file, indent=4, sort_keys=True)
+        print("Baseline saved to %s" % args.save)
+
+
+if __name__ == '__main__':
+    main()
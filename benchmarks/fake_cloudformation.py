@@ -0,0 +1,415 @@
+"""
+In-process CloudFormation stand-in for offline benchmarks.
+
+FakeCloudFormation answers the cloudformation calls of the boto3 sessions it is registered on.
+Requests never leave the process: the botocore before-send hook returns query protocol XML built
+from the service model, so botocore parsing, retries and the cfnstack rate limiter all run as they
+would against AWS. Every call waits for the configured latency, calls above the throttle rate get a
+Throttling error, and stack operations complete after a configurable number of seconds.
+Only the operations cfnstack uses are implemented
+"""
+
+import datetime
+import itertools
+import threading
+import time
+import uuid
+from xml.sax.saxutils import escape
+
+import simplejson
+from botocore.awsrequest import AWSResponse
+
+XMLNS = 'http://cloudformation.amazonaws.com/doc/2010-05-15/'
+PAGE_SIZE = 100
+EVENTS_PAGE_SIZE = 100
+
+
+class FakeError(Exception):
+
+    def __init__(self, code, message, status=400):
+        super(FakeError, self).__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class _Body(object):
+    """
+    Raw response stream handed to botocore
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, *args, **kwargs):
+        yield self.body
+
+
+def _timestamp(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _serialize(shape, value):
+    """
+    Query protocol XML of value, driven by the botocore output shape
+    """
+    if shape.type_name == 'structure':
+        parts = []
+        for name, member in shape.members.items():
+            if value.get(name) is None:
+                continue
+            tag = member.serialization.get('name', name)
+            parts.append('<%s>%s</%s>' % (tag, _serialize(member, value[name]), tag))
+        return ''.join(parts)
+    if shape.type_name == 'list':
+        return ''.join('<member>%s</member>' % _serialize(shape.member, item) for item in value)
+    if shape.type_name == 'map':
+        return ''.join('<entry><key>%s</key><value>%s</value></entry>'
+                       % (escape(str(key)), _serialize(shape.value, item)) for key, item in value.items())
+    if shape.type_name == 'timestamp':
+        return _timestamp(value)
+    if shape.type_name == 'boolean':
+        return 'true' if value else 'false'
+    return escape(str(value))
+
+
+def _stored_parameters(parameters, previous=()):
+    """
+    Parameters as cloudformation stores and describes them, only ParameterKey and ParameterValue.
+    UsePreviousValue takes the value from previous
+    """
+    previous_values = dict((item['ParameterKey'], item['ParameterValue']) for item in previous)
+    stored = []
+    for item in parameters:
+        if item.get('UsePreviousValue'):
+            value = previous_values.get(item['ParameterKey'])
+        else:
+            value = item.get('ParameterValue')
+        stored.append({'ParameterKey': item['ParameterKey'], 'ParameterValue': value})
+    return stored
+
+
+class FakeStack(object):
+
+    def __init__(self, name, template_body, parameters, tags):
+        self.name = name
+        self.stack_id = 'arn:aws:cloudformation:us-east-1:123456789012:stack/%s/%s' % (name, uuid.uuid4())
+        self.created = datetime.datetime.utcnow()
+        self.status = None
+        self.done_at = 0
+        self.template_body = template_body
+        self.parameters = parameters
+        self.tags = tags
+        self.events = []
+        self.change_sets = {}
+
+    @property
+    def template(self):
+        return simplejson.loads(self.template_body)
+
+    def resources(self):
+        return sorted((self.template.get('Resources') or {}).keys())
+
+    def physical_id(self, logical_id):
+        return '%s-%s' % (self.name, logical_id)
+
+    def outputs(self):
+        return [{'OutputKey': key, 'OutputValue': '%s-%s' % (self.name, key)}
+                for key in sorted((self.template.get('Outputs') or {}).keys())]
+
+
+class FakeCloudFormation(object):
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, operation_seconds=0.0):
+        # Seconds every API call takes
+        self.latency = latency
+        # Calls per second accepted before answering Throttling, 0 disables throttling
+        self.throttle_rate = throttle_rate
+        # Seconds a create, update or delete stays in progress
+        self.operation_seconds = operation_seconds
+
+        self.stacks = {}
+        self.calls = {}
+        self.throttled = 0
+        self._tokens = float(throttle_rate)
+        self._updated = time.monotonic()
+        self._event_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def register(self, aws_session):
+        """
+        Answer the cloudformation calls of clients created from aws_session from now on
+        """
+        events = aws_session.events
+        events.register('before-parameter-build.cloudformation', self._remember_params, unique_id='fake-cfn-params')
+        events.register('before-send.cloudformation', self._before_send, unique_id='fake-cfn-send')
+        return aws_session
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = {}
+            self.throttled = 0
+
+    def api_calls(self):
+        with self._lock:
+            return dict(self.calls)
+
+    @staticmethod
+    def _remember_params(params, model, context, **kwargs):
+        context['fake_cloudformation'] = (model, dict(params))
+
+    def _take_token(self):
+        if not self.throttle_rate:
+            return True
+        now = time.monotonic()
+        self._tokens = min(float(self.throttle_rate), self._tokens + (now - self._updated) * self.throttle_rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _before_send(self, request, **kwargs):
+        model, params = request.context['fake_cloudformation']
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[model.name] = self.calls.get(model.name, 0) + 1
+            try:
+                if not self._take_token():
+                    self.throttled += 1
+                    raise FakeError('Throttling', 'Rate exceeded')
+                result = getattr(self, '_' + model.name)(params)
+            except FakeError as error:
+                return self._error_response(request, error)
+        return self._response(request, model, result or {})
+
+    def _response(self, request, model, result):
+        body = ''
+        if model.output_shape is not None:
+            body = _serialize(model.output_shape, result)
+        xml = ('<%sResponse xmlns="%s"><%sResult>%s</%sResult><ResponseMetadata><RequestId>%s</RequestId>'
+               '</ResponseMetadata></%sResponse>' % (model.name, XMLNS, model.name, body, model.name, uuid.uuid4(), model.name))
+        return AWSResponse(request.url, 200, {'Content-Type': 'text/xml'}, _Body(xml.encode('utf-8')))
+
+    def _error_response(self, request, error):
+        xml = ('<ErrorResponse xmlns="%s"><Error><Type>Sender</Type><Code>%s</Code><Message>%s</Message></Error>'
+               '<RequestId>%s</RequestId></ErrorResponse>' % (XMLNS, error.code, escape(error.message), uuid.uuid4()))
+        return AWSResponse(request.url, error.status, {'Content-Type': 'text/xml'}, _Body(xml.encode('utf-8')))
+
+    # Stack state
+
+    def _stack(self, name):
+        stack = self.stacks.get(name)
+        if stack is None:
+            for candidate in self.stacks.values():
+                if candidate.stack_id == name:
+                    stack = candidate
+        if stack is not None:
+            self._advance(stack)
+        if stack is None or stack.status == 'DELETE_COMPLETE':
+            raise FakeError('ValidationError', 'Stack with id %s does not exist' % name)
+        return stack
+
+    def _event(self, stack, logical_id, resource_type, status, physical_id=None):
+        stack.events.append({
+            'StackId': stack.stack_id,
+            'EventId': 'event-%d' % next(self._event_ids),
+            'StackName': stack.name,
+            'LogicalResourceId': logical_id,
+            'PhysicalResourceId': physical_id or stack.stack_id,
+            'ResourceType': resource_type,
+            'Timestamp': datetime.datetime.utcnow(),
+            'ResourceStatus': status,
+        })
+
+    def _start(self, stack, action):
+        stack.status = '%s_IN_PROGRESS' % action
+        stack.done_at = time.monotonic() + self.operation_seconds
+        self._event(stack, stack.name, 'AWS::CloudFormation::Stack', stack.status)
+        self._advance(stack)
+
+    def _advance(self, stack):
+        """
+        Complete the running operation of a stack once its time is up
+        """
+        if not stack.status.endswith('_IN_PROGRESS') or time.monotonic() < stack.done_at:
+            return
+        action = stack.status[:-len('_IN_PROGRESS')]
+        template = stack.template.get('Resources') or {}
+        for logical_id in stack.resources():
+            resource_type = template[logical_id].get('Type', 'AWS::CloudFormation::WaitConditionHandle')
+            self._event(stack, logical_id, resource_type, '%s_IN_PROGRESS' % action, stack.physical_id(logical_id))
+            self._event(stack, logical_id, resource_type, '%s_COMPLETE' % action, stack.physical_id(logical_id))
+        stack.status = '%s_COMPLETE' % action
+        self._event(stack, stack.name, 'AWS::CloudFormation::Stack', stack.status)
+        if action == 'DELETE':
+            del self.stacks[stack.name]
+
+    def _describe(self, stack):
+        return {
+            'StackId': stack.stack_id,
+            'StackName': stack.name,
+            'CreationTime': stack.created,
+            'StackStatus': stack.status,
+            'Parameters': stack.parameters,
+            'Outputs': stack.outputs(),
+            'Tags': stack.tags,
+        }
+
+    def add_change_sets(self, stack_name, count, changes=5):
+        """
+        Seed change sets on an existing stack, listcs has nothing to list otherwise
+        """
+        with self._lock:
+            stack = self._stack(stack_name)
+            for index in range(count):
+                name = 'bench-changeset-%d' % index
+                stack.change_sets[name] = {
+                    'ChangeSetId': 'arn:aws:cloudformation:us-east-1:123456789012:changeSet/%s/%s' % (name, uuid.uuid4()),
+                    'ChangeSetName': name,
+                    'StackId': stack.stack_id,
+                    'StackName': stack.name,
+                    'CreationTime': datetime.datetime.utcnow(),
+                    'ExecutionStatus': 'AVAILABLE',
+                    'Status': 'CREATE_COMPLETE',
+                    'Changes': [{'Type': 'Resource', 'ResourceChange': {
+                        'Action': 'Modify', 'LogicalResourceId': logical_id,
+                        'PhysicalResourceId': stack.physical_id(logical_id),
+                        'ResourceType': 'AWS::CloudFormation::WaitConditionHandle', 'Replacement': 'False'}}
+                        for logical_id in stack.resources()[:changes]],
+                }
+
+    # Operations, called with the lock held
+
+    def _DescribeStacks(self, params):
+        if params.get('StackName'):
+            return {'Stacks': [self._describe(self._stack(params['StackName']))]}
+        names = sorted(self.stacks)
+        for name in names:
+            self._advance(self.stacks[name])
+        return {'Stacks': [self._describe(self.stacks[name]) for name in sorted(self.stacks)]}
+
+    def _ListStacks(self, params):
+        wanted = set(params.get('StackStatusFilter') or [])
+        summaries = []
+        for name in sorted(self.stacks):
+            stack = self.stacks[name]
+            self._advance(stack)
+            if name in self.stacks and (not wanted or stack.status in wanted):
+                summaries.append({'StackId': stack.stack_id, 'StackName': stack.name,
+                                  'CreationTime': stack.created, 'StackStatus': stack.status})
+        return {'StackSummaries': summaries}
+
+    def _CreateStack(self, params):
+        name = params['StackName']
+        if name in self.stacks:
+            raise FakeError('AlreadyExistsException', 'Stack [%s] already exists' % name)
+        stack = FakeStack(name, params['TemplateBody'], _stored_parameters(params.get('Parameters', [])), params.get('Tags', []))
+        self.stacks[name] = stack
+        self._start(stack, 'CREATE')
+        return {'StackId': stack.stack_id}
+
+    def _UpdateStack(self, params):
+        stack = self._stack(params['StackName'])
+        if stack.status.endswith('_IN_PROGRESS'):
+            raise FakeError('ValidationError', 'Stack %s is in %s state and can not be updated.' % (stack.name, stack.status))
+        parameters = _stored_parameters(params.get('Parameters', []), stack.parameters)
+        tags = params.get('Tags', stack.tags)
+        if params['TemplateBody'] == stack.template_body and parameters == stack.parameters and tags == stack.tags:
+            raise FakeError('ValidationError', 'No updates are to be performed.')
+        stack.template_body = params['TemplateBody']
+        stack.parameters = parameters
+        stack.tags = tags
+        self._start(stack, 'UPDATE')
+        return {'StackId': stack.stack_id}
+
+    def _DeleteStack(self, params):
+        stack = self.stacks.get(params['StackName'])
+        if stack is not None and not stack.status.startswith('DELETE'):
+            self._start(stack, 'DELETE')
+        return {}
+
+    def _DescribeStackEvents(self, params):
+        stack = self._stack(params['StackName'])
+        start = int(params.get('NextToken') or 0)
+        newest_first = stack.events[::-1]
+        result = {'StackEvents': newest_first[start:start + EVENTS_PAGE_SIZE]}
+        if start + EVENTS_PAGE_SIZE < len(newest_first):
+            result['NextToken'] = str(start + EVENTS_PAGE_SIZE)
+        return result
+
+    def _DescribeStackResource(self, params):
+        stack = self._stack(params['StackName'])
+        logical_id = params['LogicalResourceId']
+        if logical_id not in stack.resources():
+            raise FakeError('ValidationError', 'Resource %s does not exist for stack %s' % (logical_id, stack.name))
+        return {'StackResourceDetail': {
+            'StackName': stack.name, 'StackId': stack.stack_id, 'LogicalResourceId': logical_id,
+            'PhysicalResourceId': stack.physical_id(logical_id), 'ResourceType': 'AWS::CloudFormation::WaitConditionHandle',
+            'LastUpdatedTimestamp': stack.created, 'ResourceStatus': 'CREATE_COMPLETE'}}
+
+    def _ListStackResources(self, params):
+        stack = self._stack(params['StackName'])
+        start = int(params.get('NextToken') or 0)
+        resources = stack.resources()
+        result = {'StackResourceSummaries': [{
+            'LogicalResourceId': logical_id, 'PhysicalResourceId': stack.physical_id(logical_id),
+            'ResourceType': 'AWS::CloudFormation::WaitConditionHandle', 'LastUpdatedTimestamp': stack.created,
+            'ResourceStatus': 'CREATE_COMPLETE'} for logical_id in resources[start:start + PAGE_SIZE]]}
+        if start + PAGE_SIZE < len(resources):
+            result['NextToken'] = str(start + PAGE_SIZE)
+        return result
+
+    def _GetTemplate(self, params):
+        return {'TemplateBody': self._stack(params['StackName']).template_body}
+
+    def _ListChangeSets(self, params):
+        stack = self._stack(params['StackName'])
+        return {'Summaries': [dict((key, value) for key, value in change_set.items() if key != 'Changes')
+                              for change_set in stack.change_sets.values()]}
+
+    def _change_set(self, params):
+        name = params['ChangeSetName']
+        if name.startswith('arn:'):
+            for stack in self.stacks.values():
+                for change_set in stack.change_sets.values():
+                    if change_set['ChangeSetId'] == name:
+                        return stack, change_set
+            raise FakeError('ChangeSetNotFound', 'ChangeSet [%s] does not exist' % name, 404)
+        stack = self._stack(params['StackName'])
+        change_set = stack.change_sets.get(name)
+        if change_set is None:
+            raise FakeError('ChangeSetNotFound', 'ChangeSet [%s] does not exist' % name, 404)
+        return stack, change_set
+
+    def _CreateChangeSet(self, params):
+        stack = self._stack(params['StackName'])
+        name = params['ChangeSetName']
+        unchanged = (params['TemplateBody'] == stack.template_body
+                     and _stored_parameters(params.get('Parameters', []), stack.parameters) == stack.parameters)
+        change_set_id = 'arn:aws:cloudformation:us-east-1:123456789012:changeSet/%s/%s' % (name, uuid.uuid4())
+        stack.change_sets[name] = {
+            'ChangeSetId': change_set_id, 'ChangeSetName': name, 'StackId': stack.stack_id, 'StackName': stack.name,
+            'CreationTime': datetime.datetime.utcnow(),
+            'ExecutionStatus': 'UNAVAILABLE' if unchanged else 'AVAILABLE',
+            'Status': 'FAILED' if unchanged else 'CREATE_COMPLETE',
+            'StatusReason': "The submitted information didn't contain changes. Submit different information to create a change set."
+                            if unchanged else None,
+            'Changes': [] if unchanged else [{'Type': 'Resource', 'ResourceChange': {
+                'Action': 'Modify', 'LogicalResourceId': logical_id, 'PhysicalResourceId': stack.physical_id(logical_id),
+                'ResourceType': 'AWS::CloudFormation::WaitConditionHandle', 'Replacement': 'False'}}
+                for logical_id in stack.resources()],
+        }
+        return {'Id': change_set_id, 'StackId': stack.stack_id}
+
+    def _DeleteChangeSet(self, params):
+        stack, change_set = self._change_set(params)
+        del stack.change_sets[change_set['ChangeSetName']]
+        return {}
+
+    def _DescribeChangeSet(self, params):
+        stack, change_set = self._change_set(params)
+        result = dict(change_set)
+        result['Parameters'] = stack.parameters
+        return result
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for DependencyGraph on synthetic stack graphs.
+
+usage: python benchmarks/sort_deps.py [-n 10000] [--legacy]
+
+--legacy also times the sorter StackGlue used before DependencyGraph, keep -n small with it
+"""
+
+import argparse
+import random
+import sys
+import time
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from cfnstack.DependencyGraph import DependencyGraph
+
+
+class FakeStack(object):
+    """
+    Only the attributes DependencyGraph looks at
+    """
+
+    def __init__(self, index, deps):
+        self.name = 'stack%d' % index
+        self.cfn_stack_name = 'bench-dev-stack%d' % index
+        self.depends_on = ['bench-dev-stack%d' % dep for dep in deps] or None
+
+
+def chain(count, rng):
+    return [FakeStack(i, [i - 1] if i else []) for i in range(count)]
+
+
+def star(count, rng):
+    return [FakeStack(i, [0] if i else []) for i in range(count)]
+
+
+def layered(count, rng, width=100, fan_in=3):
+    stacks = []
+    for i in range(count):
+        layer = i // width
+        if layer == 0:
+            deps = []
+        else:
+            previous = range((layer - 1) * width, layer * width)
+            deps = rng.sample(previous, min(fan_in, len(previous)))
+        stacks.append(FakeStack(i, deps))
+    return stacks
+
+
+def random_dag(count, rng, fan_in=4):
+    return [FakeStack(i, rng.sample(range(i), min(fan_in, i))) for i in range(count)]
+
+
+SHAPES = [('chain', chain), ('star', star), ('layered', layered), ('random', random_dag)]
+
+
+def legacy_sort(stack_objs):
+    """
+    Copy of StackGlue.sort_cf_stacks_by_deps before DependencyGraph
+    """
+    sorted_stacks = []
+    dep_graph = {}
+    no_deps = []
+    for stack in stack_objs:
+        if stack.depends_on is None:
+            no_deps.append(stack)
+        else:
+            dep_graph[stack.name] = stack.depends_on[:]
+    while len(no_deps) > 0:
+        stack = no_deps.pop()
+        sorted_stacks.append(stack)
+        for node in list(dep_graph):
+            for deps in dep_graph[node]:
+                if stack.cfn_stack_name == deps:
+                    dep_graph[node].remove(stack.cfn_stack_name)
+                    if len(dep_graph[node]) < 1:
+                        for stack_obj in stack_objs:
+                            if stack_obj.name == node:
+                                no_deps.append(stack_obj)
+                        del dep_graph[node]
+    return sorted_stacks
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-n', '--stacks', dest='stacks', type=int, default=10000, help='Number of stacks per graph')
+    arg_parser.add_argument('--seed', dest='seed', type=int, default=1, help='Random seed for graph generation')
+    arg_parser.add_argument('--legacy', dest='legacy', action='store_true', help='Also time the previous sorter')
+    args = arg_parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print("%-10s %8s %8s %12s %12s %12s" % ('shape', 'stacks', 'levels', 'sort (s)', 'levels (s)', 'legacy (s)'))
+    for shape_name, shape in SHAPES:
+        stacks = shape(args.stacks, rng)
+        graph = DependencyGraph(stacks)
+        ordered, sort_time = timed(graph.topological_order)
+        levels, levels_time = timed(graph.levels)
+        assert len(ordered) == len(stacks)
+
+        legacy_time = '-'
+        if args.legacy:
+            _, elapsed = timed(legacy_sort, stacks)
+            legacy_time = '%.4f' % elapsed
+
+        print("%-10s %8d %8d %12.4f %12.4f %12s" % (shape_name, len(stacks), len(levels), sort_time, levels_time, legacy_time))
+
+
+if __name__ == '__main__':
+    main()
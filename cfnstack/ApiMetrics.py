@@ -0,0 +1,226 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import simplejson
+
+from cfnstack.RateLimiter import THROTTLING_ERROR_CODES
+
+"""
+ApiMetrics counts the cloudformation calls made through the boto3 sessions it is registered on.
+Like RateLimiter it hooks into botocore events, callers only mark which stack and phase of the run
+they are working on with scope(). Every call is recorded by operation, stack, phase and target with
+its latency, retries, throttles and error code. The totals can be written as a JSON summary and as a
+Prometheus textfile for the node exporter textfile collector
+"""
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class ApiMetrics(object):
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.started = time.time()
+        # (target, stack, phase, operation) -> call counters
+        self._calls = {}
+        # operation -> latency histogram
+        self._latency = {}
+        # (target, phase) -> seconds spent in the phase
+        self._phase_seconds = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def register(self, aws_session):
+        """
+        Attach the hooks to all cloudformation calls of a boto3 session.
+        Register after the rate limiter so that waiting for a token is not counted as latency
+        """
+        events = aws_session.events
+        events.register('before-call.cloudformation', self._before_call, unique_id='cfnstack-metrics-start')
+        events.register('response-received.cloudformation', self._response_received, unique_id='cfnstack-metrics-attempt')
+        events.register('after-call.cloudformation', self._after_call, unique_id='cfnstack-metrics-done')
+        events.register('after-call-error.cloudformation', self._after_call_error, unique_id='cfnstack-metrics-error')
+        return aws_session
+
+    def labels(self):
+        return getattr(self._local, 'labels', {})
+
+    @contextmanager
+    def scope(self, **labels):
+        """
+        Attribute the calls made by this thread inside the block to the given target, stack and phase.
+        Time spent in a phase is summed over all threads
+        """
+        previous = self.labels()
+        self._local.labels = dict(previous, **labels)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._local.labels = previous
+            if 'phase' in labels:
+                key = (labels.get('target', previous.get('target', '')), labels['phase'])
+                with self._lock:
+                    self._phase_seconds[key] = self._phase_seconds.get(key, 0.0) + time.monotonic() - start
+
+    def _before_call(self, model, context, **kwargs):
+        context['cfnstack_metrics'] = {'operation': model.name, 'labels': self.labels(), 'start': time.monotonic(),
+                                       'attempts': 0, 'throttles': 0}
+
+    def _response_received(self, context, parsed_response=None, **kwargs):
+        call = context.get('cfnstack_metrics')
+        if call is None:
+            return
+        call['attempts'] += 1
+        if parsed_response and parsed_response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            call['throttles'] += 1
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs):
+        error_code = None
+        if http_response.status_code >= 300:
+            error_code = parsed.get('Error', {}).get('Code') or str(http_response.status_code)
+        self._record(context, error_code)
+
+    def _after_call_error(self, exception, context, **kwargs):
+        self._record(context, exception.__class__.__name__)
+
+    def _record(self, context, error_code):
+        call = context.pop('cfnstack_metrics', None)
+        if call is None:
+            return
+        operation = call['operation']
+        latency = time.monotonic() - call['start']
+        labels = call['labels']
+        key = (labels.get('target', ''), labels.get('stack', ''), labels.get('phase', ''), operation)
+        with self._lock:
+            counters = self._calls.get(key)
+            if counters is None:
+                counters = self._calls[key] = {'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'seconds': 0.0, 'error_codes': {}}
+            counters['calls'] += 1
+            counters['retries'] += max(0, call['attempts'] - 1)
+            counters['throttles'] += call['throttles']
+            counters['seconds'] += latency
+            if error_code:
+                counters['errors'] += 1
+                counters['error_codes'][error_code] = counters['error_codes'].get(error_code, 0) + 1
+
+            histogram = self._latency.get(operation)
+            if histogram is None:
+                histogram = self._latency[operation] = {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0}
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += latency
+
+    def _group(self, position):
+        groups = {}
+        for key, counters in self._calls.items():
+            group = groups.setdefault(key[position], {'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'seconds': 0.0})
+            for name in group:
+                group[name] += counters[name]
+        return groups
+
+    def summary(self):
+        """
+        Totals of the run grouped by operation, stack, phase and target
+        """
+        with self._lock:
+            by_operation = self._group(3)
+            for operation, histogram in self._latency.items():
+                by_operation[operation]['latency_buckets'] = dict(
+                    ('%g' % bound, count) for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']))
+            by_phase = self._group(2)
+            for (target, phase), seconds in self._phase_seconds.items():
+                by_phase.setdefault(phase, {'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'seconds': 0.0})
+                by_phase[phase]['wall_seconds'] = by_phase[phase].get('wall_seconds', 0.0) + seconds
+            totals = {'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0}
+            for counters in self._calls.values():
+                for name in totals:
+                    totals[name] += counters[name]
+            error_codes = {}
+            for counters in self._calls.values():
+                for code, count in counters['error_codes'].items():
+                    error_codes[code] = error_codes.get(code, 0) + count
+            return {
+                'started': self.started,
+                'duration_seconds': time.time() - self.started,
+                'totals': totals,
+                'error_codes': error_codes,
+                'by_operation': by_operation,
+                'by_stack': self._group(1),
+                'by_phase': by_phase,
+                'by_target': self._group(0),
+            }
+
+    def log_summary(self):
+        summary = self.summary()
+        self.logger.info("API calls: %s", summary['totals'])
+        self.logger.info("API calls by phase: %s", dict((phase, group['calls']) for phase, group in summary['by_phase'].items()))
+        if summary['error_codes']:
+            self.logger.info("API errors: %s", summary['error_codes'])
+
+    @staticmethod
+    def _write_atomic(path, text):
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.cfnstack-metrics-')
+        with os.fdopen(handle, 'w') as metrics_file:
+            metrics_file.write(text)
+        os.replace(tmp_path, path)
+
+    def write_json(self, path, extra=None):
+        summary = self.summary()
+        summary.update(extra or {})
+        self._write_atomic(path, simplejson.dumps(summary, indent=4, sort_keys=True))
+
+    @staticmethod
+    def _labels(**labels):
+        return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for name, value in sorted(labels.items()))
+
+    def prometheus(self, action=''):
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            calls = sorted(self._calls.items())
+            latency = sorted(self._latency.items())
+            phase_seconds = sorted(self._phase_seconds.items())
+
+        for name, field, help_text in (('cfnstack_api_calls_total', 'calls', 'CloudFormation API calls'),
+                                       ('cfnstack_api_errors_total', 'errors', 'CloudFormation API calls that failed'),
+                                       ('cfnstack_api_retries_total', 'retries', 'Retried CloudFormation API attempts'),
+                                       ('cfnstack_api_throttles_total', 'throttles', 'Throttled CloudFormation API attempts')):
+            lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s counter' % name]
+            for (target, stack, phase, operation), counters in calls:
+                lines.append('%s{%s} %d' % (name, self._labels(action=action, target=target, stack=stack, phase=phase,
+                                                                operation=operation), counters[field]))
+
+        name = 'cfnstack_api_latency_seconds'
+        lines += ['# HELP %s Latency of CloudFormation API calls including retries' % name, '# TYPE %s histogram' % name]
+        for operation, histogram in latency:
+            for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                lines.append('%s_bucket{%s} %d' % (name, self._labels(action=action, operation=operation, le='%g' % bound), count))
+            lines.append('%s_bucket{%s} %d' % (name, self._labels(action=action, operation=operation, le='+Inf'), histogram['count']))
+            lines.append('%s_sum{%s} %.6f' % (name, self._labels(action=action, operation=operation), histogram['sum']))
+            lines.append('%s_count{%s} %d' % (name, self._labels(action=action, operation=operation), histogram['count']))
+
+        name = 'cfnstack_phase_seconds'
+        lines += ['# HELP %s Seconds spent in each phase of the run, summed over threads' % name, '# TYPE %s gauge' % name]
+        for (target, phase), seconds in phase_seconds:
+            lines.append('%s{%s} %.6f' % (name, self._labels(action=action, target=target, phase=phase), seconds))
+
+        for name, help_text, value in (('cfnstack_run_timestamp_seconds', 'Start time of the run', self.started),
+                                       ('cfnstack_run_duration_seconds', 'Duration of the run', time.time() - self.started)):
+            lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s gauge' % name,
+                      '%s{%s} %.3f' % (name, self._labels(action=action), value)]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, action=''):
+        self._write_atomic(path, self.prometheus(action))
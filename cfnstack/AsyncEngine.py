@@ -0,0 +1,190 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cfnstack.StackGlue import CREATE_WAIT_STATUS, UPDATE_WAIT_STATUS, DELETE_WAIT_STATUS
+
+"""
+AsyncEngine runs StackGlue actions on an asyncio event loop as an alternative to the thread per stack executor.
+Every blocking boto3 call becomes an awaitable running on a small bounded thread pool, while stack operations
+are tailed by the StackWatcher thread of the run and waiting for them only sleeps on the event loop. One process can so drive hundreds of
+stack operations at once without an OS thread per stack
+"""
+
+class StackOperationError(Exception):
+    """
+    A stack operation gave up with exit(), the reason is already logged
+    """
+
+
+class AsyncEngine(object):
+
+    ACTIONS = ('apply', 'create', 'update', 'delete', 'listcs')
+
+    def __init__(self, glue, max_parallel=None, api_workers=16):
+        self.logger = logging.getLogger(__name__)
+        self.glue = glue
+        # Stack operations in flight at the same time
+        self.max_parallel = max_parallel or glue.max_parallel
+        # Threads running blocking API calls
+        self.api_workers = api_workers
+        self._executor = None
+        self._slots = None
+        self._failed = False
+
+    def run(self, action, stack_name=None, **options):
+        """
+        Perform action for the selected stacks, exit when any of them failed.
+        options are passed to the action, the listcs writer and summaries_only
+        """
+        if action not in self.ACTIONS:
+            self.logger.critical("Action %s is not supported by the asyncio engine" % action)
+            exit(1)
+        if not asyncio.run(self._run(action, stack_name, options)):
+            exit(1)
+
+    async def _run(self, action, stack_name, options):
+        self._executor = ThreadPoolExecutor(max_workers=self.api_workers, thread_name_prefix=self.glue.target_name)
+        self._slots = asyncio.Semaphore(self.max_parallel)
+        self._failed = False
+        try:
+            if action == 'listcs':
+                return await self._listcs(stack_name, **options)
+            stacks = self.glue._selected_stacks(stack_name)
+            with self.glue._watching():
+                if action == 'delete':
+                    return await self._run_graph(stacks, self._delete, reverse=True)
+                workers = {'apply': self._apply, 'create': self._create, 'update': self._update}
+                return await self._run_graph(stacks, workers[action])
+        finally:
+            self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _guard(func, *args):
+        try:
+            return func(*args)
+        except SystemExit as exception:
+            raise StackOperationError(exception.code)
+
+    async def call(self, func, *args):
+        """
+        Await a blocking call running on the bounded executor
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self._guard, func, *args))
+
+    async def _run_graph(self, stacks, worker, reverse=False):
+        """
+        Run worker for every stack once the stacks it waits for are done.
+        Stacks wait for their dependencies, or for their dependents when reverse is set.
+        After a failure no new stacks are started
+        """
+        loop = asyncio.get_running_loop()
+        names = set(stack.cfn_stack_name for stack in stacks)
+        finished = dict((name, loop.create_future()) for name in names)
+        waits_for = dict((name, []) for name in names)
+        for stack in stacks:
+            for dep in (stack.depends_on or []):
+                if dep in names and dep != stack.cfn_stack_name:
+                    if reverse:
+                        waits_for[dep].append(stack.cfn_stack_name)
+                    else:
+                        waits_for[stack.cfn_stack_name].append(dep)
+
+        async def run_one(stack):
+            name = stack.cfn_stack_name
+            for other in waits_for[name]:
+                await finished[other]
+            ok = False
+            async with self._slots:
+                if not self._failed:
+                    try:
+                        await self._journaled(worker, stack)
+                        ok = True
+                    except StackOperationError:
+                        pass
+                    except Exception as exception:
+                        self.logger.critical("Stack %s failed. Error: %s" % (name, exception))
+            if not ok:
+                self._failed = True
+            finished[name].set_result(ok)
+
+        await asyncio.gather(*(run_one(stack) for stack in stacks))
+        failed = [name for name, future in finished.items() if not future.result()]
+        if failed:
+            self.logger.critical("Stacks failed or not processed: %s" % sorted(failed))
+            return False
+        return True
+
+    async def _journaled(self, worker, stack):
+        """
+        Run worker for a stack, journaling its outcome and skipping stacks a resumed run already completed
+        """
+        if self.glue.journal is None:
+            return await worker(stack)
+        if await self.call(self.glue._journal_skip, stack):
+            return
+        await self.call(self.glue._journal_event, stack, 'started')
+        try:
+            await worker(stack)
+        except Exception:
+            await self.call(self.glue._journal_event, stack, 'failed')
+            raise
+        await self.call(self.glue._journal_event, stack, 'completed')
+
+    async def watch(self, stack, while_status, cursor):
+        """
+        Wait until the StackWatcher of the run sees the status of a stack leave while_status
+        """
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        self.glue.stack_watcher.add(stack.cfn_stack_name, while_status, cursor,
+                                    lambda status: loop.call_soon_threadsafe(finished.set_result, status),
+                                    bool(stack.sns_topic_arn))
+        return await finished
+
+    async def _apply(self, stack):
+        planned_action = self.glue._planned_action(stack)
+        if planned_action == 'noop':
+            self.glue.logger.info("Stack %s is unchanged according to the plan, skipping..." % stack.name)
+        elif planned_action is None and await self.call(self.glue._unchanged_since_last_deploy, stack):
+            pass
+        elif planned_action == 'create' or (planned_action is None and not stack.exists_in_cfn(self.glue.cfn_all_stacks)):
+            await self._create(stack)
+        else:
+            await self._update(stack)
+
+    async def _create(self, stack):
+        cursor = await self.call(self.glue._submit_create, stack)
+        if cursor is not None:
+            status = await self.watch(stack, CREATE_WAIT_STATUS, cursor)
+            await self.call(self.glue._finish_create, stack, status)
+
+    async def _update(self, stack):
+        cursor = await self.call(self.glue._submit_update, stack)
+        if cursor is not None:
+            status = await self.watch(stack, UPDATE_WAIT_STATUS, cursor)
+            await self.call(self.glue._finish_update, stack, status)
+
+    async def _delete(self, stack):
+        cursor = await self.call(self.glue._submit_delete, stack)
+        if cursor is not None:
+            status = await self.watch(stack, DELETE_WAIT_STATUS, cursor)
+            await self.call(self.glue._finish_delete, stack, status)
+
+    async def _listcs(self, stack_name, writer=None, summaries_only=False):
+        """
+        List and describe the change sets of all stacks concurrently, streaming them as NDJSON
+        """
+        lister = self.glue._change_set_lister(writer, summaries_only)
+
+        async def list_stack(stack):
+            summaries = await self.call(lister.summaries, stack)
+            if not summaries_only:
+                await asyncio.gather(*(self.call(lister.describe, stack, summary) for summary in summaries))
+
+        stacks = await self.call(self.glue._listcs_stacks, stack_name)
+        await asyncio.gather(*(list_stack(stack) for stack in stacks))
+        lister.log_summary()
+        return not lister.errors
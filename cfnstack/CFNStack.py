@@ -1,9 +1,13 @@
+import hashlib
 import logging
 import simplejson
 import boto3
 from botocore.exceptions import ClientError
 from copy import deepcopy
 
+from cfnstack.ClientRegistry import ClientRegistry
+from cfnstack.TemplateCache import TEMPLATE_CACHE
+
 """
 CFNStack class provides methods to handle individual cloudformation stacks.
 It reads and parse parameters defined in YAML file stack definition.
@@ -11,9 +15,13 @@ It can evaluate cloudformation templates
 It can check whether dependent stack is available
 It can read parameters(both input and output parameters) from existing stack
 """
+
+# Stack tag holding the hash of the template and parameters of the last deploy
+FINGERPRINT_TAG = 'cfnstack:fingerprint'
+
 class CFNStack(object):
 
-    def __init__(self,stack_glue_name,aws_session,name,environment,params,template_name,region,sns_topic_arn,tags=None,depends_on=None):
+    def __init__(self,stack_glue_name,aws_session,name,environment,params,template_name,region,sns_topic_arn,tags=None,depends_on=None,resolver=None):
         self.logger = logging.getLogger(__name__)
         if stack_glue_name == name:
             self.cfn_stack_name = name
@@ -28,6 +36,10 @@ class CFNStack(object):
         self.params = []
         self.template_name = template_name
         self.template_body = ''
+        # Cached Template object, set by read_template
+        self.template = None
+        # Operation the current action performed on the stack: create, update, delete or noop
+        self.last_operation = None
         self.tags = []
         if depends_on is None:
             self.depends_on = None
@@ -63,35 +75,32 @@ class CFNStack(object):
 
         self.cfn_stacks = {}
         self.cfn_stacks_resources = {}
+        # Shared ReferenceResolver, when not set references are looked up by this stack only
+        self.resolver = resolver
 
     def exists_in_cfn(self,current_cf_stacks):
         """
-        Check if this stack exists in amazon cloudformation
+        Check if this stack exists in amazon cloudformation.
+        current_cf_stacks is the StackIndex snapshot of the account
         """
-
-        for stack in current_cf_stacks:
-            if str(stack.stack_name) == self.cfn_stack_name:
-                return stack
-
-        return False
+        stack = current_cf_stacks.get(self.cfn_stack_name)
+        if stack is None:
+            return False
+        return stack
 
     def dependencies_met(self,current_cf_stacks):
         if self.depends_on is None:
             return True
 
         for dep in self.depends_on:
-            dep_met = False
-            for stack in current_cf_stacks:
-                if str(stack.stack_name) == dep:
-                    dep_met  = True
-            if not dep_met:
+            if dep not in current_cf_stacks:
                 return False
         return True
 
     def populate_params(self,current_cf_stacks):
 
+        self.params = []
         if self.yaml_params is None:
-            self.params = []
             return True
 
         if self.dependencies_met(current_cf_stacks):
@@ -117,14 +126,32 @@ class CFNStack(object):
         else:
             return False
 
+    def _source_stack_name(self, source):
+        if source == self.stack_glue_name:
+            return source
+        return "%s-%s-%s" % (self.stack_glue_name,self.environment,source)
+
+    def references(self):
+        """
+        List (source stack, type, variable) of every parameter referring to another stack
+        """
+        refs = []
+        if type(self.yaml_params) is not dict:
+            return refs
+        for param_val in self.yaml_params.values():
+            if type(param_val) is dict and 'value' not in param_val \
+                    and 'source' in param_val and 'type' in param_val and 'variable' in param_val:
+                refs.append((self._source_stack_name(param_val['source']), param_val['type'], param_val['variable']))
+        return refs
+
     def _parse_param(self, param_name, param_dict):
         if 'value' in param_dict :
             return str(param_dict['value'])
         elif ('source' in param_dict and 'type' in param_dict and 'variable' in param_dict):
-            if param_dict['source'] == self.stack_glue_name:
-                source_stack = param_dict['source']
-            else:
-                source_stack =  ("%s-%s-%s" % (self.stack_glue_name,self.environment,param_dict['source']))
+            source_stack = self._source_stack_name(param_dict['source'])
+
+            if self.resolver is not None:
+                return self.resolver.resolve(self.aws_session, source_stack, param_dict['type'], param_dict['variable'])
 
             return self.get_value_from_cf(
                 source_stack=source_stack,
@@ -139,7 +166,7 @@ class CFNStack(object):
         if not resources:
             if stack not in self.cfn_stacks:
                 try:
-                    cloudformation = self.aws_session.resource("cloudformation")
+                    cloudformation = ClientRegistry.for_session(self.aws_session).resource("cloudformation")
                     self.cfn_stacks[stack] = cloudformation.Stack(stack)
                 except ClientError as exception:
                     self.logger.critical("Client ERROR: %s" % exception)
@@ -178,15 +205,15 @@ class CFNStack(object):
 
     def read_template(self):
         """
-        Open and parse the json template for this stack
+        Open and parse the json template for this stack.
+        Templates are parsed once per process and sent in compact form
         """
         try:
-            template_file = open(self.template_name,'r')
-            template = simplejson.load(template_file)
+            self.template = TEMPLATE_CACHE.load(self.template_name)
         except Exception as exception:
             self.logger.critical("Cannot parse %s template for stack %s. Error %s", self.template_name,self.name,exception)
             exit(1)
-        self.template_body = simplejson.dumps(template, sort_keys=True,indent=2,separators=(',',':'),)
+        self.template_body = self.template.body
         return True
 
     def get_params_tuples(self):
@@ -199,16 +226,57 @@ class CFNStack(object):
                 tuple_list.append((param,self.params[param]))
         return tuple_list
 
+    def fingerprint(self):
+        """
+        SHA-256 of the canonical template and parameters of this stack.
+        read_template and populate_params must be called first
+        """
+        params = sorted((str(param['ParameterKey']), str(param.get('ParameterValue')), bool(param.get('UsePreviousValue', False)))
+                        for param in self.params)
+        canonical = simplejson.dumps({'template': self.template.sha256, 'parameters': params},
+                                     sort_keys=True, separators=(',',':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def inputs_hash(self):
+        """
+        SHA-256 of the local definition of this stack: template, YAML parameters, tags and notification topics.
+        Computed without API calls, a deploy plan is out of date when it changes
+        """
+        self.read_template()
+        canonical = simplejson.dumps({'template': self.template.sha256, 'params': self.yaml_params,
+                                      'tags': self.tags, 'sns': self.sns_topic_arn, 'depends': self.depends_on},
+                                     sort_keys=True, separators=(',',':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def deploy_tags(self):
+        """
+        Tags to send with create/update calls, stack tags plus the deploy fingerprint
+        """
+        tags = [tag for tag in self.tags if tag['Key'] != FINGERPRINT_TAG]
+        tags.append({'Key': FINGERPRINT_TAG, 'Value': self.fingerprint()})
+        return tags
+
+    def deployed_fingerprint(self, cf_stack):
+        for tag in (cf_stack.tags or []):
+            if tag['Key'] == FINGERPRINT_TAG:
+                return tag['Value']
+        return None
+
     def template_uptodate(self,current_cf_stacks):
         """
         Check if stack is up to date with cloudformation.
-        Return true if template matches what's in cloudformatio,false if not
+        Return true if template matches what's in cloudformatio,false if not.
+        When the deployed fingerprint tag matches, the deployed template is not downloaded
         """
         cf_stack = self.exists_in_cfn(current_cf_stacks)
         if cf_stack:
-            cf_client = self.aws_session.client('cloudformation')
+            deployed_fingerprint = self.deployed_fingerprint(cf_stack)
+            if deployed_fingerprint is not None and deployed_fingerprint == self.fingerprint():
+                self.logger.debug("Fingerprint of stack %s matches the deployed stack", self.name)
+                return True
+            cf_client = ClientRegistry.for_session(self.aws_session).client('cloudformation')
             cf_temp_dict = cf_client.get_template(StackName=self.cfn_stack_name)['TemplateBody']
-            cf_stack_temp_dict = simplejson.loads(self.template_body)
+            cf_stack_temp_dict = self.template.parsed
             #cf_temp_dict = simplejson.loads(cf_temp_body)
             if cf_temp_dict == cf_stack_temp_dict:
                 return True
@@ -0,0 +1,126 @@
+import datetime
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import simplejson
+from botocore.exceptions import ClientError
+
+"""
+ChangeSetLister streams the change sets of stacks as NDJSON, one JSON object per line.
+All pages of ListChangeSets and DescribeChangeSet are read, change sets are described concurrently
+and every page of changes is written as soon as it arrives, so nothing is held in memory
+until the end. Records carry a type field:
+change_set - summary of a change set, description - the change set without its changes,
+change - one change of a change set, error - a stack or change set that could not be read
+"""
+
+
+def json_default(obj):
+    if isinstance(obj, datetime.datetime) or isinstance(obj, datetime.date):
+        return obj.isoformat()
+    return None
+
+
+class NdjsonWriter(object):
+    """
+    Thread safe NDJSON output shared by all listers of a run
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = simplejson.dumps(record, default=json_default) + '\n'
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+class ChangeSetLister(object):
+
+    def __init__(self, cf_client, writer, target='', summaries_only=False, scope=None):
+        self.logger = logging.getLogger(__name__)
+        self.cf_client = cf_client
+        self.writer = writer
+        self.target = target
+        self.summaries_only = summaries_only
+        # Callable returning a context manager that attributes API calls to a stack, see ApiMetrics.scope
+        self.scope = scope
+        self.change_sets = 0
+        self.changes = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _scope(self, stack):
+        return self.scope(stack.cfn_stack_name, 'changeset')
+
+    def _error(self, stack, message, change_set=None):
+        with self._lock:
+            self.errors += 1
+        self.logger.error("Can't read change sets of stack %s: %s", stack.cfn_stack_name, message)
+        self.writer.write({'type': 'error', 'target': self.target, 'stack': stack.name, 'change_set': change_set,
+                           'error': message})
+
+    def summaries(self, stack):
+        """
+        Write and return the summaries of all change sets of a stack
+        """
+        summaries = []
+        try:
+            with self._scope(stack):
+                for page in self.cf_client.get_paginator('list_change_sets').paginate(StackName=stack.cfn_stack_name):
+                    for summary in page['Summaries']:
+                        self.writer.write({'type': 'change_set', 'target': self.target, 'stack': stack.name, 'change_set': summary})
+                        summaries.append(summary)
+        except ClientError as exception:
+            self._error(stack, str(exception))
+        with self._lock:
+            self.change_sets += len(summaries)
+        return summaries
+
+    def describe(self, stack, summary):
+        """
+        Write the description of a change set followed by its changes, one page at a time
+        """
+        name = summary['ChangeSetName']
+        changes = 0
+        try:
+            with self._scope(stack):
+                # The change set ARN identifies it without the stack name
+                pages = self.cf_client.get_paginator('describe_change_set').paginate(ChangeSetName=summary['ChangeSetId'])
+                for page_number, page in enumerate(pages):
+                    if page_number == 0:
+                        description = dict((key, value) for key, value in page.items()
+                                           if key not in ('Changes', 'NextToken', 'ResponseMetadata'))
+                        self.writer.write({'type': 'description', 'target': self.target, 'stack': stack.name,
+                                           'change_set': description})
+                    for change in page.get('Changes', []):
+                        self.writer.write({'type': 'change', 'target': self.target, 'stack': stack.name,
+                                           'change_set': name, 'change': change})
+                        changes += 1
+        except ClientError as exception:
+            self._error(stack, str(exception), name)
+        with self._lock:
+            self.changes += changes
+
+    def run(self, stacks, max_parallel=1):
+        """
+        List the change sets of all stacks and describe them on max_parallel threads.
+        Return True when every stack and change set could be read
+        """
+        with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as pool:
+            listings = dict((pool.submit(self.summaries, stack), stack) for stack in stacks)
+            describes = []
+            for future in as_completed(listings):
+                if not self.summaries_only:
+                    describes += [pool.submit(self.describe, listings[future], summary) for summary in future.result()]
+            for future in describes:
+                future.result()
+        self.log_summary()
+        return not self.errors
+
+    def log_summary(self):
+        self.logger.info("Listed %s change sets with %s changes, %s errors", self.change_sets, self.changes, self.errors)
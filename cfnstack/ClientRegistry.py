@@ -0,0 +1,98 @@
+import logging
+import threading
+import weakref
+
+from botocore.config import Config
+
+"""
+ClientRegistry hands out one pooled client and resource per AWS service for a boto3 session.
+Creating clients repeats botocore model loading and opens a new connection pool, so StackGlue,
+CFNStack and ReferenceResolver get them from the registry of their session instead.
+Clients are thread safe and can be shared by worker threads, resources are kept per session.
+The registry counts client reuse and the connections opened by its connection pools
+"""
+
+class ClientRegistry(object):
+
+    # boto3 session -> ClientRegistry
+    _registries = weakref.WeakKeyDictionary()
+    _registries_lock = threading.Lock()
+
+    def __init__(self, aws_session, max_pool_connections=10):
+        self.logger = logging.getLogger(__name__)
+        # The registry is the value of a weak key dictionary keyed by the session, a strong
+        # reference would keep every session and its loaded service models alive
+        self._aws_session = weakref.ref(aws_session)
+        self.config = Config(max_pool_connections=max_pool_connections)
+        self._clients = {}
+        self._resources = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    @property
+    def aws_session(self):
+        return self._aws_session()
+
+    @classmethod
+    def for_session(cls, aws_session, max_pool_connections=10):
+        """
+        Return the registry of aws_session, creating it on first use
+        """
+        with cls._registries_lock:
+            registry = cls._registries.get(aws_session)
+            if registry is None:
+                registry = cls(aws_session, max_pool_connections)
+                cls._registries[aws_session] = registry
+            return registry
+
+    def resource(self, service):
+        with self._lock:
+            if service in self._resources:
+                self.reused += 1
+                return self._resources[service]
+            # Sessions are not thread safe, clients and resources are created under the lock
+            resource = self.aws_session.resource(service, config=self.config)
+            self.created += 1
+            self._resources[service] = resource
+            # The resource brings its own client, reuse it for client calls
+            self._clients.setdefault(service, resource.meta.client)
+            return resource
+
+    def client(self, service):
+        with self._lock:
+            if service in self._clients:
+                self.reused += 1
+                return self._clients[service]
+            client = self.aws_session.client(service, config=self.config)
+            self.created += 1
+            self._clients[service] = client
+            return client
+
+    @staticmethod
+    def _pool_stats(client):
+        """
+        Connections opened and requests sent by the urllib3 pools of a client
+        """
+        connections = 0
+        requests = 0
+        try:
+            pools = client._endpoint.http_session._manager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                connections += pool.num_connections
+                requests += pool.num_requests
+        except (AttributeError, KeyError):
+            pass
+        return connections, requests
+
+    def metrics(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            metrics = {'clients_created': self.created, 'clients_reused': self.reused,
+                       'connections_opened': 0, 'requests_sent': 0}
+        for client in clients:
+            connections, requests = self._pool_stats(client)
+            metrics['connections_opened'] += connections
+            metrics['requests_sent'] += requests
+        return metrics
@@ -0,0 +1,157 @@
+import datetime
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+import pystache
+import simplejson
+import yaml
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+"""
+ConfigLoader renders the YAML stack definition with mustache and parses it.
+Parsed configs are cached on disk as JSON, keyed by the hash of the YAML file and of the names and
+values of the environment variables it uses, so unchanged configs skip both rendering and parsing.
+Rendered environment values like passwords must not end up on disk: a config is cached only when
+every variable resolving in it is listed as cacheable (CFNSTACK_CACHE_VARIABLES), cache files are
+readable by their owner only. The C YAML loader is used when PyYAML was built with libyaml
+"""
+
+# Bump when the cached format changes
+CACHE_VERSION = 2
+
+# {{name}}, {{{name}}}, {{&name}}, {{#name}}, {{^name}} and {{/name}} tags
+MUSTACHE_TAG = re.compile(r'\{\{\{?\s*([#^/&]?)\s*([^\s{}!>=]+)\s*\}?\}\}')
+# Tags changing the mustache delimiters, variables can't be found by MUSTACHE_TAG then
+MUSTACHE_DELIMITER = re.compile(r'\{\{\s*=')
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    raise TypeError("Can't cache value of type %s" % type(value).__name__)
+
+
+def _decode_value(obj):
+    if len(obj) == 1:
+        if '__datetime__' in obj:
+            return datetime.datetime.fromisoformat(obj['__datetime__'])
+        if '__date__' in obj:
+            return datetime.date.fromisoformat(obj['__date__'])
+    return obj
+
+
+class ConfigLoader(object):
+
+    def __init__(self, cache_dir=None, max_entries=32, cache_variables=None):
+        self.logger = logging.getLogger(__name__)
+        if cache_dir is None:
+            cache_dir = os.environ.get('CFNSTACK_CACHE_DIR',
+                                       os.path.join(os.path.expanduser('~'), '.cache', 'cfnstack'))
+        # Empty cache_dir disables the cache
+        self.cache_dir = cache_dir
+        # Oldest cached configs are removed above this count
+        self.max_entries = max_entries
+        # Environment variables whose values may be written to the cache, like paths and revisions
+        if cache_variables is None:
+            cache_variables = os.environ.get('CFNSTACK_CACHE_VARIABLES', '').split(',')
+        self.cache_variables = set(name.strip() for name in cache_variables if name.strip())
+
+    @staticmethod
+    def template_variables(text):
+        """
+        Names of the environment variables used by the YAML file, None when they can't be determined
+        """
+        if MUSTACHE_DELIMITER.search(text):
+            return None
+        return sorted(set(match.group(2).split('.')[0] for match in MUSTACHE_TAG.finditer(text)))
+
+    def _cache_path(self, raw, variables, context):
+        key = hashlib.sha256()
+        key.update(("%s\0%s\0" % (CACHE_VERSION, YamlLoader.__name__)).encode('utf-8'))
+        key.update(raw)
+        key.update(b'\0')
+        key.update(simplejson.dumps([variables, sorted(context.items())]).encode('utf-8'))
+        return os.path.join(self.cache_dir, 'config-%s.json' % key.hexdigest())
+
+    def _read_cache(self, cache_path):
+        try:
+            with open(cache_path) as cache_file:
+                return simplejson.load(cache_file, object_hook=_decode_value)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_cache(self, cache_path, config):
+        try:
+            text = simplejson.dumps(config, default=_encode_value)
+        except TypeError as exception:
+            self.logger.debug("Not caching config: %s", exception)
+            return
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.config-')
+            os.chmod(tmp_path, 0o600)
+            with os.fdopen(handle, 'w') as cache_file:
+                cache_file.write(text)
+            os.replace(tmp_path, cache_path)
+            self._prune()
+        except (IOError, OSError) as exception:
+            self.logger.debug("Could not write config cache %s: %s", cache_path, exception)
+
+    def _prune(self):
+        names = os.listdir(self.cache_dir)
+        # Pickled configs of earlier versions may hold rendered environment values, remove them
+        for name in names:
+            if name.startswith('config-') and name.endswith('.pickle'):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        entries = [os.path.join(self.cache_dir, name) for name in names
+                   if name.startswith('config-') and name.endswith('.json')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def load(self, yamlfile):
+        """
+        Return the parsed stack definition of yamlfile
+        """
+        with open(yamlfile, 'rb') as yamlconfig:
+            raw = yamlconfig.read()
+        text = raw.decode('utf-8')
+
+        variables = self.template_variables(text)
+        if variables is None:
+            context = dict(os.environ)
+        else:
+            context = dict((name, os.environ[name]) for name in variables if name in os.environ)
+
+        cache_path = None
+        # Only configs whose rendered environment values are all cacheable are cached
+        if self.cache_dir and variables is not None and set(context) <= self.cache_variables:
+            cache_path = self._cache_path(raw, variables, context)
+            config = self._read_cache(cache_path)
+            if config is not None:
+                self.logger.debug("Loaded %s from config cache %s", yamlfile, cache_path)
+                return config
+
+        render_yaml = pystache.render(text, context)
+        config = yaml.load(render_yaml, Loader=YamlLoader)
+
+        if cache_path is not None:
+            self._write_cache(cache_path, config)
+        return config
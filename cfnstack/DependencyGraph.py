@@ -0,0 +1,136 @@
+import heapq
+import logging
+
+"""
+DependencyGraph orders CFNStack objects by the dependencies listed in the YAML file.
+Sorting uses Kahn's algorithm with indegree maps, linear in stacks plus dependencies.
+Stacks that are ready at the same time keep the order they are declared in the YAML file.
+Failures report the exact cycle or the missing dependency
+"""
+
+class DependencyError(Exception):
+
+    def __init__(self, message, cycle=None, missing=None):
+        super(DependencyError, self).__init__(message)
+        # Stack names forming a cycle, first name repeated at the end
+        self.cycle = cycle
+        # stack name -> dependencies not defined in the YAML file
+        self.missing = missing
+
+
+class DependencyGraph(object):
+
+    def __init__(self, stack_objs, external=()):
+        """
+        external lists stack names defined in the YAML file but left out of stack_objs,
+        dependencies on them are treated as met
+        """
+        self.logger = logging.getLogger(__name__)
+        external = set(external)
+        self.stacks = {}
+        self.position = {}
+        self.deps = {}
+        for index, stack in enumerate(stack_objs):
+            self.stacks[stack.cfn_stack_name] = stack
+            self.position[stack.cfn_stack_name] = index
+            deps = []
+            for dep in (stack.depends_on or []):
+                if dep not in deps and dep not in external:
+                    deps.append(dep)
+            self.deps[stack.cfn_stack_name] = deps
+
+        self.dependents = dict((name, []) for name in self.stacks)
+        for name, deps in self.deps.items():
+            for dep in deps:
+                if dep in self.dependents:
+                    self.dependents[dep].append(name)
+
+    def missing_dependencies(self):
+        missing = {}
+        for name, deps in self.deps.items():
+            not_found = [dep for dep in deps if dep not in self.stacks]
+            if not_found:
+                missing[name] = not_found
+        return missing
+
+    def _check_missing(self):
+        missing = self.missing_dependencies()
+        if missing:
+            details = "; ".join("%s depends on %s" % (name, ", ".join(deps)) for name, deps in sorted(missing.items()))
+            raise DependencyError("Dependency on stack not in yaml file or disabled: %s" % details, missing=missing)
+
+    def find_cycle(self, names):
+        """
+        Return one cycle among names as a list of stack names, first name repeated at the end
+        """
+        names = set(names)
+        state = {}
+        for start in sorted(names, key=lambda name: self.position[name]):
+            if start in state:
+                continue
+            path = [start]
+            on_path = {start: 0}
+            iters = [iter(self.deps[start])]
+            state[start] = 'visiting'
+            while iters:
+                for dep in iters[-1]:
+                    if dep not in names:
+                        continue
+                    if dep in on_path:
+                        return path[on_path[dep]:] + [dep]
+                    if dep not in state:
+                        state[dep] = 'visiting'
+                        on_path[dep] = len(path)
+                        path.append(dep)
+                        iters.append(iter(self.deps[dep]))
+                        break
+                else:
+                    done = path.pop()
+                    del on_path[done]
+                    state[done] = 'done'
+                    iters.pop()
+        return None
+
+    def _indegrees(self):
+        return dict((name, len(deps)) for name, deps in self.deps.items())
+
+    def topological_order(self):
+        """
+        Return the CFNStack objects in dependency order or raise DependencyError
+        """
+        self._check_missing()
+        indegree = self._indegrees()
+        ready = [(self.position[name], name) for name, count in indegree.items() if count == 0]
+        heapq.heapify(ready)
+
+        ordered = []
+        while ready:
+            _, name = heapq.heappop(ready)
+            ordered.append(self.stacks[name])
+            for child in self.dependents[name]:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    heapq.heappush(ready, (self.position[child], child))
+
+        if len(ordered) != len(self.stacks):
+            remaining = [name for name, count in indegree.items() if count > 0]
+            cycle = self.find_cycle(remaining)
+            raise DependencyError("Circular dependency: %s" % " -> ".join(cycle), cycle=cycle)
+        return ordered
+
+    def levels(self):
+        """
+        Group stacks in topological levels. Stacks of one level only depend on stacks of earlier levels
+        """
+        level_of = {}
+        levels = []
+        for stack in self.topological_order():
+            name = stack.cfn_stack_name
+            level = 0
+            for dep in self.deps[name]:
+                level = max(level, level_of[dep] + 1)
+            level_of[name] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(stack)
+        return levels
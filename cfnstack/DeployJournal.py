@@ -0,0 +1,109 @@
+import datetime
+import logging
+import os
+import threading
+import uuid
+
+import simplejson
+
+"""
+DeployJournal is an append-only log of apply, update and delete runs, one JSON record per line.
+A run record opens every run, then each stack gets a started record and a completed record with
+the operation performed, its parameter keys and deploy fingerprint, or a failed record. Parameter
+values are never recorded and the journal is created readable by its owner only. Every record is
+flushed and fsync'd before the run goes on, so the journal survives a crash of cfnstack or of the machine.
+--resume continues the last run of the journal: stacks it completed are skipped without any check
+"""
+
+
+class JournalError(Exception):
+    """
+    Journal can't be read or its last run doesn't match the run to resume
+    """
+
+
+class DeployJournal(object):
+
+    def __init__(self, path, run_id, completed=None):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.run_id = run_id
+        # (target name, cfn stack name) of the stacks completed by this run, including earlier attempts
+        self.completed = completed or set()
+        self._lock = threading.Lock()
+        self._file = os.fdopen(os.open(path, os.O_CREAT | os.O_APPEND | os.O_WRONLY, 0o600), 'a')
+
+    @classmethod
+    def start(cls, path, action, yamlfile, selector=None):
+        """
+        Open the journal at path and append the record of a new run
+        """
+        try:
+            journal = cls(path, uuid.uuid4().hex)
+        except (IOError, OSError) as exception:
+            raise JournalError("Can't open journal %s: %s" % (path, exception))
+        journal.record(event='run', action=action, yamlfile=os.path.abspath(yamlfile), selector=selector)
+        return journal
+
+    @classmethod
+    def resume(cls, path, action, yamlfile):
+        """
+        Continue the last run of the journal at path, which must be a run of the same action and YAML file
+        """
+        logger = logging.getLogger(__name__)
+        run = None
+        completed = set()
+        try:
+            with open(path) as journal_file:
+                for number, line in enumerate(journal_file, 1):
+                    try:
+                        entry = simplejson.loads(line)
+                    except ValueError:
+                        # A crash can leave the last record half written
+                        logger.warning("Ignoring unreadable record on line %s of journal %s", number, path)
+                        continue
+                    if entry.get('event') == 'run':
+                        run = entry
+                        completed = set()
+                    elif run is not None and entry.get('run') == run['run']:
+                        key = (entry.get('target'), entry.get('stack'))
+                        if entry.get('event') == 'completed':
+                            completed.add(key)
+                        elif entry.get('event') in ('started', 'failed'):
+                            completed.discard(key)
+        except (IOError, OSError) as exception:
+            raise JournalError("Can't read journal %s to resume: %s" % (path, exception))
+
+        if run is None:
+            raise JournalError("Journal %s has no run to resume" % path)
+        if run.get('action') != action or run.get('yamlfile') != os.path.abspath(yamlfile):
+            raise JournalError("Last run in journal %s is %s of %s, can't resume it with %s of %s"
+                               % (path, run.get('action'), run.get('yamlfile'), action, os.path.abspath(yamlfile)))
+        try:
+            journal = cls(path, run['run'], completed)
+        except (IOError, OSError) as exception:
+            raise JournalError("Can't open journal %s: %s" % (path, exception))
+        journal.record(event='resume', completed=len(completed))
+        logger.info("Resuming run %s of journal %s, %s stacks already completed", run['run'], path, len(completed))
+        return journal
+
+    def record(self, **fields):
+        """
+        Append one record and fsync it
+        """
+        fields.update(run=self.run_id, time=datetime.datetime.utcnow().isoformat())
+        line = simplejson.dumps(fields, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if fields.get('event') == 'completed':
+                self.completed.add((fields.get('target'), fields.get('stack')))
+
+    def is_completed(self, target_name, stack_name):
+        with self._lock:
+            return (target_name, stack_name) in self.completed
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,76 @@
+import datetime
+import logging
+import os
+import tempfile
+import threading
+
+import simplejson
+
+"""
+DeployPlan holds the outcome of the plan action: for every stack of every target whether apply
+has to create it, update it or can leave it alone (noop), with the fingerprints the decision was based on.
+apply --plan reads the file back and only calls cloudformation for stacks that change
+"""
+
+# Bump when the plan file format changes
+PLAN_VERSION = 1
+
+PLAN_ACTIONS = ('create', 'update', 'noop')
+
+
+class PlanError(Exception):
+    """
+    Plan file can't be read or doesn't match the project
+    """
+
+
+class DeployPlan(object):
+
+    def __init__(self, yamlfile=None, targets=None, created=None):
+        self.logger = logging.getLogger(__name__)
+        self.yamlfile = yamlfile
+        # target name -> cfn stack name -> plan entry
+        self.targets = targets or {}
+        self.created = created or datetime.datetime.utcnow().isoformat()
+        self._lock = threading.Lock()
+
+    def add_target(self, target_name, entries):
+        with self._lock:
+            self.targets[target_name] = entries
+
+    def target(self, target_name):
+        """
+        Plan entries of a target, PlanError when the plan doesn't cover it
+        """
+        if target_name not in self.targets:
+            raise PlanError("Plan has no entries for target %s, planned targets are %s" % (target_name, sorted(self.targets)))
+        return self.targets[target_name]
+
+    def counts(self):
+        counts = dict((action, 0) for action in PLAN_ACTIONS)
+        for entries in self.targets.values():
+            for entry in entries.values():
+                counts[entry['action']] += 1
+        return counts
+
+    def save(self, path):
+        """
+        Write the plan atomically
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.cfnstack-plan-')
+        with os.fdopen(handle, 'w') as plan_file:
+            simplejson.dump({'version': PLAN_VERSION, 'created': self.created, 'yamlfile': self.yamlfile,
+                             'targets': self.targets}, plan_file, indent=4, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as plan_file:
+                data = simplejson.load(plan_file)
+        except (IOError, OSError, ValueError) as exception:
+            raise PlanError("Can't read plan file %s: %s" % (path, exception))
+        if data.get('version') != PLAN_VERSION:
+            raise PlanError("Plan file %s has version %s, expected %s" % (path, data.get('version'), PLAN_VERSION))
+        return cls(data.get('yamlfile'), data.get('targets'), data.get('created'))
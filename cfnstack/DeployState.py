@@ -0,0 +1,74 @@
+import logging
+import os
+import tempfile
+import threading
+
+import simplejson
+
+"""
+DeployState is the local state file of incremental deploys. For every stack cfnstack deployed or
+found up to date it records the hash of the local definition (inputs), the fingerprint of the
+template and resolved parameters, the last update time and fingerprint tag of the stack in
+cloudformation (version) and the versions of the stacks it takes values from (upstream). apply skips a stack when none of
+these changed, without resolving parameters or downloading templates
+"""
+
+# Bump when the state file format changes
+STATE_VERSION = 1
+
+
+class DeployState(object):
+
+    def __init__(self, path, targets=None):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        # target name -> cfn stack name -> state entry
+        self.targets = targets or {}
+        self._lock = threading.Lock()
+
+    def entry(self, target_name, stack_name):
+        with self._lock:
+            return self.targets.get(target_name, {}).get(stack_name)
+
+    def record(self, target_name, stack_name, entry):
+        with self._lock:
+            self.targets.setdefault(target_name, {})[stack_name] = entry
+
+    def forget(self, target_name, stack_name):
+        with self._lock:
+            self.targets.get(target_name, {}).pop(stack_name, None)
+
+    def save(self):
+        """
+        Write the state atomically
+        """
+        with self._lock:
+            data = {'version': STATE_VERSION, 'targets': self.targets}
+            text = simplejson.dumps(data, indent=4, sort_keys=True)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.cfnstack-state-')
+        with os.fdopen(handle, 'w') as state_file:
+            state_file.write(text)
+        os.replace(tmp_path, self.path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read the state file, a missing or unreadable file starts an empty state and every stack is examined
+        """
+        logger = logging.getLogger(__name__)
+        try:
+            with open(path) as state_file:
+                data = simplejson.load(state_file)
+        except (IOError, OSError) as exception:
+            if os.path.exists(path):
+                logger.warning("Can't read state file %s, examining every stack: %s", path, exception)
+            return cls(path)
+        except ValueError as exception:
+            logger.warning("Can't parse state file %s, examining every stack: %s", path, exception)
+            return cls(path)
+        if data.get('version') != STATE_VERSION:
+            logger.warning("State file %s has version %s, expected %s, examining every stack",
+                           path, data.get('version'), STATE_VERSION)
+            return cls(path)
+        return cls(path, data.get('targets'))
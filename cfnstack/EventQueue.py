@@ -0,0 +1,140 @@
+import datetime
+import logging
+import re
+import uuid
+
+import simplejson
+from botocore.exceptions import ClientError
+
+"""
+EventQueue receives the stack events cloudformation publishes to the SNS topics of the stacks
+(sns-topic-arn, passed as NotificationARNs). open() creates a temporary SQS queue and subscribes it
+to the topics, receive() long-polls the queue and turns every CloudFormation notification into an
+event shaped like the StackEvents of DescribeStackEvents, close() unsubscribes and deletes the queue.
+SNS and SQS endpoints follow the boto3 configuration, AWS_ENDPOINT_URL_SNS and AWS_ENDPOINT_URL_SQS
+point them at a local stand-in
+"""
+
+# One Key='Value' line of a CloudFormation notification, values like ResourceProperties may span lines
+NOTIFICATION_FIELD = re.compile(r"^(\w+)='(.*?)'$(?=\n\w+='|\s*\Z)", re.MULTILINE | re.DOTALL)
+
+
+def parse_notification(message):
+    """
+    Event of a CloudFormation notification message, None when the message is not one
+    """
+    fields = dict(NOTIFICATION_FIELD.findall(message))
+    if 'EventId' not in fields or 'StackName' not in fields or 'ResourceStatus' not in fields:
+        return None
+    for key, value in list(fields.items()):
+        if value in ('null', 'None'):
+            fields[key] = None
+    timestamp = None
+    for timestamp_format in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            timestamp = datetime.datetime.strptime(fields.get('Timestamp') or '', timestamp_format)
+            break
+        except ValueError:
+            continue
+    if timestamp is None:
+        timestamp = datetime.datetime.utcnow()
+    return {
+        'EventId': fields['EventId'],
+        'StackId': fields.get('StackId'),
+        'StackName': fields['StackName'],
+        'LogicalResourceId': fields.get('LogicalResourceId'),
+        'PhysicalResourceId': fields.get('PhysicalResourceId'),
+        'ResourceType': fields.get('ResourceType'),
+        'ResourceStatus': fields['ResourceStatus'],
+        'ResourceStatusReason': fields.get('ResourceStatusReason'),
+        'Timestamp': timestamp.replace(tzinfo=datetime.timezone.utc),
+    }
+
+
+class EventQueue(object):
+
+    def __init__(self, sns_client, sqs_client, topic_arns, name=None):
+        self.logger = logging.getLogger(__name__)
+        self.sns_client = sns_client
+        self.sqs_client = sqs_client
+        self.topic_arns = sorted(set(topic_arns))
+        self.name = name or 'cfnstack-events-%s' % uuid.uuid4().hex[:12]
+        self.queue_url = None
+        self.subscriptions = []
+        self.messages = 0
+
+    def _policy(self, queue_arn):
+        return simplejson.dumps({
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Effect': 'Allow',
+                'Principal': {'Service': 'sns.amazonaws.com'},
+                'Action': 'sqs:SendMessage',
+                'Resource': queue_arn,
+                'Condition': {'ArnEquals': {'aws:SourceArn': self.topic_arns}},
+            }],
+        })
+
+    def open(self):
+        """
+        Create the queue and subscribe it to the topics. ClientError is raised when that fails,
+        whatever was created is removed again
+        """
+        try:
+            self.queue_url = self.sqs_client.create_queue(QueueName=self.name, Attributes={
+                'MessageRetentionPeriod': '3600'})['QueueUrl']
+            queue_arn = self.sqs_client.get_queue_attributes(
+                QueueUrl=self.queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+            self.sqs_client.set_queue_attributes(QueueUrl=self.queue_url, Attributes={'Policy': self._policy(queue_arn)})
+            for topic_arn in self.topic_arns:
+                subscription = self.sns_client.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn,
+                                                         ReturnSubscriptionArn=True)
+                self.subscriptions.append(subscription['SubscriptionArn'])
+        except ClientError:
+            self.close()
+            raise
+        self.logger.info("Receiving stack events of topics %s through queue %s", ", ".join(self.topic_arns), self.name)
+
+    def receive(self, wait_seconds=10):
+        """
+        Long-poll the queue once and return the events of the CloudFormation notifications received
+        """
+        response = self.sqs_client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10,
+                                                   WaitTimeSeconds=wait_seconds)
+        messages = response.get('Messages', [])
+        if not messages:
+            return []
+        self.sqs_client.delete_message_batch(QueueUrl=self.queue_url, Entries=[
+            {'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']} for index, message in enumerate(messages)])
+        self.messages += len(messages)
+
+        events = []
+        for message in messages:
+            try:
+                body = simplejson.loads(message['Body'])
+            except ValueError:
+                self.logger.debug("Ignoring message %s, not an SNS notification", message.get('MessageId'))
+                continue
+            event = parse_notification(body.get('Message', '')) if type(body) is dict else None
+            if event is None:
+                self.logger.debug("Ignoring message %s, not a CloudFormation notification", message.get('MessageId'))
+                continue
+            events.append(event)
+        return events
+
+    def close(self):
+        """
+        Unsubscribe from the topics and delete the queue, errors are only logged
+        """
+        for subscription in self.subscriptions:
+            try:
+                self.sns_client.unsubscribe(SubscriptionArn=subscription)
+            except ClientError as exception:
+                self.logger.warning("Could not unsubscribe %s. Error: %s", subscription, exception)
+        self.subscriptions = []
+        if self.queue_url is not None:
+            try:
+                self.sqs_client.delete_queue(QueueUrl=self.queue_url)
+            except ClientError as exception:
+                self.logger.warning("Could not delete queue %s. Error: %s", self.queue_url, exception)
+            self.queue_url = None
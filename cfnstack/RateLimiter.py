@@ -0,0 +1,122 @@
+import logging
+import random
+import threading
+import time
+
+"""
+RateLimiter is a token bucket shared by every cloudformation call made through the boto3 sessions it is registered on.
+It hooks into botocore events, so callers don't need to wrap their API calls.
+Throttling errors halve the request rate and are retried with jittered exponential backoff,
+successful calls slowly raise the rate back to the configured maximum.
+PollInterval provides adaptive wait times for polling long running stack operations
+"""
+
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate=4.0, burst=8, min_rate=0.5, max_attempts=8, base_delay=0.5, max_delay=30.0):
+        self.logger = logging.getLogger(__name__)
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.throttle_count = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def register(self, aws_session):
+        """
+        Attach the limiter to all cloudformation calls of a boto3 session.
+        Must be called before clients or resources are created from the session
+        """
+        events = aws_session.events
+        events.register('before-call.cloudformation', self._before_call, unique_id='cfnstack-rate-limit')
+        events.register('after-call.cloudformation', self._after_call, unique_id='cfnstack-rate-recover')
+        events.register_first('needs-retry.cloudformation', self._needs_retry, unique_id='cfnstack-rate-retry')
+        return aws_session
+
+    def acquire(self):
+        """
+        Block until a token is available
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+    def throttled(self):
+        with self._lock:
+            self.throttle_count += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+        self.logger.warning("API calls are throttled, lowering request rate to %.2f calls/sec", self.rate)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def backoff_delay(self, attempts):
+        """
+        Full jitter exponential backoff
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempts)))
+
+    def _before_call(self, **kwargs):
+        self.acquire()
+
+    def _after_call(self, parsed=None, **kwargs):
+        if parsed is not None and 'Error' not in parsed:
+            self.succeeded()
+
+    def _needs_retry(self, response=None, attempts=None, operation=None, **kwargs):
+        if response is None:
+            return None
+        error_code = response[1].get('Error', {}).get('Code')
+        if error_code not in THROTTLING_ERROR_CODES:
+            return None
+
+        self.throttled()
+        if attempts >= self.max_attempts:
+            self.logger.critical("%s is still throttled after %s attempts, giving up", operation.name, attempts)
+            return None
+
+        delay = self.backoff_delay(attempts)
+        self.logger.info("%s is throttled, retrying in %.1f sec (attempt %s)", operation.name, delay, attempts)
+        # Retries don't go through before-call, take a token here so they are rate limited too
+        self.acquire()
+        return delay
+
+
+class PollInterval(object):
+    """
+    Poll quickly right after an operation started and back off while nothing happens.
+    Call reset() when there was progress
+    """
+
+    def __init__(self, initial=2.0, maximum=30.0, factor=1.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.current = initial
+
+    def next(self):
+        interval = self.current
+        self.current = min(self.maximum, self.current * self.factor)
+        return interval
+
+    def reset(self):
+        self.current = self.initial
@@ -0,0 +1,142 @@
+import logging
+import threading
+
+from botocore.exceptions import ClientError
+
+from cfnstack.ClientRegistry import ClientRegistry
+
+"""
+ReferenceResolver resolves source/type/variable parameters for all stacks of a project.
+References are collected from the YAML up front and grouped per source stack. Each source stack
+is fetched once and indexed by parameter, output and resource name, the index is shared by every
+CFNStack referring to it and dropped as soon as the source stack is changed by this run.
+Resources are looked up by logical ID with DescribeStackResource when a source stack has only a
+few resource references, otherwise the whole logical to physical ID map is listed once
+"""
+
+VAR_TYPES = ('parameter', 'output', 'resource')
+
+
+class ReferenceResolver(object):
+
+    def __init__(self, targeted_lookup_limit=3):
+        self.logger = logging.getLogger(__name__)
+        # ListStackResources returns 100 resources per page, a handful of DescribeStackResource
+        # calls is cheaper than paging through big stacks
+        self.targeted_lookup_limit = targeted_lookup_limit
+        # Total cloudformation calls made to resolve references
+        self.api_calls = 0
+        # source stack name -> {var_type: set of variable names}
+        self.references = {}
+        # source stack name -> {var_type: {variable name: value}}
+        self._indexes = {}
+        # source stacks whose full resource map was listed
+        self._resource_maps = set()
+        self._lock = threading.Lock()
+        self._source_locks = {}
+
+    def collect(self, stack_objs):
+        """
+        Pre-pass over all stacks collecting every reference, deduplicated per source stack
+        """
+        for stack in stack_objs:
+            for source_stack, var_type, var_name in stack.references():
+                self._add_reference(source_stack, var_type, var_name)
+        self.logger.debug("Collected references to %s source stacks", len(self.references))
+
+    def _add_reference(self, source_stack, var_type, var_name):
+        source_refs = self.references.setdefault(source_stack, dict((t, set()) for t in VAR_TYPES))
+        if var_type in source_refs:
+            source_refs[var_type].add(var_name)
+
+    def _source_lock(self, source_stack):
+        with self._lock:
+            return self._source_locks.setdefault(source_stack, threading.Lock())
+
+    def _describe_resource(self, cf_client, source_stack, logical_id):
+        """
+        Look up one resource by logical ID, return None when the stack doesn't have it
+        """
+        try:
+            res = cf_client.describe_stack_resource(StackName=source_stack, LogicalResourceId=logical_id)
+        except ClientError as exception:
+            if 'does not exist' in str(exception.response['Error']['Message']):
+                return None
+            raise
+        return str(res['StackResourceDetail'].get('PhysicalResourceId'))
+
+    def _build_index(self, cf_client, source_stack):
+        """
+        Fetch everything referenced from source_stack. Return the index and the number of API calls made
+        """
+        source_refs = self.references.get(source_stack, {})
+        index = {'parameter': {}, 'output': {}, 'resource': {}}
+        api_calls = 0
+
+        # Parameters and outputs come with the same DescribeStacks call
+        stack = cf_client.describe_stacks(StackName=source_stack)['Stacks'][0]
+        api_calls += 1
+        for param in stack.get('Parameters', []):
+            index['parameter'][str(param['ParameterKey'])] = str(param['ParameterValue'])
+        for output in stack.get('Outputs', []):
+            index['output'][str(output['OutputKey'])] = str(output['OutputValue'])
+
+        logical_ids = sorted(source_refs.get('resource', ()))
+        if len(logical_ids) > self.targeted_lookup_limit:
+            paginator = cf_client.get_paginator('list_stack_resources')
+            for page in paginator.paginate(StackName=source_stack):
+                api_calls += 1
+                for res in page['StackResourceSummaries']:
+                    index['resource'][str(res['LogicalResourceId'])] = str(res.get('PhysicalResourceId'))
+            self._resource_maps.add(source_stack)
+            strategy = 'full resource map'
+        else:
+            for logical_id in logical_ids:
+                index['resource'][logical_id] = self._describe_resource(cf_client, source_stack, logical_id)
+                api_calls += 1
+            strategy = 'lookup by logical ID'
+
+        self.logger.info("Fetched %s references from stack %s with %s API calls (%s)",
+                         sum(len(names) for names in source_refs.values()), source_stack, api_calls, strategy)
+        return index, api_calls
+
+    def resolve(self, aws_session, source_stack, var_type, var_name):
+        """
+        Return the value of a parameter, output or resource of source_stack
+        """
+        if var_type not in VAR_TYPES:
+            self.logger.critical("Error: invalid var_type passed to get_value_from_cd, needs to be 'parameter','resource' or 'output'. Not %s" % (var_type))
+            exit(1)
+
+        api_calls = 0
+        with self._source_lock(source_stack):
+            index = self._indexes.get(source_stack)
+            try:
+                if index is None:
+                    # References missed by the pre-pass are registered before fetching
+                    self._add_reference(source_stack, var_type, var_name)
+                    self._resource_maps.discard(source_stack)
+                    index, api_calls = self._build_index(ClientRegistry.for_session(aws_session).client('cloudformation'), source_stack)
+                    self._indexes[source_stack] = index
+                elif var_type == 'resource' and var_name not in index['resource'] \
+                        and source_stack not in self._resource_maps:
+                    self._add_reference(source_stack, var_type, var_name)
+                    index['resource'][var_name] = self._describe_resource(
+                        ClientRegistry.for_session(aws_session).client('cloudformation'), source_stack, var_name)
+                    api_calls = 1
+            except ClientError as exception:
+                self.logger.critical("Error calling Cloudformation API : "+str(exception))
+                exit(1)
+
+        with self._lock:
+            self.api_calls += api_calls
+        self.logger.debug("Resolved %s %s of stack %s with %s API calls", var_type, var_name, source_stack, api_calls)
+        return index[var_type].get(var_name)
+
+    def invalidate(self, source_stack):
+        """
+        Forget the index of a stack that was created, updated or deleted
+        """
+        with self._source_lock(source_stack):
+            self._indexes.pop(source_stack, None)
+            self._resource_maps.discard(source_stack)
@@ -0,0 +1,85 @@
+import logging
+from collections import deque
+
+"""
+EventCursor keeps the position in the event history of one cloudformation stack.
+DescribeStackEvents returns newest events first, so every poll pages only until it
+reaches an event that was already seen instead of listing the whole stack history.
+Only a bounded window of recent events is held in memory
+"""
+
+class EventCursor(object):
+
+    def __init__(self, cf_client, stack_name, window=100):
+        self.logger = logging.getLogger(__name__)
+        self.cf_client = cf_client
+        self.stack_name = stack_name
+        self.recent_events = deque(maxlen=window)
+        self.last_event_id = None
+        # API pages used by the last poll and by all polls of this cursor
+        self.last_poll_pages = 0
+        self.total_pages = 0
+
+    def _fetch(self, max_pages=None):
+        """
+        Page through events newer than the last seen one, newest first
+        """
+        seen_ids = set(event['EventId'] for event in self.recent_events)
+        new_events = []
+        pages = 0
+        kwargs = {'StackName': self.stack_name}
+
+        while True:
+            response = self.cf_client.describe_stack_events(**kwargs)
+            pages += 1
+            reached_seen = False
+            for event in response['StackEvents']:
+                if event['EventId'] in seen_ids:
+                    reached_seen = True
+                    break
+                new_events.append(event)
+
+            if reached_seen or 'NextToken' not in response:
+                break
+            if max_pages and pages >= max_pages:
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+        self.last_poll_pages = pages
+        self.total_pages += pages
+        for event in reversed(new_events):
+            self.recent_events.append(event)
+        if new_events:
+            self.last_event_id = new_events[0]['EventId']
+        return new_events
+
+    def prime(self):
+        """
+        Mark the current newest events as seen without returning them.
+        Call before starting an operation on an existing stack so that only its events are reported
+        """
+        self._fetch(max_pages=1)
+        self.logger.debug("Event cursor for stack %s starts at event %s", self.stack_name, self.last_event_id)
+
+    def push(self, events):
+        """
+        Record events received without polling, like SNS notifications.
+        Return those not seen yet, oldest first
+        """
+        seen_ids = set(event['EventId'] for event in self.recent_events)
+        new_events = sorted((event for event in events if event['EventId'] not in seen_ids),
+                            key=lambda event: event['Timestamp'])
+        for event in new_events:
+            self.recent_events.append(event)
+        if new_events:
+            self.last_event_id = new_events[-1]['EventId']
+        return new_events
+
+    def poll(self):
+        """
+        Return events that happened since the last poll, oldest first
+        """
+        new_events = self._fetch()
+        self.logger.debug("Found %s new events for stack %s in %s API pages",
+                          len(new_events), self.stack_name, self.last_poll_pages)
+        return list(reversed(new_events))
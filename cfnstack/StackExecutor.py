@@ -0,0 +1,93 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+"""
+StackExecutor runs an action for every CFNStack object in dependency waves.
+A stack is started as soon as every stack it depends on has finished, with at most
+max_parallel stacks in flight at the same time. In reverse, used for deletes, a stack is started
+once every stack depending on it has finished
+"""
+
+class StackExecutor(object):
+
+    def __init__(self, stack_objs, max_parallel=1, name='', reverse=False):
+        self.logger = logging.getLogger(__name__)
+        self.stack_objs = stack_objs
+        self.max_parallel = max(1, int(max_parallel))
+        # Prefix of worker thread names
+        self.name = name
+        self.reverse = reverse
+
+    def _dependencies(self):
+        """
+        Map each stack name to the set of stack names it waits for, its dependencies
+        or in reverse its dependents. Stacks outside stack_objs are not waited for
+        """
+        names = set(stack.cfn_stack_name for stack in self.stack_objs)
+        deps = dict((name, set()) for name in names)
+        for stack in self.stack_objs:
+            for dep in (stack.depends_on or []):
+                if dep in names and dep != stack.cfn_stack_name:
+                    if self.reverse:
+                        deps[dep].add(stack.cfn_stack_name)
+                    else:
+                        deps[stack.cfn_stack_name].add(dep)
+        return deps
+
+    def run(self, worker):
+        """
+        Call worker(stack) for every stack once the stacks it waits for completed.
+        Return True if every stack finished, False if any worker failed.
+        On failure no new stacks are started, stacks already in flight are allowed to finish
+        """
+        by_name = {stack.cfn_stack_name: stack for stack in self.stack_objs}
+        order = list(reversed(self.stack_objs)) if self.reverse else self.stack_objs
+        position = {stack.cfn_stack_name: index for index, stack in enumerate(order)}
+        pending = self._dependencies()
+
+        dependents = {}
+        for name, deps in pending.items():
+            for dep in deps:
+                dependents.setdefault(dep, []).append(name)
+
+        ready = [stack.cfn_stack_name for stack in order if not pending[stack.cfn_stack_name]]
+        running = {}
+        completed = []
+        failed = []
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix=self.name) as pool:
+            while ready or running:
+                while ready and not failed and len(running) < self.max_parallel:
+                    name = ready.pop(0)
+                    self.logger.debug("Starting worker for stack %s", name)
+                    running[pool.submit(worker, by_name[name])] = name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except SystemExit:
+                        # Worker already logged the reason before calling exit
+                        failed.append(name)
+                        continue
+                    except Exception as exception:
+                        self.logger.critical("Stack %s failed. Error: %s" % (name, exception))
+                        failed.append(name)
+                        continue
+
+                    completed.append(name)
+                    for child in dependents.get(name, []):
+                        pending[child].discard(name)
+                        if not pending[child]:
+                            ready.append(child)
+                ready.sort(key=lambda stack_name: position[stack_name])
+
+        if failed:
+            not_started = [name for name in by_name if name not in completed and name not in failed]
+            self.logger.critical("Stacks failed: %s. Stacks not processed: %s" % (failed, not_started))
+            return False
+        return True
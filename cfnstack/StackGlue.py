@@ -1,15 +1,40 @@
+import contextlib
 import logging
-import os
+import threading
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-import pystache
-import yaml
-import simplejson
 from botocore.exceptions import NoCredentialsError, ClientError
 
-from cfnstack.CFNStack import CFNStack
+from cfnstack.ApiMetrics import ApiMetrics
+from cfnstack.CFNStack import CFNStack, FINGERPRINT_TAG
+from cfnstack.ChangeSetLister import ChangeSetLister, NdjsonWriter
+from cfnstack.ClientRegistry import ClientRegistry
+from cfnstack.ConfigLoader import ConfigLoader
+from cfnstack.StackEvents import EventCursor
+from cfnstack.DependencyGraph import DependencyGraph, DependencyError
+from cfnstack.EventQueue import EventQueue
+from cfnstack.StackExecutor import StackExecutor
+from cfnstack.StackIndex import StackIndex
+from cfnstack.StackSelector import StackSelector, SelectorError
+from cfnstack.StackWatcher import StackWatcher, stack_gone
+from cfnstack.TemplateStore import TemplateStore
+from cfnstack.ReferenceResolver import ReferenceResolver
+from cfnstack.RateLimiter import RateLimiter, PollInterval
+
+# Stack status while an operation is still running
+CREATE_WAIT_STATUS = "CREATE_IN_PROGRESS"
+UPDATE_WAIT_STATUS = ["UPDATE_IN_PROGRESS", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"]
+DELETE_WAIT_STATUS = "DELETE_IN_PROGRESS"
+# Change set status while it is being created, and results that are not errors
+CHANGE_SET_WAIT_STATUS = ["CREATE_PENDING", "CREATE_IN_PROGRESS"]
+CHANGE_SET_OK_STATUS = ["CREATE_COMPLETE", "NO_CHANGES", "SKIPPED"]
+# Stack status a state file entry can be trusted in
+STATE_OK_STATUS = ["CREATE_COMPLETE", "UPDATE_COMPLETE"]
+# Status reasons of change sets that failed because the stack is up to date
+EMPTY_CHANGE_SET_REASONS = ["didn't contain changes", "No updates are to be performed"]
 
 """
 StackGlue glues cloudformation stacks together and provides ability to create/destroy stacks based on dependency defined in YAML file
@@ -19,17 +44,35 @@ cloudformation stacks listed in YAML file
 """
 
 class StackGlue(object):
-    def __init__(self, yamlfile, profile):
+    def __init__(self, yamlfile, profile, max_parallel=1, api_rate=4.0, region=None, config=None, max_pool_connections=10,
+                 metrics=None, template_bucket=None, selector=None, deploy_state=None, journal=None, event_mode='poll'):
         self.logger = logging.getLogger(__name__)
+        # API calls of every session are counted by stack and phase, targets of a deployment matrix share one ApiMetrics
+        self.metrics = metrics or ApiMetrics()
 
         if profile and not profile.isspace():
             config_profile = profile
         else:
             config_profile = 'default'
 
-        yamlconfig = open(yamlfile, 'r')
-        render_yaml = pystache.render(yamlconfig.read(), dict(os.environ))
-        self.stackDict = yaml.safe_load(render_yaml)
+        self.config_profile = config_profile
+        # Maximum number of stacks deployed at the same time
+        self.max_parallel = max_parallel
+        # Worker threads keep their own boto3 session, sessions are not thread safe
+        self._worker_local = threading.local()
+        # One rate limiter shared by the cloudformation calls of every session
+        self.rate_limiter = RateLimiter(rate=api_rate, burst=max(2, int(api_rate * 2)))
+        # Connection pool size of the clients handed out by each session's ClientRegistry
+        self.max_pool_connections = max_pool_connections
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+
+        # Rendered and parsed config is cached until the file or the environment variables it uses change.
+        # Targets of a deployment matrix share the config parsed once by the caller
+        if config is None:
+            with self.metrics.scope(phase='config'):
+                config = ConfigLoader().load(yamlfile)
+        self.stackDict = config
 
         # There will be only one global stack name
         toplevel_stack_count = len(self.stackDict.keys())
@@ -40,7 +83,9 @@ class StackGlue(object):
 
         self.name = list(self.stackDict.keys())[0]
 
-        if 'region' in self.stackDict[self.name]:
+        if region:
+            self.region = region
+        elif 'region' in self.stackDict[self.name]:
             self.region = self.stackDict[self.name]['region']
         else:
             self.logger.critical("No region mentioned in the stack. Please specify region")
@@ -65,10 +110,11 @@ class StackGlue(object):
             # Assign default as DEV
             self.environment = 'dev'
 
+        # Name of this region/profile target in log messages
+        self.target_name = "%s/%s" % (self.config_profile, self.region)
+
         # Get and verify SNS topic
-        self.sns_topic_arn = self.stackDict[self.name].get('sns-topic-arn', [])
-        if isinstance(self.sns_topic_arn, str):
-            self.sns_topic_arn = [self.sns_topic_arn]
+        self.sns_topic_arn = self._region_topics(self.stackDict[self.name].get('sns-topic-arn', []))
         for topic in self.sns_topic_arn:
             if topic.split(':')[3] != self.region:
                 self.logger.critical('SNS Topic %s is not in the %s region' % (topic, self.region))
@@ -79,17 +125,42 @@ class StackGlue(object):
 
         # Array for holding CFNStack objects
         self.stack_objs = []
+        # stack_objs grouped by topological level, set by sort_cf_stacks_by_deps
+        self.stack_levels = []
+        # Parameter references to other stacks are resolved once per source stack for all stacks
+        self.resolver = ReferenceResolver()
+        # Plan entries by cfn stack name when apply follows a plan, set by use_plan
+        self.deploy_plan = None
+        # DeployState of incremental deploys, apply examines every stack without it
+        self.deploy_state = deploy_state
+        # DeployJournal recording the stacks apply, update and delete complete
+        self.journal = journal
+        # StackWatcher tailing the stack operations of the running action, see _watching
+        self.stack_watcher = None
+        # poll reads stack events with DescribeStackEvents, push receives them from the SNS topics of the stacks
+        self.event_mode = event_mode
 
         self.cf_stacks = list(self.stackDict[self.name]['stacks'].keys())
 
-        # Get all existing cloudformation stack details
-        try:
-            self.aws_session = boto3.Session(profile_name=config_profile)
-            self.cfn_conn = self.aws_session.resource("cloudformation")
-            self.cfn_all_stacks = self.cfn_conn.stacks.all()
-        except NoCredentialsError as exception:
-            self.logger.critical("No Credentials found for connecting to cloudformation: %s" % exception)
-            exit(1)
+        # Stacks matched by the -s/--stack selector, only these are built, indexed and resolved. None selects all
+        self.stack_selector = StackSelector(self.stackDict[self.name]['stacks'])
+        self.selection = None
+        if selector:
+            self.selection = self._select(selector)
+            self.logger.info("Selected %s of %s stacks: %s", len(self.selection), len(self.cf_stacks), self.selection)
+        # Cloudformation names of enabled stacks left out by the selector
+        self.external_stacks = []
+
+        # Templates are uploaded to this bucket and passed as TemplateURL, sent as TemplateBody without it
+        self.template_bucket = template_bucket or self._region_value(self.stackDict[self.name].get('template-bucket'))
+        self.template_store = None
+
+        self.aws_session = self._new_session()
+        self.cfn_conn = ClientRegistry.for_session(self.aws_session).resource("cloudformation")
+
+        if self.template_bucket:
+            self.template_store = TemplateStore(ClientRegistry.for_session(self.aws_session).client('s3'), self.template_bucket,
+                                                self.stackDict[self.name].get('template-prefix', 'cfnstack/templates'))
 
         for stack_name in self.cf_stacks:
             one_stack = self.stackDict[self.name]['stacks'][stack_name]
@@ -97,10 +168,11 @@ class StackGlue(object):
                 if one_stack.get('disable', False):
                     self.logger.warning("Stack %s is disabled by configuration, skipping..." % stack_name)
                     continue
+            if self.selection is not None and stack_name not in self.selection:
+                self.external_stacks.append(self._cfn_stack_name(stack_name))
+                continue
 
-            local_sns_arn = one_stack.get('sns-topic-arn', self.sns_topic_arn)
-            if isinstance(local_sns_arn, str):
-                local_sns_arn = [local_sns_arn]
+            local_sns_arn = self._region_topics(one_stack.get('sns-topic-arn', self.sns_topic_arn))
 
             for topic in local_sns_arn:
                 if topic.split(':')[3] != self.region:
@@ -128,61 +200,254 @@ class StackGlue(object):
                         region=self.region,
                         sns_topic_arn=local_sns_arn,
                         depends_on=one_stack.get('depends'),
-                        tags=self.merged_tags
+                        tags=self.merged_tags,
+                        resolver=self.resolver
                     )
                 )
 
+        self.resolver.collect(self.stack_objs)
+
+        # Get all existing cloudformation stack details
+        try:
+            # Snapshot of the stacks in the account indexed by stack name, limited to the selected
+            # stacks and the stacks they depend on when a selector is given
+            index_names = None
+            if self.selection is not None:
+                index_names = []
+                for stack in self.stack_objs:
+                    for name in [stack.cfn_stack_name] + (stack.depends_on or []):
+                        if name not in index_names:
+                            index_names.append(name)
+            with self._scope(phase='index'):
+                self.cfn_all_stacks = StackIndex(self.cfn_conn, index_names)
+        except NoCredentialsError as exception:
+            self.logger.critical("No Credentials found for connecting to cloudformation: %s" % exception)
+            exit(1)
+
     # Sort Cloudformation stacks by dependencies listed in YAML file
     def sort_cf_stacks_by_deps(self):
         """
-        Sort the array of stack_objs so they are in dependency order
+        Sort the array of stack_objs so they are in dependency order.
+        stack_levels holds the stacks grouped in topological levels
+        """
+        graph = DependencyGraph(self.stack_objs, self.external_stacks)
+        try:
+            with self._scope(phase='sort'):
+                self.stack_objs = graph.topological_order()
+                self.stack_levels = graph.levels()
+        except DependencyError as exception:
+            self.logger.critical("could not resolve dependency order. %s" % exception)
+            exit(1)
+        return True
+
+    # SNS topics may be given per region for deployment matrices
+    def _region_topics(self, topics):
+        if isinstance(topics, dict):
+            topics = topics.get(self.region, [])
+        if isinstance(topics, str):
+            topics = [topics]
+        return topics
+
+    # Settings like the template bucket may be given per region for deployment matrices
+    def _region_value(self, value):
+        if isinstance(value, dict):
+            return value.get(self.region)
+        return value
+
+    @staticmethod
+    def deployment_targets(config, profile):
+        """
+        List (profile, region) pairs to deploy the project to.
+        The optional matrix section of the project lists regions and profiles, every combination is a target.
+        A given profile narrows the matrix profiles to that one, it must be one of them.
+        Without a matrix, the project is deployed once with the given profile and the project region
+        """
+        if len(config.keys()) != 1:
+            return [(profile, None)]
+        matrix = list(config.values())[0].get('matrix') or {}
+        regions = matrix.get('regions') or [None]
+        profiles = matrix.get('profiles') or [profile]
+        if profile and matrix.get('profiles'):
+            if profile not in profiles:
+                logging.getLogger(__name__).critical("Profile %s is not in the matrix profiles %s of the project"
+                                                     % (profile, profiles))
+                exit(1)
+            profiles = [profile]
+        return [(target_profile, region) for target_profile in profiles for region in regions]
+
+    # New boto3 session with the shared rate limiter and a client registry attached
+    def _new_session(self):
+        aws_session = self.rate_limiter.register(boto3.Session(profile_name=self.config_profile, region_name=self.region))
+        self.metrics.register(aws_session)
+        ClientRegistry.for_session(aws_session, self.max_pool_connections)
+        with self._sessions_lock:
+            self._sessions.append(aws_session)
+        return aws_session
+
+    def client_metrics(self):
+        """
+        Client reuse and connection churn summed over all sessions of this StackGlue
         """
-        sorted_stacks = []
-        dep_graph = {}
-        no_deps = []
+        with self._sessions_lock:
+            sessions = list(self._sessions)
+        total = {'sessions': len(sessions)}
+        for aws_session in sessions:
+            for key, value in ClientRegistry.for_session(aws_session).metrics().items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    # Attribute the API calls of the current thread to a stack and phase of this target
+    def _scope(self, stack_name='', phase=''):
+        return self.metrics.scope(target=self.target_name, stack=stack_name, phase=phase)
+
+    # Session and cloudformation resource owned by the current worker thread
+    def _worker_conn(self):
+        if not hasattr(self._worker_local, 'cfn_conn'):
+            self._worker_local.aws_session = self._new_session()
+            self._worker_local.cfn_conn = ClientRegistry.for_session(self._worker_local.aws_session).resource("cloudformation")
+        return self._worker_local.aws_session, self._worker_local.cfn_conn
+
+    # Cloudformation name of a stack of the YAML file, see CFNStack
+    def _cfn_stack_name(self, stack_name):
+        if stack_name == self.name:
+            return stack_name
+        return '%s-%s-%s' % (self.name, self.environment, stack_name)
+
+    # Resolve a -s/--stack selector against the YAML dependencies, exit when it matches nothing
+    def _select(self, selector):
+        try:
+            return self.stack_selector.select(selector)
+        except SelectorError as exception:
+            self.logger.critical("%s" % exception)
+            exit(1)
 
-        # Add all stacks without dependencies in no_deps
-        for stack in self.stack_objs:
-            if stack.depends_on is None:
-                no_deps.append(stack)
-            else:
-                dep_graph[stack.name] = stack.depends_on[:]
-
-        while len(no_deps) > 0:
-            stack = no_deps.pop()
-            sorted_stacks.append(stack)
-            for node in list(dep_graph):
-                for deps in dep_graph[node]:
-                    if stack.cfn_stack_name == deps:
-                        dep_graph[node].remove(stack.cfn_stack_name)
-                        if len(dep_graph[node]) < 1:
-                            for stack_obj in self.stack_objs:
-                                if stack_obj.name == node:
-                                    no_deps.append(stack_obj)
-                            del dep_graph[node]
-        if len(dep_graph) > 0:
-            self.logger.critical(
-                "could not resolve dependency order. Either circular dependency or dependency on stack not in yaml file")
+    # Select stacks for an action, either all of them or those matched by the -s selector
+    def _selected_stacks(self, stack_name=None):
+        if not stack_name:
+            return list(self.stack_objs)
+        names = set(self._select(stack_name))
+        return [stack for stack in self.stack_objs if stack.name in names]
+
+    # Run worker for the selected stacks in dependency waves, reverse waves for deletes, exit when any of them failed
+    def _run_parallel(self, worker, stack_name=None, reverse=False):
+        executor = StackExecutor(self._selected_stacks(stack_name), self.max_parallel, self.target_name, reverse)
+        with self._watching():
+            completed = executor.run(self._journaled(worker))
+        if not completed:
             exit(1)
-        else:
-            self.stack_objs = sorted_stacks
-            return True
+
+    # Tail the stack operations of a run from one StackWatcher thread
+    @contextlib.contextmanager
+    def _watching(self):
+        event_queue = self._open_event_queue() if self.event_mode == 'push' else None
+        self.stack_watcher = StackWatcher(self.cfn_conn.meta.client, self.target_name, self._scope, event_queue=event_queue)
+        self.stack_watcher.start()
+        try:
+            yield self.stack_watcher
+        finally:
+            self.stack_watcher.stop()
+            if event_queue is not None:
+                self.logger.info("Stack events received from queue %s: %s of %s messages",
+                                 event_queue.name, self.stack_watcher.pushed_events, event_queue.messages)
+                event_queue.close()
+            self.stack_watcher = None
+
+    def _open_event_queue(self):
+        """
+        Subscribe a temporary SQS queue to the SNS topics of the stacks.
+        None when the stacks have no topic or the queue can't be set up, stack events are then polled
+        """
+        topics = set()
+        for stack in self.stack_objs:
+            topics.update(stack.sns_topic_arn or [])
+        if not topics:
+            self.logger.warning("No sns-topic-arn configured, polling stack events")
+            return None
+        registry = ClientRegistry.for_session(self.aws_session)
+        event_queue = EventQueue(registry.client('sns'), registry.client('sqs'), topics)
+        try:
+            event_queue.open()
+        except ClientError as exception:
+            self.logger.warning("Can't subscribe an SQS queue to %s, polling stack events. Error: %s"
+                                % (", ".join(sorted(topics)), exception))
+            return None
+        return event_queue
+
+    # Wait for a stack operation, through the StackWatcher of the run when there is one
+    def _watch(self, stack, while_status, cursor):
+        if self.stack_watcher is not None:
+            return self.stack_watcher.watch(stack.cfn_stack_name, while_status, cursor, bool(stack.sns_topic_arn))
+        return self.watch_events(stack.cfn_stack_name, while_status, self._worker_conn()[1], cursor)
+
+    # Wrap a stack worker to journal its outcome and skip stacks a resumed run already completed
+    def _journaled(self, worker):
+        if self.journal is None:
+            return worker
+
+        def journaled_worker(stack):
+            if self._journal_skip(stack):
+                return
+            self._journal_event(stack, 'started')
+            try:
+                worker(stack)
+            except (SystemExit, Exception):
+                self._journal_event(stack, 'failed')
+                raise
+            self._journal_event(stack, 'completed')
+        return journaled_worker
+
+    def _journal_skip(self, stack):
+        if self.journal is None or not self.journal.is_completed(self.target_name, stack.cfn_stack_name):
+            return False
+        self.logger.info("Stack %s was completed by the resumed run, skipping..." % stack.name)
+        return True
+
+    def _journal_event(self, stack, event):
+        """
+        Append a started, completed or failed record of a stack to the journal.
+        Completed records carry the operation performed, the parameter keys and the deploy fingerprint,
+        resolved parameter values are never written
+        """
+        if self.journal is None:
+            return
+        fields = {'event': event, 'target': self.target_name, 'stack': stack.cfn_stack_name}
+        if event == 'started':
+            stack.last_operation = 'noop'
+        if event == 'completed':
+            fields.update(operation=stack.last_operation,
+                          params=sorted(str(param['ParameterKey']) for param in stack.params))
+            if stack.template is not None:
+                fields.update(fingerprint=stack.fingerprint())
+        self.journal.record(**fields)
 
     # Apply - Create stacks if does not exists in AWS cloudformation and update the stack with updated template if stack already exists in cloudformation
     def apply(self, stack_name=None):
-        for stack in self.stack_objs:
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Determining whether stack needs to be created or updated")
+        self._run_parallel(self._apply_stack, stack_name)
+
+    def _apply_stack(self, stack):
+        planned_action = self._planned_action(stack)
+        if planned_action == 'noop':
+            self.logger.info("Stack %s is unchanged according to the plan, skipping..." % stack.name)
+            return
+        if planned_action == 'create':
+            self._create_stack(stack)
+            return
+        if planned_action == 'update':
+            self._update_stack(stack)
+            return
+        if self._unchanged_since_last_deploy(stack):
+            return
+
+        self.logger.info("Determining whether stack needs to be created or updated")
 
-            if not stack.exists_in_cfn(self.cfn_all_stacks):
-                self.logger.info("Stack %s does not exists in CloudFormation. Stack %s is going to be created" % (
-                stack.name, stack.name))
-                self.create(stack.name)
-            else:
-                self.logger.info(
-                    "Stack %s exists in CloudFormation. Checking wheter there is any change in the cloudformation template or parameters" % stack.name)
-                self.update(stack.name)
+        if not stack.exists_in_cfn(self.cfn_all_stacks):
+            self.logger.info("Stack %s does not exists in CloudFormation. Stack %s is going to be created" % (
+            stack.name, stack.name))
+            self._create_stack(stack)
+        else:
+            self.logger.info(
+                "Stack %s exists in CloudFormation. Checking wheter there is any change in the cloudformation template or parameters" % stack.name)
+            self._update_stack(stack)
 
     # Create cloudformation stack and this function is called from apply.
     def create(self, stack_name=None):
@@ -190,167 +455,370 @@ class StackGlue(object):
         Create all stacks in the yaml file based on dependency order.
         Any stack already exists skip the stack creation
         """
+        self._run_parallel(self._create_stack, stack_name)
 
-        for stack in self.stack_objs:
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Starting checks for creation of stack %s" % stack.name)
+    def _create_stack(self, stack):
+        cursor = self._submit_create(stack)
+        if cursor is not None:
+            create_result = self._watch(stack, CREATE_WAIT_STATUS, cursor)
+            self._finish_create(stack, create_result)
 
-            if stack.exists_in_cfn(self.cfn_all_stacks):
-                self.logger.critical("Stack %s already exists in cloudformation, skipping..." % stack.name)
-            else:
-                if stack.dependencies_met(self.cfn_all_stacks) is False:
-                    self.logger.critical("Dependencies for stack %s is not met and exiting..." % stack.name)
-                    exit(1)
-                if not stack.populate_params(self.cfn_all_stacks):
-                    self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
-                    exit(1)
+    def _prepare_stack(self, stack):
+        """
+        Check dependencies, resolve parameters and load the template of a stack
+        """
+        with self._scope(stack.cfn_stack_name, 'params'):
+            if stack.dependencies_met(self.cfn_all_stacks) is False:
+                self.logger.critical("Dependencies for stack %s is not met and exiting..." % stack.name)
+                exit(1)
+            if not stack.populate_params(self.cfn_all_stacks):
+                self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
+                exit(1)
 
-                stack.read_template()
-                self.logger.info("Creating: %s, and its parameters : %s" % (stack.cfn_stack_name, stack.params))
-                try:
-                    self.cfn_conn.create_stack(
-                        StackName=stack.cfn_stack_name,
-                        TemplateBody=stack.template_body,
-                        Parameters=stack.params,
-                        Capabilities=['CAPABILITY_IAM'],
-                        NotificationARNs=stack.sns_topic_arn,
-                        OnFailure='DELETE',
-                        Tags=stack.tags
-                    )
-                except Exception as exception:
-                    self.logger.critical("Creating stack %s failed. Error: %s" % (stack.cfn_stack_name, exception))
-                    exit(1)
+            stack.read_template()
 
-                create_result = self.watch_events(stack.cfn_stack_name, "CREATE_IN_PROGRESS")
-                if create_result != "CREATE_COMPLETE":
-                    self.logger.critical("Stack did not create correctly, status is now %s" % create_result)
-                    exit(1)
+    def _submit_create(self, stack):
+        """
+        Run the checks and the CreateStack call of a stack without waiting for it.
+        Return the event cursor of the operation, None when the stack already exists
+        """
+        aws_session, cfn_conn = self._worker_conn()
+        stack.aws_session = aws_session
+
+        self.logger.info("Starting checks for creation of stack %s" % stack.name)
+
+        if stack.exists_in_cfn(self.cfn_all_stacks):
+            self.logger.critical("Stack %s already exists in cloudformation, skipping..." % stack.name)
+            return None
 
-                self.logger.info("Finished creating stack: %s" % stack.cfn_stack_name)
-                self.cfn_all_stacks = self.cfn_conn.stacks.all()
+        self._prepare_stack(stack)
+        template_args = self._template_args(stack)
+        self.logger.info("Creating: %s, and its parameters : %s" % (stack.cfn_stack_name, stack.params))
+        try:
+            with self._scope(stack.cfn_stack_name, 'deploy'):
+                cfn_conn.create_stack(
+                    StackName=stack.cfn_stack_name,
+                    Parameters=stack.params,
+                    Capabilities=['CAPABILITY_IAM'],
+                    NotificationARNs=stack.sns_topic_arn,
+                    OnFailure='DELETE',
+                    Tags=stack.deploy_tags(),
+                    **template_args
+                )
+        except Exception as exception:
+            self.logger.critical("Creating stack %s failed. Error: %s" % (stack.cfn_stack_name, exception))
+            exit(1)
+
+        # New stack, every event belongs to this operation
+        return EventCursor(cfn_conn.meta.client, stack.cfn_stack_name)
+
+    def _template_args(self, stack):
+        """
+        Template argument of create, update and change set calls.
+        With a template bucket the template is stored in S3 and passed as TemplateURL
+        """
+        if self.template_store is None:
+            return {'TemplateBody': stack.template_body}
+        try:
+            with self._scope(stack.cfn_stack_name, 'upload'):
+                return {'TemplateURL': self.template_store.template_url(stack.template)}
+        except ClientError as exception:
+            self.logger.critical("Storing template of stack %s in bucket %s failed. Error: %s"
+                                 % (stack.cfn_stack_name, self.template_bucket, exception))
+            exit(1)
+
+    def save_template_manifest(self):
+        """
+        Record the templates stored in the template bucket by this run, also after a failed run
+        """
+        if self.template_store is not None:
+            self.template_store.log_summary()
+            self.template_store.save_manifest()
+
+    def _finish_create(self, stack, create_result):
+        if create_result != "CREATE_COMPLETE":
+            self.logger.critical("Stack %s did not create correctly, status is now %s" % (stack.cfn_stack_name, create_result))
+            exit(1)
+
+        self.logger.info("Finished creating stack: %s" % stack.cfn_stack_name)
+        stack.last_operation = 'create'
+        self._stack_changed(stack)
+        self._record_state(stack)
+
+    # Reload a stack changed by this run and forget the references resolved from it
+    def _stack_changed(self, stack):
+        with self._scope(stack.cfn_stack_name, 'refresh'):
+            self.cfn_all_stacks.refresh(stack.cfn_stack_name, self._worker_conn()[1])
+        self.resolver.invalidate(stack.cfn_stack_name)
 
     # Update cloudfromation stack if already exists in AWS cloudformation
     def update(self, stack_name=None):
-        for stack in self.stack_objs:
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Starting checks for update of stack %s" % stack.name)
+        self._run_parallel(self._update_stack, stack_name)
 
-            if not stack.exists_in_cfn(self.cfn_all_stacks):
-                self.logger.critical(
-                    "Stack %s does not exists in cloudformation, can't update non-existing stack, skipping..." % stack.name)
+    def _update_stack(self, stack):
+        cursor = self._submit_update(stack)
+        if cursor is not None:
+            update_result = self._watch(stack, UPDATE_WAIT_STATUS, cursor)
+            self._finish_update(stack, update_result)
+
+    def _submit_update(self, stack):
+        """
+        Run the checks and the UpdateStack call of a stack without waiting for it.
+        Return the event cursor of the operation, None when there is nothing to update
+        """
+        aws_session, cfn_conn = self._worker_conn()
+        stack.aws_session = aws_session
+
+        self.logger.info("Starting checks for update of stack %s" % stack.name)
+
+        if not stack.exists_in_cfn(self.cfn_all_stacks):
+            self.logger.critical(
+                "Stack %s does not exists in cloudformation, can't update non-existing stack, skipping..." % stack.name)
+            return None
+
+        self._prepare_stack(stack)
+
+        planned_fingerprint = self._planned_fingerprint(stack)
+        if planned_fingerprint is not None:
+            if stack.fingerprint() != planned_fingerprint:
+                self.logger.critical("Parameters of stack %s changed since the plan was made, run plan again" % stack.name)
+                exit(1)
+            return self._start_update(stack, cfn_conn)
+
+        with self._scope(stack.cfn_stack_name, 'template'):
+            template_up_to_date = stack.template_uptodate(self.cfn_all_stacks)
+            params_up_to_date = stack.params_uptodate(self.cfn_all_stacks)
+
+        self.logger.info("Stack %s is up to date: %s" % (stack.name, template_up_to_date and params_up_to_date))
+
+        if template_up_to_date and params_up_to_date:
+            self.logger.info("Stack '%s' is already up to date with cloudformation. Skipping..." % stack.name)
+            self._record_state(stack)
+            return None
+
+        self.logger.info("Template or parameter for stack %s has changed." % stack.name)
+        return self._start_update(stack, cfn_conn)
+
+    def _start_update(self, stack, cfn_conn):
+        self.logger.info("Starting update of stack %s with parameters: %s" % (stack.name, stack.params))
+
+        # Validate template step can be added here
+
+        template_args = self._template_args(stack)
+        try:
+            with self._scope(stack.cfn_stack_name, 'deploy'):
+                cursor = EventCursor(cfn_conn.meta.client, stack.cfn_stack_name)
+                cursor.prime()
+                cfn_conn.Stack(stack.cfn_stack_name).update(
+                    Parameters=stack.params,
+                    Capabilities=['CAPABILITY_IAM'],
+                    NotificationARNs=stack.sns_topic_arn,
+                    Tags=stack.deploy_tags(),
+                    **template_args
+                )
+        except ClientError as exception:
+            if (str(exception.response['Error']['Message']) == "No updates are to be performed."):
+                self.logger.error(
+                    "CloudFormation has no updates to perform on resources of stack %s. Continue with next stack if exists..." % stack.name)
+                self._record_state(stack)
+                return None
             else:
-                if stack.dependencies_met(self.cfn_all_stacks) is False:
-                    self.logger.critical("Dependencies for stack %s is not met and exiting..." % stack.name)
-                    exit(1)
-                if not stack.populate_params(self.cfn_all_stacks):
-                    self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
-                    exit(1)
+                self.logger.critical(
+                    "Updating stack %s failed. Error: %s" % (stack.cfn_stack_name, exception))
+                exit(1)
+        return cursor
 
-                stack.read_template()
+    def _finish_update(self, stack, update_result):
+        if update_result != "UPDATE_COMPLETE":
+            self.logger.critical(
+                "Stack %s didn't update correctly, status is now %s"
+                % (stack.cfn_stack_name, update_result))
+            exit(1)
 
-                template_up_to_date = stack.template_uptodate(self.cfn_all_stacks)
-                params_up_to_date = stack.params_uptodate(self.cfn_all_stacks)
+        self.logger.info(
+            "Finished updating stack: %s" % stack.cfn_stack_name)
+        stack.last_operation = 'update'
+        self._stack_changed(stack)
+        self._record_state(stack)
+
+    # Last update time and deploy fingerprint of a stack in the stack index, None when it doesn't exist
+    def _deployed_version(self, cfn_stack_name):
+        cf_stack = self.cfn_all_stacks.get(cfn_stack_name)
+        if cf_stack is None:
+            return None
+        fingerprint = [tag['Value'] for tag in (cf_stack.tags or []) if tag['Key'] == FINGERPRINT_TAG]
+        return '%s %s' % (cf_stack.last_updated_time or cf_stack.creation_time, ''.join(fingerprint))
+
+    # Versions of the stacks a stack depends on or takes parameter values from
+    def _upstream_versions(self, stack):
+        upstream = set(stack.depends_on or []) | set(source for source, _, _ in stack.references())
+        return dict((name, self._deployed_version(name)) for name in upstream if name != stack.cfn_stack_name)
+
+    def _record_state(self, stack):
+        """
+        Record a stack that was deployed or found up to date in the state file.
+        read_template and populate_params must be called first
+        """
+        if self.deploy_state is None:
+            return
+        self.deploy_state.record(self.target_name, stack.cfn_stack_name, {
+            'inputs': stack.inputs_hash(),
+            'fingerprint': stack.fingerprint(),
+            'version': self._deployed_version(stack.cfn_stack_name),
+            'upstream': self._upstream_versions(stack),
+        })
+
+    def _unchanged_since_last_deploy(self, stack):
+        """
+        True when the state file shows that neither the local definition of a stack nor the stack in
+        cloudformation changed since it was last deployed or verified. Parameters are resolved again only
+        when a stack it takes values from was deployed since, it is unchanged if they resolve to the same values
+        """
+        if self.deploy_state is None:
+            return False
+        entry = self.deploy_state.entry(self.target_name, stack.cfn_stack_name)
+        if entry is None:
+            return False
+        cf_stack = stack.exists_in_cfn(self.cfn_all_stacks)
+        if not cf_stack or cf_stack.stack_status not in STATE_OK_STATUS:
+            return False
+        if entry['version'] != self._deployed_version(stack.cfn_stack_name) or entry['inputs'] != stack.inputs_hash():
+            return False
+
+        if entry['upstream'] == self._upstream_versions(stack):
+            self.logger.info("Stack %s is unchanged since it was last deployed, skipping..." % stack.name)
+            return True
 
-                self.logger.info("Stack is up to date: %s" % (template_up_to_date and params_up_to_date))
+        stack.aws_session = self._worker_conn()[0]
+        self._prepare_stack(stack)
+        if stack.fingerprint() != entry['fingerprint']:
+            self.logger.info("Values stack %s takes from other stacks changed since it was last deployed" % stack.name)
+            return False
+        self.logger.info("Values stack %s takes from redeployed stacks are unchanged, skipping..." % stack.name)
+        self._record_state(stack)
+        return True
+
+    # Plan - Classify stacks as create, update or noop without changing anything
+    def plan(self, stack_name=None):
+        """
+        Resolve parameters and compare templates and parameters of the selected stacks concurrently.
+        A stack that depends on or takes values from a changing stack may receive new outputs, so its
+        planned parameters are not final: it is planned as an update that apply verifies again.
+        Return the plan entries of this target by cfn stack name
+        """
+        stacks = self._selected_stacks(stack_name)
+        with ThreadPoolExecutor(max_workers=max(1, self.max_parallel), thread_name_prefix=self.target_name) as pool:
+            entries = dict(zip([stack.cfn_stack_name for stack in stacks], pool.map(self._plan_stack, stacks)))
+
+        changing = set(name for name, entry in entries.items() if entry['action'] != 'noop')
+        for stack in stacks:
+            entry = entries[stack.cfn_stack_name]
+            upstream = set(stack.depends_on or []) | set(source for source, _, _ in stack.references())
+            changed_deps = sorted(dep for dep in upstream if dep in changing and dep != stack.cfn_stack_name)
+            if changed_deps:
+                entry['verify'] = True
+                if entry['action'] == 'noop':
+                    entry.update(action='update', reason='depends on changing stack %s' % ', '.join(changed_deps))
+                changing.add(stack.cfn_stack_name)
+            self.logger.info("Plan for stack %s: %s (%s)", stack.name, entry['action'], entry['reason'])
+        return entries
+
+    def _plan_stack(self, stack):
+        aws_session, cfn_conn = self._worker_conn()
+        stack.aws_session = aws_session
+
+        entry = {'stack': stack.name, 'inputs': stack.inputs_hash(), 'verify': False}
+        cf_stack = stack.exists_in_cfn(self.cfn_all_stacks)
+        if not cf_stack:
+            entry.update(action='create', reason='stack does not exist', deployed_fingerprint=None)
+            return entry
+
+        self._prepare_stack(stack)
+        with self._scope(stack.cfn_stack_name, 'template'):
+            template_up_to_date = stack.template_uptodate(self.cfn_all_stacks)
+            params_up_to_date = stack.params_uptodate(self.cfn_all_stacks)
+        entry['fingerprint'] = stack.fingerprint()
+        entry['deployed_fingerprint'] = stack.deployed_fingerprint(cf_stack)
+
+        if template_up_to_date and params_up_to_date:
+            entry.update(action='noop', reason='up to date')
+        else:
+            changes = [name for name, up_to_date in (('template', template_up_to_date), ('parameters', params_up_to_date))
+                       if not up_to_date]
+            entry.update(action='update', reason='%s changed' % ' and '.join(changes))
+        return entry
 
-                if template_up_to_date and params_up_to_date:
-                    self.logger.info("Stack '%s' is already up to date with cloudformation. Skipping..." % stack.name)
-                else:
-                    self.logger.info("Template or parameter for stack %s has changed." % stack.name)
-                    self.logger.info("Starting update of stack %s with parameters: %s" % (stack.name, stack.params))
-
-                    # Validate template step can be added here
-
-                    try:
-                        self.cfn_conn.Stack(stack.cfn_stack_name).update(
-                            TemplateBody=stack.template_body,
-                            Parameters=stack.params,
-                            Capabilities=['CAPABILITY_IAM'],
-                            NotificationARNs=stack.sns_topic_arn
-                        )
-                    except ClientError as exception:
-                        if (str(exception.response['Error']['Message']) == "No updates are to be performed."):
-                            self.logger.error(
-                                "CloudFormation has no updates to perform on resources of stack %s. Continue with next stack if exists..." % stack.name)
-                            continue
-                        else:
-                            self.logger.critical(
-                                "Updating stack %s failed. Error: %s" % (stack.cfn_stack_name, exception))
-                            exit(1)
-
-                    update_result = self.watch_events(
-                        stack.cfn_stack_name, [
-                            "UPDATE_IN_PROGRESS",
-                            "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"])
-                    if update_result != "UPDATE_COMPLETE":
-                        self.logger.critical(
-                            "Stack didn't update correctly, status is now %s"
-                            % update_result)
-                        exit(1)
-
-                    self.logger.info(
-                        "Finished updating stack: %s" % stack.cfn_stack_name)
-
-            # avoid getting rate limited
-            time.sleep(2)
+    def use_plan(self, entries, stack_name=None):
+        """
+        Make apply follow plan entries. The plan is rejected when the local definition of a stack
+        changed or the stack was deployed by someone else since the plan was made
+        """
+        stale = []
+        for stack in self._selected_stacks(stack_name):
+            entry = entries.get(stack.cfn_stack_name)
+            if entry is None:
+                stale.append("%s is not in the plan" % stack.name)
+                continue
+            if entry['inputs'] != stack.inputs_hash():
+                stale.append("%s changed locally" % stack.name)
+                continue
+            cf_stack = stack.exists_in_cfn(self.cfn_all_stacks)
+            if (entry['action'] == 'create') != (not cf_stack):
+                stale.append("%s was %s" % (stack.name, 'created' if cf_stack else 'deleted'))
+            elif cf_stack and stack.deployed_fingerprint(cf_stack) != entry.get('deployed_fingerprint'):
+                stale.append("%s was deployed since" % stack.name)
+        if stale:
+            self.logger.critical("Plan is out of date, run plan again: %s" % '; '.join(stale))
+            exit(1)
+        self.deploy_plan = entries
+
+    def _planned_action(self, stack):
+        if self.deploy_plan is None:
+            return None
+        return self.deploy_plan[stack.cfn_stack_name]['action']
+
+    # Fingerprint apply can trust without comparing template and parameters, None when the stack must be checked
+    def _planned_fingerprint(self, stack):
+        if self.deploy_plan is None:
+            return None
+        entry = self.deploy_plan[stack.cfn_stack_name]
+        if entry['action'] != 'update' or entry['verify']:
+            return None
+        return entry.get('fingerprint')
 
     #List CF change sets created in a stack
-    def listcs(self,stack_name=None):
-        for stack in self.stack_objs:
-            self.logger.info(stack)
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Starting to retrieve changesets for %s" % stack.name)
+    def listcs(self, stack_name=None, writer=None, summaries_only=False):
+        """
+        Stream the change sets of the selected stacks as NDJSON to writer, stdout by default.
+        Change sets are described concurrently, with summaries_only only the summaries are listed.
+        Exit when a stack or change set could not be read
+        """
+        lister = self._change_set_lister(writer, summaries_only)
+        if not lister.run(self._listcs_stacks(stack_name), self.max_parallel):
+            exit(1)
 
+    def _listcs_stacks(self, stack_name=None):
+        stacks = []
+        for stack in self._selected_stacks(stack_name):
             if not stack.exists_in_cfn(self.cfn_all_stacks):
-                self.logger.critical(
+                self.logger.warning(
                     "Stack %s does not exists in cloudformation, can't list change sets from non-existing stack, skipping..." % stack.name)
             else:
-                if stack.dependencies_met(self.cfn_all_stacks) is False:
-                    self.logger.critical("Dependencies for stack %s is not met and exiting..." % stack.name)
-                    exit(1)
-                if not stack.populate_params(self.cfn_all_stacks):
-                    self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
-                    exit(1)
+                stacks.append(stack)
+        return stacks
 
-            cf_client = self.cfn_conn.meta.client;
-
-            try:
-                stackcs = cf_client.list_change_sets(StackName=stack.cfn_stack_name)
-            except  Exception as exception:
-                self.logger.critical("Can't list change sets for stack %s. Error: %s" % (stack.cfn_stack_name, exception))
-                exit(1)
-
-            enco = lambda obj: (
-                obj.isoformat()
-                if isinstance(obj, datetime.datetime)
-                    or isinstance(obj, datetime.date)
-                else None
-            )
-
-            for csval in stackcs['Summaries']:
-                self.logger.info("\nHere is the description of change set \"%s\" for stack \"%s\", created on %s"
-                                     % (csval['ChangeSetName'],csval['StackName'],csval['CreationTime']))
-                self.logger.info("\n"+simplejson.dumps(csval,sort_keys=False,indent=4,default=enco))
-                self.logger.info("\n-----------------------------------------------------------------------------\n")
-                try:
-                    stackcs = cf_client.describe_change_set(ChangeSetName=csval['ChangeSetName'],StackName=csval['StackName'])
-                except  Exception as exception:
-                    self.logger.critical(
-                            "Can't describe change sets for stack %s. Error: %s" % (stack.cfn_stack_name, exception))
-                    exit(1)
-                self.logger.info("\nDetails of changes in the change set \"%s\" for stack \"%s\"" % (csval['ChangeSetName'],csval['StackName']) )
-                self.logger.info("\n"+simplejson.dumps(stackcs, sort_keys=False, indent=4, default=enco))
-                self.logger.info("\n********************************************************************\n")
+    def _change_set_lister(self, writer=None, summaries_only=False):
+        return ChangeSetLister(self.cfn_conn.meta.client, writer or NdjsonWriter(), self.target_name, summaries_only, self._scope)
 
     #Apply or execute changeset to a stack
     def applycs(self, stack_name=None, changesetname=None):
-        for stack in self.stack_objs:
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Starting to retrieve changesets for %s" % stack.name)
+        stacks = self._selected_stacks(stack_name)
+        if len(stacks) != 1:
+            self.logger.critical("Change sets are applied to one stack at a time, '%s' selects %s"
+                                 % (stack_name, [stack.name for stack in stacks]))
+            exit(1)
+        stack = stacks[0]
+        self.logger.info("Starting to retrieve changesets for %s" % stack.name)
 
         if not stack.exists_in_cfn(self.cfn_all_stacks):
             self.logger.critical(
@@ -387,6 +855,8 @@ class StackGlue(object):
             exit(1)
         else:
             try:
+                cursor = EventCursor(cf_client, stack.cfn_stack_name)
+                cursor.prime()
                 cf_client.execute_change_set(ChangeSetName=changesetname, StackName=stack.cfn_stack_name)
             except  Exception as exception:
                 self.logger.critical(
@@ -396,7 +866,7 @@ class StackGlue(object):
         update_result = self.watch_events(
                 stack.cfn_stack_name, [
                         "UPDATE_IN_PROGRESS",
-                        "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"])
+                        "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"], cursor=cursor)
         if update_result != "UPDATE_COMPLETE":
                 self.logger.critical(
                         "Stack didn't update correctly, status is now %s"
@@ -405,55 +875,136 @@ class StackGlue(object):
 
         self.logger.info(
                     "Finished updating stack %s using change set: %s" % (stack.cfn_stack_name,changesetname))
+        self.cfn_all_stacks.refresh(stack.cfn_stack_name)
+        self.resolver.invalidate(stack.cfn_stack_name)
 
     #Create change set for a CF stack
     def createcs(self, stack_name=None, changesetname=None):
-        for stack in self.stack_objs:
-            if stack_name and stack.name != stack_name:
-                continue
-
+        """
+        Create change set changesetname on the selected stacks, all stacks of the project when stack_name is not given.
+        Change sets are submitted concurrently, then one poller waits until every change set is ready.
+        Change sets failing because they contain no changes are deleted. One summary is logged at the end
+        """
+        results = {}
+        stacks = []
+        for stack in self._selected_stacks(stack_name):
             if not stack.exists_in_cfn(self.cfn_all_stacks):
                 self.logger.critical(
                     "Stack %s does not exists in cloudformation, can't create change sets on non-existing stack, skipping..." % stack.name)
+                results[stack.name] = {'status': 'SKIPPED', 'reason': 'stack does not exist'}
             else:
-                if stack.dependencies_met(self.cfn_all_stacks) is False:
-                    self.logger.critical("Dependencies for stack %s is not met and exiting..." % stack.name)
-                    exit(1)
-                if not stack.populate_params(self.cfn_all_stacks):
-                    self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
-                    exit(1)
+                stacks.append(stack)
 
-            cf_client = self.cfn_conn.meta.client;
+        submitted = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_parallel), thread_name_prefix=self.target_name) as pool:
+            futures = [(pool.submit(self._submit_change_set, stack, changesetname), stack) for stack in stacks]
+        for future, stack in futures:
+            try:
+                submitted[stack.name] = (stack, future.result())
+            except SystemExit:
+                results[stack.name] = {'status': 'SUBMIT_FAILED', 'reason': 'see error above'}
 
-            current_time = datetime.datetime.now().isoformat()
-            description_txt = "Change Set "+changesetname+" is created for "+stack.cfn_stack_name+" at "+current_time
+        results.update(self._wait_change_sets(submitted))
+        self._log_change_set_summary(changesetname, results)
+        if any(result['status'] not in CHANGE_SET_OK_STATUS for result in results.values()):
+            exit(1)
 
-            stack.read_template()
-            self.logger.info("Creating Changeset: %s for stack: %s, and its parameters : %s" % (changesetname,stack.cfn_stack_name, stack.params))
+    def _submit_change_set(self, stack, changesetname):
+        """
+        Resolve parameters of a stack and submit the change set, return the change set id
+        """
+        aws_session, cfn_conn = self._worker_conn()
+        stack.aws_session = aws_session
+        self._prepare_stack(stack)
+        template_args = self._template_args(stack)
 
-            try:
-                cf_client.create_change_set(
+        current_time = datetime.datetime.now().isoformat()
+        description_txt = "Change Set "+changesetname+" is created for "+stack.cfn_stack_name+" at "+current_time
+        self.logger.info("Creating Changeset: %s for stack: %s, and its parameters : %s" % (changesetname,stack.cfn_stack_name, stack.params))
+
+        try:
+            with self._scope(stack.cfn_stack_name, 'changeset'):
+                response = cfn_conn.meta.client.create_change_set(
                     StackName=stack.cfn_stack_name,
-                    TemplateBody=stack.template_body,
                     Parameters=stack.params,
                     Capabilities=['CAPABILITY_IAM'],
                     NotificationARNs=stack.sns_topic_arn,
-                    Tags=stack.tags,
+                    Tags=stack.deploy_tags(),
                     ChangeSetName = changesetname,
-                    Description = description_txt
+                    Description = description_txt,
+                    **template_args
                 )
-            except Exception as exception:
-                self.logger.critical(
-                    "Can't create change sets for stack %s. Error: %s" % (stack.cfn_stack_name, exception))
-                exit(1)
+        except Exception as exception:
+            self.logger.critical(
+                "Can't create change sets for stack %s. Error: %s" % (stack.cfn_stack_name, exception))
+            exit(1)
 
-            self.logger.info("Changeset %s for stack %s is successfully created" % (changesetname, stack.cfn_stack_name))
+        self.logger.info("Changeset %s for stack %s is submitted" % (changesetname, stack.cfn_stack_name))
+        return response['Id']
+
+    def _wait_change_sets(self, submitted):
+        """
+        Poll the submitted change sets from a single loop until each one is complete or failed.
+        submitted maps stack names to (stack, change set id), return the result of each stack
+        """
+        cf_client = self.cfn_conn.meta.client
+        pending = dict(submitted)
+        results = {}
+        poll_interval = PollInterval()
+        while pending:
+            for name, (stack, change_set_id) in list(pending.items()):
+                try:
+                    with self._scope(stack.cfn_stack_name, 'changeset'):
+                        description = cf_client.describe_change_set(ChangeSetName=change_set_id)
+                        status = description['Status']
+                        if status in CHANGE_SET_WAIT_STATUS:
+                            continue
+                        changes = len(description.get('Changes', []))
+                        while description.get('NextToken'):
+                            description = cf_client.describe_change_set(ChangeSetName=change_set_id, NextToken=description['NextToken'])
+                            changes += len(description.get('Changes', []))
+                except ClientError as exception:
+                    self.logger.critical("Can't describe change set of stack %s. Error: %s" % (stack.cfn_stack_name, exception))
+                    results[name] = {'status': 'DESCRIBE_FAILED', 'reason': str(exception)}
+                    del pending[name]
+                    continue
+
+                del pending[name]
+                reason = description.get('StatusReason', '')
+                if status == 'FAILED' and any(message in reason for message in EMPTY_CHANGE_SET_REASONS):
+                    results[name] = {'status': 'NO_CHANGES', 'reason': self._delete_empty_change_set(stack, change_set_id)}
+                else:
+                    results[name] = {'status': status, 'reason': reason, 'changes': changes}
+
+            if pending:
+                self.logger.info("Waiting for %s change sets: %s", len(pending), sorted(pending))
+                time.sleep(poll_interval.next())
+        return results
+
+    def _delete_empty_change_set(self, stack, change_set_id):
+        try:
+            with self._scope(stack.cfn_stack_name, 'changeset'):
+                self.cfn_conn.meta.client.delete_change_set(ChangeSetName=change_set_id)
+        except ClientError as exception:
+            self.logger.error("Can't delete empty change set of stack %s. Error: %s" % (stack.cfn_stack_name, exception))
+            return 'no changes, delete failed'
+        return 'no changes, deleted'
+
+    def _log_change_set_summary(self, changesetname, results):
+        counts = {}
+        for result in results.values():
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        self.logger.info("Change set %s on %s stacks: %s" % (changesetname, len(results), counts))
+        for stack in self.stack_objs:
+            if stack.name in results:
+                result = results[stack.name]
+                self.logger.info("  %-30s %-16s %-12s %s" % (stack.name, result['status'],
+                                                          '%s changes' % result['changes'] if 'changes' in result else '',
+                                                          result['reason']))
 
     #Delete change set from a CF stack
     def deletecs(self, stack_name=None, changesetname=None):
-        for stack in self.stack_objs:
-            if stack_name and stack.name != stack_name:
-                continue
+        for stack in self._selected_stacks(stack_name):
 
             if not stack.exists_in_cfn(self.cfn_all_stacks):
                 self.logger.critical(
@@ -488,107 +1039,129 @@ class StackGlue(object):
     #Delete cloudformation stack
     def delete(self, stack_name=None):
         """
-        Delete all the stacks from cloudformation.
-        Delete the stack in reverse dependency order
+        Delete the selected stacks from cloudformation in reverse dependency waves.
+        A stack is deleted once no remaining stack depends on it, up to max_parallel at a time
         """
-        for stack in reversed(self.stack_objs):
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Starting checks for creation of stack %s" % stack.name)
+        self._run_parallel(self._delete_stack, stack_name, reverse=True)
 
-            if not stack.exists_in_cfn(self.cfn_all_stacks):
-                self.logger.critical("Stack %s does not exist in cloudformation, skipping..." % stack.name)
-            else:
-                self.logger.info("Starting to delete stacks %s" % stack.name)
-                try:
-                    self.cfn_conn.Stack(stack.cfn_stack_name).delete()
-                except  Exception as exception:
-                    self.logger.critical("Deleting stack %s failed. Error: %s" % (stack.cfn_stack_name, exception))
-                    exit(1)
-
-                delete_result = self.watch_events(stack.cfn_stack_name, "DELETE_IN_PROGRESS")
+    def _delete_stack(self, stack):
+        cursor = self._submit_delete(stack)
+        if cursor is not None:
+            delete_result = self._watch(stack, DELETE_WAIT_STATUS, cursor)
+            self._finish_delete(stack, delete_result)
 
-                if (delete_result != "DELETE_COMPLETE" and delete_result != "STACK_GONE"):
-                    self.logger.critical("Stack didn't get deleted correctly, Status is now %s", delete_result)
-                    exit(1)
-
-                self.logger.info("Finished deleting Stack: %s", stack.cfn_stack_name)
-                self.cfn_all_stacks = self.cfn_conn.stacks.all()
-
-    # Watch cloudformation events for all action
-    def watch_events(self, stack_name, while_status):
+    def _submit_delete(self, stack):
         """
-        Stay and watch cloudformation events till 'while_status'
+        Start deleting a stack without waiting for it.
+        Return the event cursor of the operation, None when the stack doesn't exist
         """
-        cfstack_obj = self.cfn_conn.Stack(stack_name)
-        first_events = []
+        aws_session, cfn_conn = self._worker_conn()
+        self.logger.info("Starting checks for deletion of stack %s" % stack.name)
 
+        if not stack.exists_in_cfn(self.cfn_all_stacks):
+            self.logger.critical("Stack %s does not exist in cloudformation, skipping..." % stack.name)
+            return None
+
+        self.logger.info("Starting to delete stacks %s" % stack.name)
         try:
-            cfstack_obj.reload()
-            events = self.cfn_conn.Stack(stack_name).events.all()
-        except ClientError as exception:
-            if (str(exception.response['Error']['Message']) == "Stack with id %s does not exist" % (stack_name)):
-                return "STACK_GONE"
+            with self._scope(stack.cfn_stack_name, 'deploy'):
+                cursor = EventCursor(cfn_conn.meta.client, stack.cfn_stack_name)
+                cursor.prime()
+                cfn_conn.Stack(stack.cfn_stack_name).delete()
+        except  Exception as exception:
+            self.logger.critical("Deleting stack %s failed. Error: %s" % (stack.cfn_stack_name, exception))
+            exit(1)
+        return cursor
+
+    def _finish_delete(self, stack, delete_result):
+        if (delete_result != "DELETE_COMPLETE" and delete_result != "STACK_GONE"):
+            self.logger.critical("Stack %s didn't get deleted correctly, Status is now %s", stack.cfn_stack_name, delete_result)
+            exit(1)
 
-        for evt in first_events:
-            first_events.append(evt)
+        self.logger.info("Finished deleting Stack: %s", stack.cfn_stack_name)
+        stack.last_operation = 'delete'
+        self._stack_changed(stack)
+        if self.deploy_state is not None:
+            self.deploy_state.forget(self.target_name, stack.cfn_stack_name)
 
-        self.logger.info("All events for the stack - %s :", self.name)
+    # Check whether a cloudformation error means the stack is gone
+    _stack_gone = staticmethod(stack_gone)
 
+    def _poll_stack(self, stack_name, cursor, cfn_conn=None):
+        """
+        One watch cycle: current status of the stack and its events since the last poll.
+        Status is STACK_GONE when the stack doesn't exist anymore, other API errors are raised
+        """
+        if cfn_conn is None:
+            cfn_conn = self._worker_conn()[1]
         try:
-            for evt in reversed(first_events):
-                self.logger.info("%s %s %s %s %s %s" % (
-                    evt.timestamp.isoformat(),
-                    evt.resource_status,
-                    evt.resource_type,
-                    evt.logical_resource_id,
-                    evt.physical_resource_id,
-                    evt.resource_status_reason,
-                ))
+            with self._scope(stack_name, 'watch'):
+                cfstack_obj = cfn_conn.Stack(stack_name)
+                cfstack_obj.reload()
+                status = str(cfstack_obj.stack_status)
+                new_events = cursor.poll()
         except ClientError as exception:
-            self.logger.critical("Error reading events list : " + str(exception))
+            if self._stack_gone(exception, stack_name):
+                return "STACK_GONE", []
+            raise
+        return status, new_events
+
+    def _log_events(self, stack_name, new_events, pages):
+        self.logger.info("Fetched %s new events for the stack - %s using %s API pages",
+                         len(new_events), stack_name, pages)
+        for evt in new_events:
+            self.logger.info("%s %s %s %s %s %s" % (
+                evt['Timestamp'].isoformat(),
+                evt['ResourceStatus'],
+                evt['ResourceType'],
+                evt['LogicalResourceId'],
+                evt.get('PhysicalResourceId'),
+                evt.get('ResourceStatusReason'),
+            ))
 
-        status = str(cfstack_obj.stack_status)
+    # Watch cloudformation events for all action
+    def watch_events(self, stack_name, while_status, cfn_conn=None, cursor=None):
+        """
+        Stay and watch cloudformation events till 'while_status'.
+        Every poll fetches only events newer than the cursor position. Pass a cursor primed
+        before the operation started, otherwise events before this call are not reported
+        """
+        if cfn_conn is None:
+            cfn_conn = self.cfn_conn
 
-        while status in while_status:
-            self.logger.info("Fetching new events for the stack - %s :", self.name)
-            new_events = []
-            event_to_log = []
+        if cursor is None:
+            cursor = EventCursor(cfn_conn.meta.client, stack_name)
             try:
-                cfstack_obj.reload()
-                events = self.cfn_conn.Stack(stack_name).events.all()
+                cursor.prime()
             except ClientError as exception:
-                if (str(exception.response['Error']['Message']) == "Stack with id %s does not exist" % (stack_name)):
+                if self._stack_gone(exception, stack_name):
                     return "STACK_GONE"
+                self.logger.critical("Error reading events list : " + str(exception))
 
-            for evt in events:
-                new_events.append(evt)
-
-            event_to_log = [evt for evt in new_events if evt not in first_events]
+        self.logger.info("Events for the stack - %s :", stack_name)
 
+        poll_interval = PollInterval()
+        status = None
+        while True:
             try:
-                for evt in reversed(event_to_log):
-                    self.logger.info("%s %s %s %s %s %s" % (
-                        evt.timestamp.isoformat(),
-                        evt.resource_status,
-                        evt.resource_type,
-                        evt.logical_resource_id,
-                        evt.physical_resource_id,
-                        evt.resource_status_reason,
-                    ))
+                status, new_events = self._poll_stack(stack_name, cursor, cfn_conn)
             except ClientError as exception:
                 self.logger.critical("Error reading events list : " + str(exception))
+                return str(status)
 
-            try:
-                status = str(cfstack_obj.stack_status)
-            except ClientError as exception:
-                if (str(exception.response['Error']['Message']) == "Stack with id %s does not exist" % (stack_name)):
-                    return "STACK_GONE"
+            if status == "STACK_GONE":
+                return status
+
+            self._log_events(stack_name, new_events, cursor.last_poll_pages)
+            if new_events:
+                poll_interval.reset()
 
-            first_events = new_events
+            if status not in while_status:
+                break
 
-            self.logger.info("Waiting 5 Sec to fetch log for the stack - %s :", self.name)
+            wait_time = poll_interval.next()
+            self.logger.info("Waiting %s Sec to fetch log for the stack - %s :", wait_time, stack_name)
 
-            time.sleep(5)
+            time.sleep(wait_time)
 
         return status
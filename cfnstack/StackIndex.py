@@ -0,0 +1,78 @@
+import logging
+import threading
+
+from botocore.exceptions import ClientError
+
+"""
+StackIndex is a materialized snapshot of the cloudformation stacks in the account, indexed by stack name.
+The account is listed once, after an operation only the affected stack is reloaded
+with a single DescribeStacks call. When the run is limited to a few stacks only those are described
+"""
+
+# Up to this many named stacks are described one by one instead of listing the account
+NAMED_LOAD_LIMIT = 20
+
+class StackIndex(object):
+
+    def __init__(self, cfn_conn, names=None):
+        self.logger = logging.getLogger(__name__)
+        self.cfn_conn = cfn_conn
+        # Stack names the index is limited to, None indexes the whole account
+        self.names = names
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """
+        List every stack in the account and rebuild the index.
+        A short list of names is described stack by stack instead
+        """
+        if self.names is not None and len(self.names) <= NAMED_LOAD_LIMIT:
+            with self._lock:
+                self._stacks = {}
+            for stack_name in self.names:
+                self.refresh(stack_name)
+            self.logger.debug("Loaded %s of %s named cloudformation stacks", len(self._stacks), len(self.names))
+            return
+        stacks = {}
+        for stack in self.cfn_conn.stacks.all():
+            stacks[str(stack.stack_name)] = stack
+        with self._lock:
+            self._stacks = stacks
+        self.logger.debug("Loaded %s cloudformation stacks", len(stacks))
+
+    def refresh(self, stack_name, cfn_conn=None):
+        """
+        Reload a single stack after it was created, updated or deleted.
+        Return the stack, or None when it doesn't exist anymore
+        """
+        if cfn_conn is None:
+            cfn_conn = self.cfn_conn
+        stack = cfn_conn.Stack(stack_name)
+        try:
+            stack.load()
+        except ClientError as exception:
+            if str(exception.response['Error']['Message']) == "Stack with id %s does not exist" % stack_name:
+                stack = None
+            else:
+                raise
+
+        with self._lock:
+            if stack is None or stack.stack_status == 'DELETE_COMPLETE':
+                self._stacks.pop(stack_name, None)
+                return None
+            self._stacks[stack_name] = stack
+        return stack
+
+    def get(self, stack_name):
+        return self._stacks.get(stack_name)
+
+    def __contains__(self, stack_name):
+        return stack_name in self._stacks
+
+    def __iter__(self):
+        return iter(list(self._stacks.values()))
+
+    def __len__(self):
+        return len(self._stacks)
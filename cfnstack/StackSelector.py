@@ -0,0 +1,74 @@
+import fnmatch
+import logging
+import re
+
+"""
+StackSelector resolves -s/--stack selectors against the dependencies listed in the YAML file,
+before any CFNStack object is built or AWS is called. A selector is a list of terms separated by
+commas or spaces. Each term is a stack name or a glob, optionally marked with +:
+vpc+ selects vpc and every stack depending on it, +nat selects nat and every stack it depends on,
++app+ selects both directions
+"""
+
+
+class SelectorError(Exception):
+    """
+    Selector is malformed or one of its terms matches no stack
+    """
+
+
+class StackSelector(object):
+
+    def __init__(self, stacks):
+        """
+        stacks maps the stack names of the YAML file to their definitions
+        """
+        self.logger = logging.getLogger(__name__)
+        self.names = list(stacks.keys())
+        # stack name -> stack names it depends on
+        self.deps = {}
+        for name, definition in stacks.items():
+            depends = definition.get('depends') if type(definition) is dict else None
+            self.deps[name] = [dep for dep in (depends or []) if dep in stacks and dep != name]
+        # stack name -> stack names depending on it
+        self.dependents = dict((name, []) for name in self.names)
+        for name, deps in self.deps.items():
+            for dep in deps:
+                self.dependents[dep].append(name)
+
+    @staticmethod
+    def terms(selector):
+        return [term for term in re.split(r'[,\s]+', selector.strip()) if term]
+
+    @staticmethod
+    def _closure(names, edges):
+        """
+        names plus every stack reachable from them through edges
+        """
+        reached = set(names)
+        todo = list(names)
+        while todo:
+            for other in edges[todo.pop()]:
+                if other not in reached:
+                    reached.add(other)
+                    todo.append(other)
+        return reached
+
+    def select(self, selector):
+        """
+        Stack names matched by selector in YAML order, SelectorError when a term matches nothing
+        """
+        selected = set()
+        for term in self.terms(selector):
+            pattern = term.strip('+')
+            if not pattern:
+                raise SelectorError("Invalid stack selector '%s'" % term)
+            matched = [name for name in self.names if fnmatch.fnmatchcase(name, pattern)]
+            if not matched:
+                raise SelectorError("No stack in the YAML file matches '%s'" % term)
+            selected.update(matched)
+            if term.startswith('+'):
+                selected.update(self._closure(matched, self.deps))
+            if term.endswith('+'):
+                selected.update(self._closure(matched, self.dependents))
+        return [name for name in self.names if name in selected]
@@ -0,0 +1,367 @@
+import contextlib
+import logging
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from cfnstack.RateLimiter import PollInterval
+
+"""
+StackWatcher tails any number of stack operations in flight from one poller thread.
+Workers start an operation, hand its event cursor to watch() and sleep until the poller sees
+the stack leave its in progress status. Every cycle reads the status of all watched stacks with
+one ListStacks call filtered on in progress statuses, only the stacks that left it are described
+by name. A single watched stack is described by name. Events are fetched only for stacks whose
+status or LastUpdatedTime changed, or whose events were not read for event_interval seconds.
+API errors are retried on the next cycle, a stack fails only after max_errors errors in a row.
+The events of all stacks are logged as one stream in time order, each line prefixed with the
+stack name.
+With an EventQueue the watcher is pushed the events cloudformation publishes to the SNS topics of the
+stacks instead, and stack level events drive the status of the stacks. Only stacks nothing was heard
+of for fallback_after seconds are polled, so a topic that stops delivering costs time but not correctness
+"""
+
+# Stack status of every operation still running, the filter of ListStacks
+IN_PROGRESS_STATUS = [
+    'CREATE_IN_PROGRESS', 'ROLLBACK_IN_PROGRESS', 'DELETE_IN_PROGRESS',
+    'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS',
+    'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS',
+    'REVIEW_IN_PROGRESS', 'IMPORT_IN_PROGRESS', 'IMPORT_ROLLBACK_IN_PROGRESS',
+]
+
+
+def stack_gone(exception, stack_name):
+    """
+    Check whether a cloudformation error means the stack doesn't exist
+    """
+    message = str(exception.response['Error']['Message'])
+    return message in ("Stack with id %s does not exist" % stack_name, "Stack [%s] does not exist" % stack_name)
+
+
+class Watch(object):
+
+    def __init__(self, stack_name, while_status, cursor, callback=None, pushed=False):
+        self.stack_name = stack_name
+        self.while_status = while_status
+        self.cursor = cursor
+        # Called with the final status from the poller thread
+        self.callback = callback
+        # Notifications of the stack arrive through the event queue, otherwise it is polled
+        self.pushed = pushed
+        self.status = None
+        # (StackStatus, LastUpdatedTime) when events were last fetched
+        self.version = None
+        self.events_read = 0.0
+        # API errors in a row while reading the stack
+        self.errors = 0
+        # Last time the stack was polled or a notification about it arrived
+        self.heard = time.monotonic()
+        self.done = threading.Event()
+
+
+class StackWatcher(object):
+
+    def __init__(self, cf_client, name='', scope=None, event_interval=60.0, event_queue=None, fallback_after=60.0,
+                 receive_wait=10, max_errors=5):
+        self.logger = logging.getLogger(__name__)
+        self.cf_client = cf_client
+        # Name of the poller thread, also the target name for API metrics
+        self.name = name
+        # Callable returning a context manager that attributes API calls to a stack, see ApiMetrics.scope
+        self.scope = scope
+        # Fetch events of an unchanged stack at least this often, resources change before the stack does
+        self.event_interval = event_interval
+        # EventQueue pushing the notifications of the stacks, None to only poll
+        self.event_queue = event_queue
+        # Poll a stack when no notification about it arrived for this long
+        self.fallback_after = fallback_after
+        # Seconds a receive from the event queue waits for notifications
+        self.receive_wait = receive_wait
+        # A stack whose status or events can't be read this many cycles in a row fails with status None
+        self.max_errors = max_errors
+        self.cycles = 0
+        self.event_fetches = 0
+        self.pushed_events = 0
+        # stack name -> (arrival time, event) of notifications that arrived before the stack was watched
+        self._unclaimed = {}
+        # stack name -> Watch
+        self._watches = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='%swatcher' % self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def add(self, stack_name, while_status, cursor, callback=None, pushed=False):
+        """
+        Start watching a stack without waiting for it, callback(status) is called once its status leaves while_status.
+        pushed tells the stack publishes its events to a topic of the event queue
+        """
+        watch = Watch(stack_name, while_status, cursor, callback, pushed and self.event_queue is not None)
+        self.logger.info("Events for the stack - %s :", stack_name)
+        with self._lock:
+            self._watches[stack_name] = watch
+        self._wakeup.set()
+        return watch
+
+    def watch(self, stack_name, while_status, cursor, pushed=False):
+        """
+        Block until the status of the stack leaves while_status and return it.
+        Status is STACK_GONE when the stack doesn't exist anymore, None when it could not be read
+        """
+        watch = self.add(stack_name, while_status, cursor, pushed=pushed)
+        watch.done.wait()
+        return watch.status
+
+    def _scope(self, stack_name=''):
+        if self.scope is None:
+            return contextlib.nullcontext()
+        return self.scope(stack_name, 'watch')
+
+    def _finish(self, watch, status):
+        watch.status = status
+        with self._lock:
+            self._watches.pop(watch.stack_name, None)
+        watch.done.set()
+        if watch.callback is not None:
+            watch.callback(status)
+
+    def _describe_one(self, name, stacks, failed):
+        try:
+            with self._scope(name):
+                response = self.cf_client.describe_stacks(StackName=name)
+        except ClientError as exception:
+            if not stack_gone(exception, name):
+                self.logger.warning("Error reading status of stack %s : %s", name, exception)
+                failed.add(name)
+            return
+        for cf_stack in response['Stacks']:
+            stacks[cf_stack['StackName']] = cf_stack
+
+    def _describe(self, names):
+        """
+        Status and LastUpdatedTime of the watched stacks by name, and the names that could not be read.
+        Stacks missing from both don't exist anymore. ClientError is raised when ListStacks fails
+        """
+        stacks = {}
+        failed = set()
+        if len(names) == 1:
+            self._describe_one(names[0], stacks, failed)
+            return stacks, failed
+
+        wanted = set(names)
+        with self._scope():
+            paginator = self.cf_client.get_paginator('list_stacks')
+            for page in paginator.paginate(StackStatusFilter=IN_PROGRESS_STATUS):
+                for summary in page['StackSummaries']:
+                    if summary['StackName'] in wanted:
+                        stacks[summary['StackName']] = summary
+        # Only stacks whose operation ended are described
+        for name in names:
+            if name not in stacks:
+                self._describe_one(name, stacks, failed)
+        return stacks, failed
+
+    def _read_events(self, watch, events):
+        """
+        Add the new events of a stack to events, False when the stack is gone
+        """
+        try:
+            with self._scope(watch.stack_name):
+                new_events = watch.cursor.poll()
+        except ClientError as exception:
+            if stack_gone(exception, watch.stack_name):
+                return False
+            raise
+        watch.events_read = time.monotonic()
+        self.event_fetches += 1
+        events.extend((watch.stack_name, event) for event in new_events)
+        return True
+
+    def _log_events(self, events):
+        events.sort(key=lambda item: item[1]['Timestamp'])
+        for stack_name, evt in events:
+            self.logger.info("[%s] %s %s %s %s %s %s" % (
+                stack_name,
+                evt['Timestamp'].isoformat(),
+                evt['ResourceStatus'],
+                evt['ResourceType'],
+                evt['LogicalResourceId'],
+                evt.get('PhysicalResourceId'),
+                evt.get('ResourceStatusReason'),
+            ))
+
+    def _cycle(self, watches):
+        """
+        Poll the watched stacks once, True when any of them made progress
+        """
+        try:
+            described, failed = self._describe([watch.stack_name for watch in watches])
+        except ClientError as exception:
+            self.logger.warning("Error reading stacks status : %s", exception)
+            described, failed = {}, set(watch.stack_name for watch in watches)
+
+        events = []
+        finished = []
+        progress = False
+        for watch in watches:
+            if watch.stack_name in failed:
+                if self._failed_read(watch):
+                    finished.append((watch, None))
+                continue
+            cf_stack = described.get(watch.stack_name)
+            if cf_stack is None:
+                finished.append((watch, "STACK_GONE"))
+                continue
+            status = str(cf_stack['StackStatus'])
+            version = (status, cf_stack.get('LastUpdatedTime'))
+            in_progress = status in watch.while_status
+            if (version != watch.version or not in_progress
+                    or time.monotonic() - watch.events_read >= self.event_interval):
+                progress = progress or version != watch.version
+                watch.version = version
+                try:
+                    if not self._read_events(watch, events):
+                        status = "STACK_GONE"
+                        in_progress = False
+                except ClientError as exception:
+                    self.logger.warning("Error reading events list of stack %s : %s", watch.stack_name, exception)
+                    # Read the events again next cycle
+                    watch.version = None
+                    if self._failed_read(watch):
+                        finished.append((watch, None))
+                    continue
+            watch.errors = 0
+            if not in_progress:
+                finished.append((watch, status))
+
+        if events:
+            progress = True
+            self._log_events(events)
+        for watch, status in finished:
+            progress = True
+            self._finish(watch, status)
+        return progress
+
+    def _failed_read(self, watch):
+        """
+        Count a failed read of a stack, True when it failed max_errors times in a row
+        """
+        watch.errors += 1
+        if watch.errors < self.max_errors:
+            return False
+        self.logger.critical("Giving up watching stack %s after %s errors in a row", watch.stack_name, watch.errors)
+        return True
+
+    def _push_cycle(self, watches):
+        """
+        Poll the stacks no notification arrived for lately, then wait for notifications.
+        True when any stack made progress
+        """
+        progress = False
+        silent = [watch for watch in watches if watch.pushed and time.monotonic() - watch.heard >= self.fallback_after]
+        if silent:
+            self.logger.info("No notifications for the stacks - %s in %s Sec, polling them",
+                             ", ".join(watch.stack_name for watch in silent), self.fallback_after)
+        polled = silent + [watch for watch in watches
+                           if not watch.pushed and time.monotonic() - watch.heard >= self.receive_wait]
+        if polled:
+            progress = self._cycle(polled)
+            for watch in polled:
+                watch.heard = time.monotonic()
+
+        try:
+            received = self.event_queue.receive(self.receive_wait)
+        except ClientError as exception:
+            self.logger.warning("Reading queue %s failed, polling stacks from now on. Error: %s",
+                                self.event_queue.name, exception)
+            self.event_queue = None
+            return progress
+
+        now = time.monotonic()
+        by_stack = {}
+        for event in received:
+            by_stack.setdefault(event['StackName'], []).append(event)
+        with self._lock:
+            watches = dict((name, watch) for name, watch in self._watches.items() if watch.pushed)
+            for stack_name in list(self._unclaimed):
+                self._unclaimed[stack_name] = [(arrived, event) for arrived, event in self._unclaimed[stack_name]
+                                               if now - arrived < self.fallback_after]
+                if not self._unclaimed[stack_name]:
+                    del self._unclaimed[stack_name]
+            for stack_name, stack_events in by_stack.items():
+                if stack_name not in watches:
+                    self._unclaimed.setdefault(stack_name, []).extend((now, event) for event in stack_events)
+
+        events = []
+        finished = []
+        for watch in watches.values():
+            with self._lock:
+                unclaimed = self._unclaimed.pop(watch.stack_name, [])
+            stack_events = by_stack.get(watch.stack_name, []) + [event for arrived, event in unclaimed]
+            new_events = watch.cursor.push(stack_events)
+            if not new_events:
+                continue
+            watch.heard = now
+            self.pushed_events += len(new_events)
+            events.extend((watch.stack_name, event) for event in new_events)
+            status = None
+            for event in new_events:
+                if event['ResourceType'] == 'AWS::CloudFormation::Stack' and event['LogicalResourceId'] == watch.stack_name:
+                    status = event['ResourceStatus']
+            if status is not None and status not in watch.while_status:
+                finished.append((watch, status))
+
+        if events:
+            progress = True
+            self._log_events(events)
+        for watch, status in finished:
+            self._finish(watch, status)
+        return progress
+
+    def _loop(self):
+        poll_interval = PollInterval()
+        while not self._stopped:
+            self._wakeup.clear()
+            with self._lock:
+                watches = list(self._watches.values())
+            if not watches:
+                self._wakeup.wait()
+                poll_interval.reset()
+                continue
+
+            self.cycles += 1
+            try:
+                if self.event_queue is not None:
+                    # Receiving from the queue waits for notifications, no sleep needed
+                    self._push_cycle(watches)
+                    continue
+                progress = self._cycle(watches)
+            except Exception as exception:
+                self.logger.critical("Watching stacks failed. Error: %s" % exception)
+                for watch in watches:
+                    self._finish(watch, None)
+                continue
+            if progress:
+                poll_interval.reset()
+
+            with self._lock:
+                waiting = sorted(self._watches)
+            if not waiting:
+                continue
+            wait_time = poll_interval.next()
+            self.logger.info("Waiting %s Sec to fetch log for the stacks - %s :", wait_time, ", ".join(waiting))
+            # New watches wake the poller early so their first poll isn't delayed
+            self._wakeup.wait(wait_time)
+
@@ -0,0 +1,76 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+
+import simplejson
+
+"""
+TemplateCache parses cloudformation templates once per process.
+Entries are keyed by path, modification time and size, so a template shared by many stacks
+is read, parsed and canonicalized only once. Each entry holds the parsed template, its compact
+canonical body sent as TemplateBody and the SHA-256 of that body
+"""
+
+# Maximum size of TemplateBody accepted by cloudformation API
+TEMPLATE_BODY_LIMIT = 51200
+
+
+class Template(object):
+
+    def __init__(self, path, parsed):
+        self.path = path
+        self.parsed = parsed
+        self.body = simplejson.dumps(parsed, sort_keys=True, separators=(',',':'))
+        self.sha256 = hashlib.sha256(self.body.encode('utf-8')).hexdigest()
+        self.size = len(self.body.encode('utf-8'))
+
+
+class TemplateCache(object):
+
+    def __init__(self, mmap_threshold=256 * 1024):
+        self.logger = logging.getLogger(__name__)
+        # Files of this size or bigger are read through mmap
+        self.mmap_threshold = mmap_threshold
+        self.hits = 0
+        self.misses = 0
+        # path -> ((mtime, size), Template)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _read(self, path, size):
+        with open(path, 'rb') as template_file:
+            if size >= self.mmap_threshold:
+                with mmap.mmap(template_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return mapped[:]
+            return template_file.read()
+
+    def load(self, path):
+        """
+        Return the Template for path, parsing the file only when it changed since the last load
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        template = Template(path, simplejson.loads(self._read(path, stat.st_size).decode('utf-8')))
+        if template.size > TEMPLATE_BODY_LIMIT:
+            self.logger.warning("Template %s is %s bytes, bigger than the %s bytes TemplateBody limit, "
+                                "set template-bucket to pass it as TemplateURL",
+                                path, template.size, TEMPLATE_BODY_LIMIT)
+
+        with self._lock:
+            self._entries[path] = (key, template)
+        return template
+
+
+# Process wide cache shared by all CFNStack objects
+TEMPLATE_CACHE = TemplateCache()
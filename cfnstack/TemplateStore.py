@@ -0,0 +1,170 @@
+import datetime
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import simplejson
+from botocore.exceptions import ClientError
+
+"""
+TemplateStore uploads templates to an S3 bucket under the SHA-256 of their compact body,
+so create, update and createcs can pass TemplateURL instead of sending the body with every call.
+This also lifts the 51,200 bytes TemplateBody limit. A template is uploaded once: a HEAD request
+skips the upload when the object already exists, and a local manifest of uploaded objects skips
+even the HEAD request. The S3 endpoint follows the boto3 configuration, AWS_ENDPOINT_URL_S3
+points it at a local S3 compatible stand-in
+"""
+
+# Bump when the manifest format changes
+MANIFEST_VERSION = 1
+
+# HEAD error codes meaning the object is not there
+MISSING_OBJECT_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+# HEAD error codes of a denied request. S3 also answers 403 for a missing object without s3:ListBucket
+DENIED_CODES = ('403', 'AccessDenied', 'Forbidden')
+
+
+class TemplateStore(object):
+
+    def __init__(self, s3_client, bucket, prefix='cfnstack/templates', cache_dir=None, manifest_max_age=7 * 86400):
+        self.logger = logging.getLogger(__name__)
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        if cache_dir is None:
+            cache_dir = os.environ.get('CFNSTACK_CACHE_DIR',
+                                       os.path.join(os.path.expanduser('~'), '.cache', 'cfnstack'))
+        # Empty cache_dir disables the manifest, every template is checked with HEAD
+        self.cache_dir = cache_dir
+        # Manifest entries older than this are checked again, in case a bucket lifecycle rule removed them
+        self.manifest_max_age = manifest_max_age
+        self.endpoint = s3_client.meta.endpoint_url.rstrip('/')
+        self.uploads = 0
+        self.head_hits = 0
+        self.manifest_hits = 0
+        # Templates uploaded because HEAD was denied
+        self.head_denied = 0
+        # "endpoint/bucket/key" -> upload time
+        self._manifest = self._read_manifest()
+        self._manifest_changed = False
+        # Stacks sharing a template wait for one upload instead of uploading it again
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _manifest_path(self):
+        return os.path.join(self.cache_dir, 'templates-manifest.json')
+
+    def _read_manifest(self):
+        if not self.cache_dir:
+            return {}
+        try:
+            with open(self._manifest_path()) as manifest_file:
+                data = simplejson.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            return {}
+        if data.get('version') != MANIFEST_VERSION:
+            return {}
+        return data.get('objects', {})
+
+    def save_manifest(self):
+        """
+        Write the manifest atomically when templates were uploaded or found in the bucket
+        """
+        with self._lock:
+            if not self.cache_dir or not self._manifest_changed:
+                return
+            objects = dict(self._manifest)
+            self._manifest_changed = False
+        # Merge with the entries other targets or runs wrote meanwhile
+        current = self._read_manifest()
+        current.update(objects)
+        objects = current
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.templates-manifest-')
+            with os.fdopen(handle, 'w') as manifest_file:
+                simplejson.dump({'version': MANIFEST_VERSION, 'objects': objects}, manifest_file, indent=4, sort_keys=True)
+            os.replace(tmp_path, self._manifest_path())
+        except (IOError, OSError) as exception:
+            self.logger.debug("Could not write template manifest %s: %s", self._manifest_path(), exception)
+
+    def key(self, template):
+        return '%s/%s.json' % (self.prefix, template.sha256) if self.prefix else '%s.json' % template.sha256
+
+    def url(self, key):
+        """
+        TemplateURL of an object, virtual hosted on AWS and path style on any other endpoint
+        """
+        if self.endpoint.endswith('.amazonaws.com'):
+            return 'https://%s.s3.%s.amazonaws.com/%s' % (self.bucket, self.s3_client.meta.region_name, key)
+        return '%s/%s/%s' % (self.endpoint, self.bucket, key)
+
+    def _in_manifest(self, manifest_key):
+        uploaded = self._manifest.get(manifest_key)
+        return uploaded is not None and time.time() - uploaded < self.manifest_max_age
+
+    def _exists(self, key):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as exception:
+            code = str(exception.response['Error']['Code'])
+            if code in MISSING_OBJECT_CODES:
+                return False
+            if code in DENIED_CODES:
+                with self._lock:
+                    self.head_denied += 1
+                    first = self.head_denied == 1
+                if first:
+                    self.logger.warning("HEAD of s3://%s/%s is denied, templates are uploaded without checking the bucket. "
+                                        "Grant s3:GetObject and s3:ListBucket on %s to skip uploads of stored templates",
+                                        self.bucket, key, self.bucket)
+                return False
+            raise
+        return True
+
+    def template_url(self, template):
+        """
+        Upload template unless the bucket already holds it and return its TemplateURL.
+        ClientError is raised when the bucket can't be read or written
+        """
+        key = self.key(template)
+        manifest_key = '%s/%s/%s' % (self.endpoint, self.bucket, key)
+        with self._lock:
+            if self._in_manifest(manifest_key):
+                self.manifest_hits += 1
+                return self.url(key)
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                if self._in_manifest(manifest_key):
+                    self.manifest_hits += 1
+                    return self.url(key)
+            if self._exists(key):
+                self.logger.debug("Template %s is already stored as s3://%s/%s", template.path, self.bucket, key)
+                with self._lock:
+                    self.head_hits += 1
+            else:
+                self.logger.info("Uploading template %s (%s bytes) to s3://%s/%s", template.path, template.size, self.bucket, key)
+                self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=template.body.encode('utf-8'),
+                                          ContentType='application/json',
+                                          Metadata={'source': os.path.basename(template.path),
+                                                    'uploaded': datetime.datetime.utcnow().isoformat()})
+                with self._lock:
+                    self.uploads += 1
+            with self._lock:
+                self._manifest[manifest_key] = time.time()
+                self._manifest_changed = True
+        return self.url(key)
+
+    def log_summary(self):
+        if not (self.uploads or self.head_hits or self.manifest_hits):
+            return
+        self.logger.info("Templates uploaded: %s, found in bucket: %s, found in manifest: %s",
+                         self.uploads, self.head_hits, self.manifest_hits)
+        if self.head_denied:
+            self.logger.warning("%s templates were uploaded because HEAD was denied on bucket %s",
+                                self.head_denied, self.bucket)
@@ -5,9 +5,19 @@ Entry program for CFNStack project. This program evaluates parameters passed and
 """
 
 import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import argparse
 
+from cfnstack.ApiMetrics import ApiMetrics
+from cfnstack.AsyncEngine import AsyncEngine
+from cfnstack.ChangeSetLister import NdjsonWriter
+from cfnstack.ConfigLoader import ConfigLoader
+from cfnstack.DeployPlan import DeployPlan, PlanError
+from cfnstack.DeployJournal import DeployJournal, JournalError
+from cfnstack.DeployState import DeployState
 from cfnstack.StackGlue import StackGlue
 
 
@@ -19,19 +29,58 @@ def main():
     arg_parser.add_argument('-y', '--yamlfile', dest='yamlfile', required=True,
                             help="The yaml file where stacks,params & dependency definition exists")
     arg_parser.add_argument('-a', '--action', dest='action', required=True,
-                            choices=['apply','update','createcs','listcs','applycs','deletecs','delete'],
-                            help="Action to be performed : apply - Create Cloudformation stacks, update - Update CF stacks (Better use change sets)"
+                            choices=['apply','plan','update','createcs','listcs','applycs','deletecs','delete'],
+                            help="Action to be performed : apply - Create Cloudformation stacks, plan - Show which stacks apply would create or update, update - Update CF stacks (Better use change sets)"
                                  ", createcs - Create Change sets on given stack, listcs - List Change sets on given Stack, applycs - Apply Change Sets on given stack,"
                                  " deletecs - Delete change sets on given stack, delete - Delete Cloudformation stacks")
     arg_parser.add_argument('-l','--logging', dest='loglevel', required=False, default="info",
                             choices=['critical','error','warning','info' or 'debug'], help='Log level for output messages,''critical,error,warning,info,debug')
     arg_parser.add_argument('-L','--botolog',dest='botolog',required=False,default='critical',
                             choices=['critical','error','warning','info' or 'debug'], help='Log level for boto,''critical,error,warning,info,debug')
-    arg_parser.add_argument('-s','--stack',dest='stackname',required=False, help='Stack Name. It can be called with individual action also')
+    arg_parser.add_argument('-s','--stack',dest='stackname',required=False,
+                            help='Stacks to run the action on, all stacks when not given. Comma separated names or globs, name+ adds the stacks depending on it, '
+                                 '+name adds the stacks it depends on. Only the selected stacks are loaded')
     arg_parser.add_argument('-c', '--changesetname', dest='changesetname', required=False,
                             help='Change Set name to be applied on stack to update')
     arg_parser.add_argument('-p', '--profile', dest='profile', required=False,
-                            help='AWS configure profile name to be used. If not provided, default profile will be used. This could be useful to use with federated IAM USER')
+                            help='AWS configure profile name to be used. If not provided, default profile will be used. This could be useful to use with federated IAM USER. '
+                                 'With a deployment matrix, only this profile of the matrix is deployed')
+    arg_parser.add_argument('-m', '--max-parallel', dest='max_parallel', required=False, type=int, default=1,
+                            help='Maximum number of independent stacks deployed at the same time. A stack is started as soon as all stacks it depends on are complete. Default is 1')
+    arg_parser.add_argument('-t', '--max-targets', dest='max_targets', required=False, type=int, default=0,
+                            help='Maximum number of region/profile targets of the deployment matrix processed at the same time. Default is all of them')
+    arg_parser.add_argument('--max-pool-connections', dest='max_pool_connections', required=False, type=int, default=10,
+                            help='Size of the HTTP connection pool of each AWS client. Default is 10')
+    arg_parser.add_argument('-r', '--api-rate', dest='api_rate', required=False, type=float, default=4.0,
+                            help='Maximum cloudformation API calls per second shared by all workers. The rate is lowered automatically when AWS throttles requests. Default is 4')
+    arg_parser.add_argument('-e', '--engine', dest='engine', required=False, default='sync', choices=['sync', 'async'],
+                            help='Execution backend. sync runs one thread per stack in flight, async runs apply, update, delete and listcs on an asyncio event loop '
+                                 'with a small pool of threads for API calls. Default is sync')
+    arg_parser.add_argument('--api-workers', dest='api_workers', required=False, type=int, default=16,
+                            help='Threads running blocking AWS API calls for the async engine. Default is 16')
+    arg_parser.add_argument('--events', dest='events', required=False, default='poll', choices=['poll', 'push'],
+                            help='How stack events are followed. poll reads them with DescribeStackEvents, push subscribes a temporary SQS queue '
+                                 'to the sns-topic-arn topics of the stacks and polls only when notifications stop arriving. Default is poll')
+    arg_parser.add_argument('--plan', dest='plan', required=False,
+                            help='Plan file. The plan action writes it (default cfnstack.plan.json), apply deploys only the stacks it lists as changed')
+    arg_parser.add_argument('--state', dest='state', required=False,
+                            help='State file of incremental deploys. apply skips stacks whose template, parameters and upstream '
+                                 'stacks did not change since the last deploy recorded in it, apply, update and delete keep it current')
+    arg_parser.add_argument('--journal', dest='journal', required=False,
+                            help='Append-only journal apply, update and delete record every stack they start, complete or fail in')
+    arg_parser.add_argument('--resume', dest='resume', required=False, action='store_true',
+                            help='Continue the last run of the --journal file, stacks it completed are skipped without checks')
+    arg_parser.add_argument('--template-bucket', dest='template_bucket', required=False,
+                            help='S3 bucket templates are uploaded to and passed to cloudformation as TemplateURL. '
+                                 'Overrides template-bucket of the YAML file')
+    arg_parser.add_argument('-o', '--output', dest='output', required=False,
+                            help='File listcs writes change sets to as NDJSON, one JSON object per line. Default is standard output')
+    arg_parser.add_argument('--summaries-only', dest='summaries_only', required=False, action='store_true',
+                            help='listcs writes only change set summaries without describing their changes')
+    arg_parser.add_argument('--metrics-json', dest='metrics_json', required=False,
+                            help='Write a JSON summary of the cloudformation API calls by operation, stack and phase to this file')
+    arg_parser.add_argument('--metrics-prom', dest='metrics_prom', required=False,
+                            help='Write the API call metrics to this file in Prometheus textfile format')
 
     args = arg_parser.parse_args()
 
@@ -39,7 +88,7 @@ def main():
 
     #Validating action parameter. Actions in commented variable will be developed for future enhancement
     #valid_actions = ['apply','check','update','delete','watch']
-    valid_actions = ['apply', 'update', 'createcs', 'listcs', 'applycs','deletecs','delete']
+    valid_actions = ['apply', 'plan', 'update', 'createcs', 'listcs', 'applycs','deletecs','delete']
     if args.action not in valid_actions:
         print("Invalid action provided, must be one of '%s'" % (", ".join(valid_actions)))
         exit(1)
@@ -57,7 +106,16 @@ def main():
     if not isinstance(numeric_level,int):
         print('Invalid Log Level for output message - %s' % args.loglevel)
         exit(1)
+    # Parse the YAML once, targets of a deployment matrix share it
+    metrics = ApiMetrics()
+    with metrics.scope(phase='config'):
+        config = ConfigLoader().load(args.yamlfile)
+    targets = StackGlue.deployment_targets(config, args.profile)
+
     FORMAT = "%(asctime)s:%(levelname)s:%(name)s-%(module)s:%(message)s"
+    if len(targets) > 1:
+        # Worker threads are named after their profile/region target
+        FORMAT = "%(asctime)s:%(levelname)s:%(threadName)s:%(name)s-%(module)s:%(message)s"
     logging.basicConfig(level=numeric_level,format=FORMAT)
     logger = logging.getLogger(__name__)
 
@@ -66,7 +124,144 @@ def main():
         exit(1)
     logging.getLogger('boto').setLevel(level=boto_numeric_level)
 
-    glued_stack = StackGlue(args.yamlfile,args.profile)
+    if args.max_parallel < 1:
+        print('Invalid max parallel value - %s, must be 1 or more' % args.max_parallel)
+        exit(1)
+
+    if args.api_rate <= 0:
+        print('Invalid API rate - %s, must be greater than 0' % args.api_rate)
+        exit(1)
+
+    if args.max_targets < 0:
+        print('Invalid max targets value - %s' % args.max_targets)
+        exit(1)
+
+    if args.max_pool_connections < 1:
+        print('Invalid max pool connections value - %s' % args.max_pool_connections)
+        exit(1)
+
+    if args.api_workers < 1:
+        print('Invalid api workers value - %s' % args.api_workers)
+        exit(1)
+
+    plan = None
+    if args.action == 'plan':
+        plan = DeployPlan(args.yamlfile)
+    elif args.action == 'apply' and args.plan:
+        try:
+            plan = DeployPlan.load(args.plan)
+        except PlanError as exception:
+            logger.critical("%s", exception)
+            exit(1)
+
+    # Stacks completed by this run and the runs it resumes, shared by all targets
+    journal = None
+    if args.resume and not args.journal:
+        logger.critical("--resume needs the journal of the run to continue, use --journal")
+        exit(1)
+    if (args.journal or args.resume) and args.action not in ('apply', 'update', 'delete'):
+        logger.critical("--journal and --resume only apply to apply, update and delete, not %s", args.action)
+        exit(1)
+    if args.journal:
+        try:
+            if args.resume:
+                journal = DeployJournal.resume(args.journal, args.action, args.yamlfile)
+            else:
+                journal = DeployJournal.start(args.journal, args.action, args.yamlfile, args.stackname)
+        except JournalError as exception:
+            logger.critical("%s", exception)
+            exit(1)
+
+    # Stacks deployed by earlier runs, shared by all targets
+    state = None
+    if args.state and args.action in ('apply', 'update', 'delete'):
+        state = DeployState.load(args.state)
+
+    # Change sets of all targets are streamed to one NDJSON output
+    writer = None
+    if args.action == 'listcs':
+        try:
+            writer = NdjsonWriter(open(args.output, 'w') if args.output else sys.stdout)
+        except IOError as exception:
+            logger.critical("Can't open output file %s: %s", args.output, exception)
+            exit(1)
+
+    try:
+        if len(targets) == 1:
+            run_target(args, config, *targets[0], metrics=metrics, plan=plan, writer=writer, state=state, journal=journal)
+            save_plan(args, plan)
+            return
+
+        max_targets = args.max_targets or len(targets)
+        logger.info("Running %s on %s targets, %s at a time: %s", args.action, len(targets), max_targets,
+                    ["%s/%s" % target for target in targets])
+        with ThreadPoolExecutor(max_workers=max_targets) as pool:
+            futures = dict((pool.submit(_run_target_thread, args, config, profile, region, metrics, plan, writer, state, journal),
+                            (profile, region))
+                           for profile, region in targets)
+        failed = ["%s/%s" % futures[future] for future in futures if not future.result()]
+        if failed:
+            logger.critical("Action %s failed for targets: %s", args.action, failed)
+            exit(1)
+        logger.info("Action %s finished for all %s targets", args.action, len(targets))
+        save_plan(args, plan)
+    finally:
+        if journal is not None:
+            journal.close()
+        save_state(state)
+        write_metrics(args, metrics)
+
+
+def save_plan(args, plan):
+    """
+    Write the plan made by the plan action
+    """
+    if args.action != 'plan':
+        return
+    logger = logging.getLogger(__name__)
+    plan_file = args.plan or 'cfnstack.plan.json'
+    plan.save(plan_file)
+    logger.info("Plan written to %s: %s", plan_file, plan.counts())
+
+
+def save_state(state):
+    """
+    Write the state of incremental deploys, also after a failed run so finished stacks are not examined again
+    """
+    if state is None:
+        return
+    logger = logging.getLogger(__name__)
+    try:
+        state.save()
+    except (IOError, OSError) as exception:
+        logger.error("Could not write state file %s: %s", state.path, exception)
+
+
+def write_metrics(args, metrics):
+    """
+    Log the API call totals and write the metrics files requested on the command line, also after a failed run
+    """
+    logger = logging.getLogger(__name__)
+    metrics.log_summary()
+    try:
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json, {'action': args.action, 'yamlfile': args.yamlfile})
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom, args.action)
+    except (IOError, OSError) as exception:
+        logger.error("Could not write metrics: %s", exception)
+
+
+def run_target(args, config, profile, region=None, metrics=None, plan=None, writer=None, state=None, journal=None):
+    """
+    Perform the requested action for one profile/region target
+    """
+    logger = logging.getLogger(__name__)
+
+    glued_stack = StackGlue(args.yamlfile,profile,args.max_parallel,args.api_rate,region=region,config=config,
+                            max_pool_connections=args.max_pool_connections,metrics=metrics,
+                            template_bucket=args.template_bucket,selector=args.stackname,deploy_state=state,
+                            journal=journal,event_mode=args.events)
     glued_stack.sort_cf_stacks_by_deps()
 
     #Print info
@@ -75,8 +270,44 @@ def main():
     logger.info("Cloudformation stacks are processed in the following order: %s", [x.name for x in glued_stack.stack_objs])
     for stack in glued_stack.stack_objs:
         logger.debug("%s depends on %s", stack.name, stack.depends_on)
+    for level, stacks in enumerate(glued_stack.stack_levels):
+        logger.debug("Dependency level %s: %s", level, [x.name for x in stacks])
+
+    if args.action == 'plan':
+        plan.add_target(glued_stack.target_name, glued_stack.plan(args.stackname))
+        logger.info("AWS client metrics: %s", glued_stack.client_metrics())
+        return
+    if args.action == 'apply' and plan is not None:
+        try:
+            glued_stack.use_plan(plan.target(glued_stack.target_name), args.stackname)
+        except PlanError as exception:
+            logger.critical("%s", exception)
+            exit(1)
 
     # Perform action
+    try:
+        perform_action(args, glued_stack, writer)
+    finally:
+        glued_stack.save_template_manifest()
+
+    logger.info("AWS client metrics: %s", glued_stack.client_metrics())
+
+
+def perform_action(args, glued_stack, writer=None):
+    """
+    Run the requested action on the stacks of a target
+    """
+    logger = logging.getLogger(__name__)
+
+    if args.engine == 'async' and args.action in AsyncEngine.ACTIONS:
+        options = {}
+        if args.action == 'listcs':
+            options = {'writer': writer, 'summaries_only': args.summaries_only}
+        AsyncEngine(glued_stack, args.max_parallel, args.api_workers).run(args.action, args.stackname, **options)
+        return
+    if args.engine == 'async':
+        logger.info("Action %s is not supported by the async engine, running it with the sync engine", args.action)
+
     if args.action == 'apply':
         glued_stack.apply(args.stackname)
     if args.action == 'delete':
@@ -84,7 +315,7 @@ def main():
     if args.action == 'update':
         glued_stack.update(args.stackname)
     if args.action == 'listcs':
-        glued_stack.listcs(args.stackname)
+        glued_stack.listcs(args.stackname, writer, args.summaries_only)
     if args.action == 'applycs':
         if args.changesetname != None and args.stackname != None:
             glued_stack.applycs(args.stackname, args.changesetname)
@@ -92,10 +323,11 @@ def main():
             logger.critical("Change set name and stackname must be provided. Use option \"-c\" or \"--changesetname\" for changesetname, \"-s\" or \"--stackname\" for stackname .")
             exit(1)
     if args.action == 'createcs':
-        if args.changesetname != None and args.stackname != None:
+        # Without a stack name the change set is created on every stack of the project
+        if args.changesetname != None:
             glued_stack.createcs(args.stackname, args.changesetname)
         else:
-            logger.critical("Change set name and stackname must be provided. Use option \"-c\" or \"--changesetname\" for changesetname, \"-s\" or \"--stackname\" for stackname .")
+            logger.critical("Change set name must be provided. Use option \"-c\" or \"--changesetname\" for changesetname, \"-s\" or \"--stackname\" to limit it to one stack.")
             exit(1)
     if args.action == 'deletecs':
         if args.changesetname != None and args.stackname != None:
@@ -105,6 +337,17 @@ def main():
             exit(1)
 
 
+def _run_target_thread(args, config, profile, region, metrics, plan, writer, state, journal):
+    """
+    Worker of a deployment matrix, return True when the target succeeded
+    """
+    threading.current_thread().name = "%s/%s" % (profile or 'default', region or 'default')
+    try:
+        run_target(args, config, profile, region, metrics, plan, writer, state, journal)
+    except SystemExit as exception:
+        return not exception.code
+    return True
+
 
 if __name__ == '__main__':
     main()
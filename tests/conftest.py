@@ -0,0 +1,43 @@
+import pytest
+from moto import mock_aws
+
+"""
+Fixtures of the checks run against moto, the local stand-in of the AWS services.
+No AWS account or configuration is read
+"""
+
+REGION = 'us-east-1'
+
+
+@pytest.fixture
+def aws(tmp_path, monkeypatch):
+    """
+    Offline credentials and config cache, every AWS call inside the test goes to moto
+    """
+    # StackGlue opens the default profile
+    (tmp_path / 'aws-credentials').write_text('[default]\naws_access_key_id = testing\naws_secret_access_key = testing\n')
+    (tmp_path / 'aws-config').write_text('[default]\nregion = %s\n' % REGION)
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_PROFILE'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / 'aws-config'))
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(tmp_path / 'aws-credentials'))
+    monkeypatch.setenv('CFNSTACK_CACHE_DIR', str(tmp_path / 'cache'))
+    with mock_aws():
+        yield
+
+
+@pytest.fixture
+def template(tmp_path):
+    """
+    Path of a template of wait condition handles with one parameter and one output
+    """
+    path = tmp_path / 'stack.template'
+    path.write_text('''{
+    "AWSTemplateFormatVersion": "2010-09-09",
+    "Parameters": {"revision": {"Type": "String"}},
+    "Resources": {"Res0": {"Type": "AWS::CloudFormation::WaitConditionHandle"},
+                  "Res1": {"Type": "AWS::CloudFormation::WaitConditionHandle"}},
+    "Outputs": {"Out0": {"Value": {"Ref": "Res0"}}}
+}''')
+    return str(path)
@@ -0,0 +1,54 @@
+import os
+import stat
+
+from cfnstack.ConfigLoader import ConfigLoader
+
+"""
+Config cache: templated configs are cached only when their rendered variables are cacheable
+"""
+
+CONFIG = '''sample:
+    region: us-east-1
+    stacks:
+        vpc:
+            cf_template: {{PROJECT_BASE}}/vpc/vpc_setup.template
+            params:
+                password:
+                    value: "{{DB_PASSWORD}}"
+'''
+
+
+def cache_files(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if name.startswith('config-')) if os.path.isdir(cache_dir) else []
+
+
+def test_cacheable_variables(tmp_path, monkeypatch):
+    yamlfile = tmp_path / 'sample.yaml'
+    yamlfile.write_text(CONFIG.replace('{{DB_PASSWORD}}', 'fixed'))
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setenv('PROJECT_BASE', '/srv/one')
+
+    config = ConfigLoader(cache_dir, cache_variables=['PROJECT_BASE']).load(str(yamlfile))
+    assert config['sample']['stacks']['vpc']['cf_template'] == '/srv/one/vpc/vpc_setup.template'
+    files = cache_files(cache_dir)
+    assert len(files) == 1
+    assert stat.S_IMODE(os.stat(os.path.join(cache_dir, files[0])).st_mode) == 0o600
+    assert ConfigLoader(cache_dir, cache_variables=['PROJECT_BASE']).load(str(yamlfile)) == config
+
+    # Another value is another entry
+    monkeypatch.setenv('PROJECT_BASE', '/srv/two')
+    config = ConfigLoader(cache_dir, cache_variables=['PROJECT_BASE']).load(str(yamlfile))
+    assert config['sample']['stacks']['vpc']['cf_template'] == '/srv/two/vpc/vpc_setup.template'
+    assert len(cache_files(cache_dir)) == 2
+
+
+def test_secret_values_stay_off_disk(tmp_path, monkeypatch):
+    yamlfile = tmp_path / 'sample.yaml'
+    yamlfile.write_text(CONFIG)
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setenv('PROJECT_BASE', '/srv/one')
+    monkeypatch.setenv('DB_PASSWORD', 's3cr3t-value')
+
+    config = ConfigLoader(cache_dir, cache_variables=['PROJECT_BASE']).load(str(yamlfile))
+    assert config['sample']['stacks']['vpc']['params']['password']['value'] == 's3cr3t-value'
+    assert cache_files(cache_dir) == []
@@ -0,0 +1,62 @@
+import os
+import stat
+import sys
+
+import pytest
+import simplejson
+
+import cfnstack
+from cfnstack.DeployJournal import DeployJournal
+from cfnstack.StackGlue import StackGlue
+from conftest import REGION
+
+"""
+Deploy journal (--journal, --resume) against the CloudFormation of moto
+"""
+
+SECRET = 's3cr3t-value'
+
+
+def write_config(tmp_path, template):
+    yamlfile = tmp_path / 'sample.yaml'
+    yamlfile.write_text('''sample:
+    region: %s
+    environment: dev
+    stacks:
+        vpc:
+            cf_template: %s
+            depends:
+            params:
+                revision:
+                    value: "%s"
+''' % (REGION, template, SECRET))
+    return str(yamlfile)
+
+
+def test_journal_keeps_values_off_disk(aws, template, tmp_path):
+    yamlfile = write_config(tmp_path, template)
+    path = str(tmp_path / 'deploy.journal')
+    journal = DeployJournal.start(path, 'apply', yamlfile)
+    glue = StackGlue(yamlfile, None, region=REGION, journal=journal)
+    glue.sort_cf_stacks_by_deps()
+    glue.apply()
+    journal.close()
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with open(path) as journal_file:
+        text = journal_file.read()
+    assert SECRET not in text
+    completed = [record for record in map(simplejson.loads, text.splitlines()) if record['event'] == 'completed']
+    assert [(record['stack'], record['operation'], record['params']) for record in completed] == \
+        [('sample-dev-vpc', 'create', ['revision'])]
+    assert len(completed[0]['fingerprint']) == 64
+
+
+@pytest.mark.parametrize('options', [['--journal', 'deploy.journal'], ['--journal', 'deploy.journal', '--resume']])
+def test_journal_rejected_for_other_actions(aws, template, tmp_path, monkeypatch, options):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', ['cfnstack', '-y', write_config(tmp_path, template), '-a', 'listcs'] + options)
+    with pytest.raises(SystemExit) as exit_info:
+        cfnstack.main()
+    assert exit_info.value.code == 1
+    assert not os.path.exists('deploy.journal')
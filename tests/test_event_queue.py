@@ -0,0 +1,146 @@
+import logging
+
+import boto3
+
+from cfnstack.EventQueue import EventQueue, parse_notification
+from cfnstack.StackEvents import EventCursor
+from cfnstack.StackGlue import StackGlue
+from cfnstack.StackWatcher import StackWatcher
+from conftest import REGION
+
+"""
+Push mode (--events push) against the SNS and SQS of moto: moto publishes the stack events of
+CloudFormation to the NotificationARNs of a stack like AWS does
+"""
+
+NOTIFICATION = """StackId='arn:aws:cloudformation:us-east-1:123456789012:stack/sample-dev-vpc/1'
+Timestamp='2026-10-17T23:28:21.514Z'
+EventId='vpc-CREATE_COMPLETE-1'
+LogicalResourceId='sample-dev-vpc'
+Namespace='123456789012'
+PhysicalResourceId='arn:aws:cloudformation:us-east-1:123456789012:stack/sample-dev-vpc/1'
+ResourceProperties='null'
+ResourceStatus='CREATE_COMPLETE'
+ResourceStatusReason=''
+ResourceType='AWS::CloudFormation::Stack'
+StackName='sample-dev-vpc'
+ClientRequestToken='null'
+"""
+
+
+def clients():
+    return (boto3.client('sns', region_name=REGION), boto3.client('sqs', region_name=REGION),
+            boto3.client('cloudformation', region_name=REGION))
+
+
+def create_stack(cf_client, name, template, topic_arn):
+    with open(template) as template_file:
+        cf_client.create_stack(StackName=name, TemplateBody=template_file.read(), NotificationARNs=[topic_arn],
+                               Parameters=[{'ParameterKey': 'revision', 'ParameterValue': '1'}])
+
+
+def test_parse_notification():
+    event = parse_notification(NOTIFICATION)
+    assert event['StackName'] == 'sample-dev-vpc'
+    assert event['ResourceStatus'] == 'CREATE_COMPLETE'
+    assert event['ResourceType'] == 'AWS::CloudFormation::Stack'
+    assert event['Timestamp'].tzinfo is not None
+    assert parse_notification('{"not": "a notification"}') is None
+
+
+def test_open_and_close(aws):
+    sns, sqs, _ = clients()
+    topic_arn = sns.create_topic(Name='cfn-events')['TopicArn']
+    event_queue = EventQueue(sns, sqs, [topic_arn])
+    event_queue.open()
+
+    assert sqs.list_queues()['QueueUrls'] == [event_queue.queue_url]
+    queue_arn = sqs.get_queue_attributes(QueueUrl=event_queue.queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+    subscriptions = sns.list_subscriptions_by_topic(TopicArn=topic_arn)['Subscriptions']
+    assert [(subscription['Protocol'], subscription['Endpoint']) for subscription in subscriptions] == [('sqs', queue_arn)]
+
+    event_queue.close()
+    assert sqs.list_queues().get('QueueUrls', []) == []
+    assert sns.list_subscriptions_by_topic(TopicArn=topic_arn)['Subscriptions'] == []
+    assert event_queue.queue_url is None
+
+
+def test_receive_stack_events(aws, template):
+    sns, sqs, cf_client = clients()
+    topic_arn = sns.create_topic(Name='cfn-events')['TopicArn']
+    event_queue = EventQueue(sns, sqs, [topic_arn])
+    event_queue.open()
+    try:
+        create_stack(cf_client, 'sample-dev-vpc', template, topic_arn)
+        events = event_queue.receive(wait_seconds=1)
+    finally:
+        event_queue.close()
+
+    assert events and event_queue.messages >= len(events)
+    assert set(event['StackName'] for event in events) == {'sample-dev-vpc'}
+    stack_status = [event['ResourceStatus'] for event in events
+                    if event['ResourceType'] == 'AWS::CloudFormation::Stack']
+    assert 'CREATE_COMPLETE' in stack_status
+    assert all(event['EventId'] and event['Timestamp'].tzinfo is not None for event in events)
+
+
+def test_watcher_finishes_pushed_watch(aws, template):
+    sns, sqs, cf_client = clients()
+    topic_arn = sns.create_topic(Name='cfn-events')['TopicArn']
+    event_queue = EventQueue(sns, sqs, [topic_arn])
+    event_queue.open()
+    # A fallback far in the future, the status can only come from the notifications
+    watcher = StackWatcher(cf_client, event_queue=event_queue, fallback_after=300, receive_wait=1)
+    watcher.start()
+    try:
+        create_stack(cf_client, 'sample-dev-vpc', template, topic_arn)
+        status = watcher.watch('sample-dev-vpc', ['CREATE_IN_PROGRESS'], EventCursor(cf_client, 'sample-dev-vpc'),
+                               pushed=True)
+    finally:
+        watcher.stop()
+        event_queue.close()
+
+    assert status == 'CREATE_COMPLETE'
+    assert watcher.pushed_events > 0
+    assert watcher.event_fetches == 0
+
+
+def test_apply_push_mode(aws, template, tmp_path, caplog):
+    sns, sqs, cf_client = clients()
+    topic_arn = sns.create_topic(Name='cfn-events')['TopicArn']
+    yamlfile = tmp_path / 'sample.yaml'
+    yamlfile.write_text('''sample:
+    sns-topic-arn: %s
+    region: %s
+    environment: dev
+    stacks:
+        vpc:
+            cf_template: %s
+            depends:
+            params:
+                revision:
+                    value: "1"
+        nat:
+            cf_template: %s
+            depends:
+                - vpc
+            params:
+                revision:
+                    source: vpc
+                    type: parameter
+                    variable: revision
+''' % (topic_arn, REGION, template, template))
+
+    glue = StackGlue(str(yamlfile), None, max_parallel=2, region=REGION, event_mode='push')
+    glue.sort_cf_stacks_by_deps()
+    with caplog.at_level(logging.INFO):
+        glue.apply()
+
+    statuses = dict((stack['StackName'], stack['StackStatus']) for stack in cf_client.describe_stacks()['Stacks'])
+    assert statuses == {'sample-dev-vpc': 'CREATE_COMPLETE', 'sample-dev-nat': 'CREATE_COMPLETE'}
+    # The temporary queue and its subscription are gone once the run is over
+    assert sqs.list_queues().get('QueueUrls', []) == []
+    assert sns.list_subscriptions_by_topic(TopicArn=topic_arn)['Subscriptions'] == []
+    # Both stacks finished on their notifications, none was polled
+    assert 'Stack events received from queue' in caplog.text
+    assert 'polling them' not in caplog.text
@@ -0,0 +1,132 @@
+import logging
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+from cfnstack.StackGlue import StackGlue
+from cfnstack.TemplateCache import TEMPLATE_CACHE
+from cfnstack.TemplateStore import TemplateStore
+from conftest import REGION
+
+"""
+Template bucket (template-bucket, --template-bucket) against the S3 and CloudFormation of moto
+"""
+
+BUCKET = 'cfn-templates'
+
+
+@pytest.fixture
+def s3(aws):
+    s3_client = boto3.client('s3', region_name=REGION)
+    s3_client.create_bucket(Bucket=BUCKET)
+    return s3_client
+
+
+def count_calls(client, operation):
+    """
+    List filled with the parameters of every call of operation made by client
+    """
+    calls = []
+    client.meta.events.register('provide-client-params.s3.%s' % operation,
+                                lambda params, **kwargs: calls.append(dict(params)))
+    return calls
+
+
+def test_upload_under_content_hash(s3, template):
+    stored = TEMPLATE_CACHE.load(template)
+    store = TemplateStore(s3, BUCKET, cache_dir='')
+    url = store.template_url(stored)
+
+    key = 'cfnstack/templates/%s.json' % stored.sha256
+    assert url == 'https://%s.s3.%s.amazonaws.com/%s' % (BUCKET, REGION, key)
+    assert s3.get_object(Bucket=BUCKET, Key=key)['Body'].read().decode('utf-8') == stored.body
+    assert store.uploads == 1
+
+
+def test_head_skips_stored_template(s3, template):
+    stored = TEMPLATE_CACHE.load(template)
+    TemplateStore(s3, BUCKET, cache_dir='').template_url(stored)
+
+    puts = count_calls(s3, 'PutObject')
+    store = TemplateStore(s3, BUCKET, cache_dir='')
+    store.template_url(stored)
+    assert (store.uploads, store.head_hits) == (0, 1)
+    assert puts == []
+
+
+def test_manifest_skips_head(s3, template, tmp_path):
+    stored = TEMPLATE_CACHE.load(template)
+    first = TemplateStore(s3, BUCKET, cache_dir=str(tmp_path / 'cache'))
+    first.template_url(stored)
+    first.save_manifest()
+
+    heads = count_calls(s3, 'HeadObject')
+    puts = count_calls(s3, 'PutObject')
+    second = TemplateStore(s3, BUCKET, cache_dir=str(tmp_path / 'cache'))
+    assert second.template_url(stored) == first.template_url(stored)
+    assert (second.uploads, second.head_hits, second.manifest_hits) == (0, 0, 1)
+    assert heads == [] and puts == []
+
+
+def test_denied_head_is_logged(s3, template, monkeypatch, caplog):
+    stored = TEMPLATE_CACHE.load(template)
+    store = TemplateStore(s3, BUCKET, cache_dir='')
+
+    def denied_head(**kwargs):
+        raise ClientError({'Error': {'Code': '403', 'Message': 'Forbidden'}}, 'HeadObject')
+    monkeypatch.setattr(store.s3_client, 'head_object', denied_head)
+
+    with caplog.at_level(logging.WARNING):
+        store.template_url(stored)
+        store.log_summary()
+    assert (store.uploads, store.head_denied) == (1, 1)
+    assert 'HEAD of s3://%s/' % BUCKET in caplog.text
+    assert '1 templates were uploaded because HEAD was denied' in caplog.text
+
+
+class RecordingGlue(StackGlue):
+    """
+    StackGlue recording the parameters of the stack calls of its sessions
+    """
+
+    calls = []
+
+    def _new_session(self):
+        session = super(RecordingGlue, self)._new_session()
+        for operation in ('CreateStack', 'UpdateStack'):
+            session.events.register('provide-client-params.cloudformation.%s' % operation,
+                                    lambda params, operation=operation, **kwargs: self.calls.append((operation, dict(params))))
+        return session
+
+
+def test_create_and_update_use_template_url(s3, template, tmp_path, monkeypatch):
+    yamlfile = tmp_path / 'sample.yaml'
+    yamlfile.write_text('''sample:
+    region: %s
+    environment: dev
+    template-bucket: %s
+    stacks:
+        vpc:
+            cf_template: %s
+            depends:
+            params:
+                revision:
+                    value: "{{REVISION}}"
+''' % (REGION, BUCKET, template))
+    key = 'cfnstack/templates/%s.json' % TEMPLATE_CACHE.load(template).sha256
+    RecordingGlue.calls = []
+
+    for revision in ('1', '2'):
+        monkeypatch.setenv('REVISION', revision)
+        glue = RecordingGlue(str(yamlfile), None, region=REGION)
+        glue.sort_cf_stacks_by_deps()
+        glue.apply()
+        glue.save_template_manifest()
+
+    assert [operation for operation, params in RecordingGlue.calls] == ['CreateStack', 'UpdateStack']
+    for operation, params in RecordingGlue.calls:
+        assert 'TemplateBody' not in params
+        assert params['TemplateURL'].endswith('/%s' % key)
+    stack = boto3.client('cloudformation', region_name=REGION).describe_stacks(StackName='sample-dev-vpc')['Stacks'][0]
+    assert stack['Parameters'] == [{'ParameterKey': 'revision', 'ParameterValue': '2'}]